@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Benchmark /meme latency under concurrent chats against a local mock Reddit.
+
+Compares the blocking MemeFetcher called directly from an async handler
+(the old behaviour) with the AsyncMemeFetcher awaited by the handler.
+
+Usage:
+    python benchmarks/bench_async_fetch.py [--chats 200] [--rounds 3]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_reddit import MockRedditServer
+
+
+def percentile(samples: list, pct: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def run_chats(fetch, chats: int, rounds: int) -> list:
+    """Fire ``chats`` concurrent /meme commands ``rounds`` times; return latencies."""
+    latencies = []
+    
+    async def one_command(arrived: float):
+        meme = await fetch()
+        latencies.append(time.perf_counter() - arrived)
+        return meme
+    
+    for _ in range(rounds):
+        # All updates arrive at once; latency is measured from arrival, so time
+        # spent queued behind a blocked event loop is counted.
+        arrived = time.perf_counter()
+        await asyncio.gather(*(one_command(arrived) for _ in range(chats)))
+    return latencies
+
+
+async def bench(chats: int, rounds: int) -> None:
+    import logging
+    import telegram_meme_bot as bot
+    logging.getLogger().setLevel(logging.WARNING)
+    
+    sync_fetcher = bot.MemeFetcher()
+    
+    async def blocking_fetch():
+        # What meme_command used to do: a blocking call on the event loop
+        return sync_fetcher.get_random_meme()
+    
+    # The mock's media links point at the real hosts, so skip the media checks
+    async_fetcher = bot.AsyncMemeFetcher(validate=False, dedup=False)
+    
+    results = {}
+    for name, fetch in (('sync (blocking)', blocking_fetch),
+                        ('async', async_fetcher.get_random_meme)):
+        started = time.perf_counter()
+        latencies = await run_chats(fetch, chats, rounds)
+        elapsed = time.perf_counter() - started
+        results[name] = (latencies, elapsed)
+    
+    await async_fetcher.aclose()
+    
+    print(f"{chats} concurrent chats x {rounds} rounds")
+    print(f"{'mode':<18}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}{'cmd/s':>10}")
+    for name, (latencies, elapsed) in results.items():
+        print(f"{name:<18}"
+              f"{percentile(latencies, 50) * 1000:>10.1f}"
+              f"{percentile(latencies, 99) * 1000:>10.1f}"
+              f"{max(latencies) * 1000:>10.1f}"
+              f"{len(latencies) / elapsed:>10.1f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--chats', type=int, default=200)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='mock upstream latency in seconds')
+    args = parser.parse_args()
+    
+    with MockRedditServer(latency=args.latency) as server:
+        os.environ['REDDIT_BASE_URL'] = server.base_url
+        asyncio.run(bench(args.chats, args.rounds))
+
+
+if __name__ == '__main__':
+    main()
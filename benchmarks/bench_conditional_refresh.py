@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Benchmark pool refreshes with and without conditional GET.
+
+Runs repeated refresh cycles against a local mock Reddit whose listings
+only change every few cycles, first without validators and then with
+ETags, and compares bytes downloaded and time spent parsing.
+
+Usage:
+    python benchmarks/bench_conditional_refresh.py [--cycles 30] [--change-every 3]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_reddit import MockRedditServer
+
+
+async def run_cycles(server: MockRedditServer, batched: bool, cycles: int,
+                     change_every: int, new_posts: int) -> tuple:
+    import telegram_meme_bot as bot
+    
+    # Media checks would probe the real hosts the mock links to
+    fetcher = bot.AsyncMemeFetcher(batched=batched, validate=False, dedup=False)
+    fetcher.upstream_budget = bot.TokenBucket(1e9, 1e9)
+    server.offset = 0
+    bytes_before = server.bytes_served
+    
+    started = time.perf_counter()
+    for cycle in range(cycles):
+        if cycle and cycle % change_every == 0:
+            # A few new posts push the oldest ones off the listing
+            server.offset += new_posts
+        await fetcher.refresh_pools()
+    elapsed = time.perf_counter() - started
+    
+    await fetcher.aclose()
+    return server.bytes_served - bytes_before, elapsed, fetcher.conditional_stats
+
+
+async def bench(args) -> None:
+    import logging
+    import telegram_meme_bot as bot
+    logging.getLogger().setLevel(logging.WARNING)
+    
+    print(f"{args.cycles} refresh cycles, listings change every {args.change_every} "
+          f"cycles by {args.new_posts} posts")
+    print(f"{'mode':<24}{'KiB down':>10}{'304s':>8}{'parse saved ms':>16}{'posts reused':>14}{'s':>8}")
+    for batched in (True, False):
+        for etags in (False, True):
+            with MockRedditServer(latency=0.0, etags=etags) as server:
+                bot.REDDIT_BASE_URL = server.base_url
+                downloaded, elapsed, stats = await run_cycles(
+                    server, batched, args.cycles, args.change_every, args.new_posts
+                )
+            name = f"{'combined' if batched else 'per-subreddit'}, {'etag' if etags else 'plain'}"
+            reused = f"{stats.posts_reused}/{stats.posts_reused + stats.posts_parsed}"
+            print(f"{name:<24}{downloaded / 1024:>10.0f}{stats.not_modified:>8}"
+                  f"{stats.parse_seconds_saved * 1000:>16.1f}{reused:>14}{elapsed:>8.2f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--cycles', type=int, default=30)
+    parser.add_argument('--change-every', type=int, default=3,
+                        help='listings change once every this many cycles')
+    parser.add_argument('--new-posts', type=int, default=5,
+                        help='posts added per change')
+    asyncio.run(bench(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
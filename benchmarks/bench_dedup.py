@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Repost deduplication benchmark.
+
+index       fills a MultiIndexHashTable with --entries random 64-bit hashes
+            and times inserts, lookups of near-duplicates (a stored hash
+            with up to max_distance bits flipped) and lookups of new hashes,
+            against a linear Hamming scan of every entry; also reports the
+            table's memory.
+pools       fills every subreddit pool from the recorded fixtures, served by
+            a mock upstream where --dup-rate of the image links are reposts
+            of a few popular pictures, with and without MediaDeduplicator,
+            and counts how many pool entries show a picture another entry
+            already shows.
+
+Usage:
+    python benchmarks/bench_dedup.py [--entries 1000000] [--queries 2000] [--dup-rate 0.15]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import image_hash
+import telegram_meme_bot as bot
+from harness import percentile
+from mock_upstream import FixtureUpstreamServer
+
+
+def build(values: list) -> image_hash.MultiIndexHashTable:
+    table = image_hash.MultiIndexHashTable(bot.DEDUP_MAX_DISTANCE, capacity=len(values))
+    for key, value in enumerate(values):
+        table.add(value, key)
+    return table
+
+
+def near(rng: random.Random, value: int, max_distance: int) -> int:
+    for bit in rng.sample(range(image_hash.HASH_BITS), rng.randint(1, max_distance)):
+        value ^= 1 << bit
+    return value
+
+
+def linear_scan(values: list, query: int, max_distance: int):
+    best = None
+    for key, value in enumerate(values):
+        distance = image_hash.hamming(query, value)
+        if distance <= max_distance and (best is None or distance < best[1]):
+            best = (key, distance)
+    return best
+
+
+def time_lookups(lookup, queries: list) -> list:
+    samples = []
+    for query in queries:
+        started = time.perf_counter()
+        lookup(query)
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def bench_index(args) -> None:
+    rng = random.Random(42)
+    max_distance = bot.DEDUP_MAX_DISTANCE
+    values = [rng.getrandbits(image_hash.HASH_BITS) for _ in range(args.entries)]
+    
+    started = time.perf_counter()
+    table = build(values)
+    insert_seconds = time.perf_counter() - started
+    del table
+    tracemalloc.start()
+    table = build(values)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    
+    near_queries = [near(rng, rng.choice(values), max_distance) for _ in range(args.queries)]
+    new_queries = [rng.getrandbits(image_hash.HASH_BITS) for _ in range(args.queries)]
+    scan_queries = near_queries[:args.scan_queries]
+    for query in scan_queries:
+        assert table.nearest(query) == linear_scan(values, query, max_distance)
+    
+    print(f"{args.entries:,} hashes, max distance {max_distance}: "
+          f"{args.entries / insert_seconds:,.0f} inserts/s, {memory / 2 ** 20:.0f} MiB")
+    print(f"{'lookup':<22}{'p50 ms':>10}{'p99 ms':>10}{'lookups/s':>12}")
+    for name, lookup, queries in (
+        ('index, near-duplicate', table.nearest, near_queries),
+        ('index, new hash', table.nearest, new_queries),
+        ('linear scan', lambda query: linear_scan(values, query, max_distance), scan_queries),
+    ):
+        samples = time_lookups(lookup, queries)
+        print(f"{name:<22}{percentile(samples, 50) * 1000:>10.3f}{percentile(samples, 99) * 1000:>10.3f}"
+              f"{len(samples) / sum(samples):>12,.0f}")
+
+
+async def fill_pools(server: FixtureUpstreamServer, dedup: bool) -> tuple:
+    """Fill every pool; return (pool entries, distinct pictures, seconds, media requests)."""
+    fetcher = bot.AsyncMemeFetcher(batched=False, validate=False, dedup=dedup)
+    fetcher.upstream_budget = bot.TokenBucket(1e9, 1e9)
+    requests_before = server.media_requests
+    started = time.perf_counter()
+    await fetcher.refresh_pools()
+    # Cold pools finish deduplicating in the background
+    await asyncio.gather(*(asyncio.all_tasks() - {asyncio.current_task()}), return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    
+    urls = [meme.url for pool in fetcher.pools.values() for meme in pool.memes]
+    pictures = {server.content_key(url) for url in urls}
+    await fetcher.aclose()
+    return len(urls), len(pictures), elapsed, server.media_requests - requests_before
+
+
+async def bench_pools(args) -> None:
+    print(f"\n{len(bot.SUBREDDITS)} subreddit pools, {args.dup_rate:.0%} of image links are reposts")
+    print(f"{'dedup':<8}{'entries':>9}{'pictures':>10}{'repeats':>9}{'fill s':>9}{'media GETs':>12}")
+    for dedup in (False, True):
+        with FixtureUpstreamServer(latency=0.0, media_latency=0.0, html_rate=0.0, missing_rate=0.0,
+                                   oversize_rate=0.0, dup_rate=args.dup_rate) as server:
+            bot.REDDIT_BASE_URL = server.base_url
+            entries, pictures, elapsed, downloads = await fill_pools(server, dedup)
+        print(f"{'on' if dedup else 'off':<8}{entries:>9}{pictures:>10}{entries - pictures:>9}"
+              f"{elapsed:>9.2f}{downloads:>12}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Repost deduplication benchmark')
+    parser.add_argument('--entries', type=int, default=1_000_000, help='hashes in the index')
+    parser.add_argument('--queries', type=int, default=2000, help='index lookups to time')
+    parser.add_argument('--scan-queries', type=int, default=20, help='lookups to time with a linear scan')
+    parser.add_argument('--dup-rate', type=float, default=0.15, help='fraction of image links that are reposts')
+    args = parser.parse_args()
+    bot.logger.setLevel('ERROR')
+    bench_index(args)
+    asyncio.run(bench_pools(args))
+
+
+if __name__ == '__main__':
+    main()
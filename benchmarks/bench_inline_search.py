@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Inline query benchmark: title search over warm pools.
+
+Fills the pools from the recorded listings in benchmarks/fixtures/ (copied
+under new names up to --pools subreddits), then replays keystroke-by-keystroke
+queries built from title words, the way Telegram sends them while a user
+types. Times ``AsyncMemeFetcher.search`` plus building the result page,
+against a linear scan of every title as the baseline.
+
+Usage:
+    python benchmarks/bench_inline_search.py [--pools 20] [--queries 2000]
+"""
+
+import argparse
+import gzip
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import telegram_meme_bot as bot
+from harness import percentile
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def load_listings(fetcher: bot.AsyncMemeFetcher) -> list:
+    listings = []
+    for name in sorted(os.listdir(FIXTURES)):
+        if name.startswith('reddit_') and name.endswith('_hot.json.gz'):
+            with gzip.open(os.path.join(FIXTURES, name), 'rb') as f:
+                subreddit = name[len('reddit_'):-len('_hot.json.gz')]
+                listings.append(fetcher._parse_listing(json.loads(f.read()), subreddit))
+    return listings
+
+
+def fill_pools(fetcher: bot.AsyncMemeFetcher, listings: list, count: int) -> float:
+    """Fill ``count`` pools; return the mean TitleIndex build time in ms."""
+    fetcher.default_subreddits = tuple(f'sub{i:03d}' for i in range(count))
+    fetcher.pools = {}
+    build_seconds = 0.0
+    for i, subreddit in enumerate(fetcher.default_subreddits):
+        memes = [meme._replace(subreddit=subreddit, url=f'{meme.url}?{subreddit}')
+                 for meme in listings[i % len(listings)]]
+        pool = fetcher.pools[subreddit] = bot.MemePool(subreddit)
+        store = bot.MemeStore(memes)
+        started = time.perf_counter()
+        bot.TitleIndex(store)
+        build_seconds += time.perf_counter() - started
+        pool.replace(memes)
+    return build_seconds / count * 1000
+
+
+def keystroke_queries(fetcher: bot.AsyncMemeFetcher, count: int) -> list:
+    """Growing prefixes of one or two title words, as sent while typing."""
+    rng = random.Random(42)
+    words = sorted({word for pool in fetcher.pools.values() for meme in pool.memes
+                    for word in bot.title_words(meme.title) if len(word) > 2})
+    queries = ['']
+    while len(queries) < count:
+        text = ' '.join(rng.sample(words, rng.choice((1, 1, 2))))
+        queries.extend(text[:end] for end in range(1, len(text) + 1))
+    return queries[:count]
+
+
+def linear_scan(fetcher: bot.AsyncMemeFetcher, query: str) -> list:
+    needle = query.casefold()
+    return [meme for pool in fetcher.pools.values() for meme in pool.memes if needle in meme.title.casefold()]
+
+
+def time_queries(answer, queries: list) -> list:
+    samples = []
+    for query in queries:
+        started = time.perf_counter()
+        answer(query)
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Inline title search benchmark')
+    parser.add_argument('--pools', type=int, default=20, help='subreddit pools to fill')
+    parser.add_argument('--queries', type=int, default=2000, help='inline queries to replay')
+    args = parser.parse_args()
+    bot.logger.setLevel('ERROR')
+    
+    fetcher = bot.AsyncMemeFetcher(validate=False, dedup=False)
+    build_ms = fill_pools(fetcher, load_listings(fetcher), args.pools)
+    memes = sum(len(pool) for pool in fetcher.pools.values())
+    queries = keystroke_queries(fetcher, args.queries)
+    
+    def indexed(query: str) -> None:
+        page, _ = fetcher.search(query, 0, bot.INLINE_PAGE_SIZE)
+        [bot.inline_result(meme) for meme in page]
+    
+    def scanned(query: str) -> None:
+        [bot.inline_result(meme) for meme in linear_scan(fetcher, query)[:bot.INLINE_PAGE_SIZE]]
+    
+    print(f"{args.pools} pools, {memes} memes, {len(queries)} keystroke queries; "
+          f"TitleIndex build {build_ms:.2f} ms per pool")
+    print(f"{'search':<14}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}{'queries/s':>12}")
+    for name, answer in (('title index', indexed), ('linear scan', scanned)):
+        samples = time_queries(answer, queries)
+        print(f"{name:<14}{percentile(samples, 50) * 1000:>10.3f}{percentile(samples, 99) * 1000:>10.3f}"
+              f"{max(samples) * 1000:>10.3f}{len(samples) / sum(samples):>12,.0f}")
+
+
+if __name__ == '__main__':
+    main()
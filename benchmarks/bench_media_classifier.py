@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark for the media URL classifier.
+
+Compares the original substring-scanning _is_valid_media_url with the
+compiled classify_media_url over a corpus of listing URLs.
+
+Usage:
+    python benchmarks/bench_media_classifier.py [--corpus urls.txt] [--size 100000]
+
+The corpus file holds one URL per line (e.g. the ``url`` field of posts
+dumped from hot.json listings). Without one, a synthetic corpus with the
+host/extension mix of a typical r/memes listing is generated.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram_meme_bot import classify_media_url
+
+
+def legacy_is_valid_media_url(url: str) -> bool:
+    """The pre-classifier implementation, kept for comparison."""
+    if not url:
+        return False
+    
+    image_extensions = ['.jpg', '.jpeg', '.png', '.gif', '.webp']
+    video_extensions = ['.mp4', '.gifv', '.webm']
+    
+    url_lower = url.lower()
+    
+    if any(ext in url_lower for ext in image_extensions):
+        return True
+    
+    if any(ext in url_lower for ext in video_extensions):
+        return True
+    
+    image_domains = [
+        'imgur.com', 'i.imgur.com', 'redd.it', 'i.redd.it',
+        'media.giphy.com', 'giphy.com', 'tenor.com', 'gfycat.com',
+        'v.redd.it', 'preview.redd.it'
+    ]
+    
+    if any(domain in url_lower for domain in image_domains):
+        return True
+    
+    return False
+
+
+def synthetic_corpus(size: int, seed: int = 1234) -> list:
+    """Generate listing-like post URLs."""
+    rng = random.Random(seed)
+    
+    def token(n=13):
+        return ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz0123456789') for _ in range(n))
+    
+    templates = [
+        (40, lambda: f"https://i.redd.it/{token()}.jpeg"),
+        (15, lambda: f"https://i.redd.it/{token()}.png"),
+        (6, lambda: f"https://i.redd.it/{token()}.gif"),
+        (10, lambda: f"https://v.redd.it/{token()}"),
+        (8, lambda: f"https://www.reddit.com/gallery/{token(7)}"),
+        (6, lambda: f"https://www.reddit.com/r/memes/comments/{token(7)}/{token(20)}/"),
+        (5, lambda: f"https://i.imgur.com/{token(7)}.jpg"),
+        (2, lambda: f"https://i.imgur.com/{token(7)}.gifv"),
+        (2, lambda: f"https://imgur.com/a/{token(7)}"),
+        (3, lambda: f"https://preview.redd.it/{token()}.png?width=640&format=png&auto=webp&s={token(40)}"),
+        (2, lambda: f"https://youtube.com/watch?v={token(11)}"),
+        (1, lambda: f"https://example.com/share?u=https%3A%2F%2Fgiphy.com%2F{token(8)}"),
+    ]
+    weights = [w for w, _ in templates]
+    makers = [m for _, m in templates]
+    return [rng.choices(makers, weights)[0]() for _ in range(size)]
+
+
+def time_it(func, corpus: list, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for url in corpus:
+            func(url)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Media URL classifier microbenchmark')
+    parser.add_argument('--corpus', help='file with one URL per line')
+    parser.add_argument('--size', type=int, default=100_000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    
+    if args.corpus:
+        with open(args.corpus, encoding='utf-8') as f:
+            corpus = [line.strip() for line in f if line.strip()]
+    else:
+        corpus = synthetic_corpus(args.size)
+    
+    legacy = time_it(legacy_is_valid_media_url, corpus, args.repeat)
+    compiled = time_it(classify_media_url, corpus, args.repeat)
+    
+    disagreements = [u for u in corpus
+                     if legacy_is_valid_media_url(u) != (classify_media_url(u) is not None)]
+    
+    print(f"{len(corpus)} URLs, best of {args.repeat}")
+    print(f"{'classifier':<12}{'total ms':>10}{'ns/url':>10}{'Murl/s':>10}")
+    for name, elapsed in (('legacy', legacy), ('compiled', compiled)):
+        print(f"{name:<12}{elapsed * 1000:>10.1f}{elapsed / len(corpus) * 1e9:>10.0f}"
+              f"{len(corpus) / elapsed / 1e6:>10.2f}")
+    print(f"speedup: {legacy / compiled:.2f}x")
+    print(f"{len(disagreements)} URLs classified differently "
+          f"(legacy substring matches in query strings, redd.it short links, ...)")
+    for url in disagreements[:5]:
+        print(f"   {url}")
+
+
+if __name__ == '__main__':
+    main()
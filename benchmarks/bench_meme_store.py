@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Memory and sampling benchmark for meme pool storage.
+
+Compares a list of dicts (the old pool format, as produced by parsing
+listing JSON) with a list of Meme records and the columnar MemeStore.
+
+Usage:
+    python benchmarks/bench_meme_store.py [--size 1000000]
+"""
+
+import argparse
+import gc
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram_meme_bot import Meme, MemeStore
+
+SUBREDDITS = [f'sub{i:03d}' for i in range(200)]
+
+
+def make_rows(size: int) -> list:
+    """Title/URL/subreddit/permalink strings shared by every representation."""
+    rng = random.Random(42)
+    rows = []
+    for i in range(size):
+        subreddit = rng.choice(SUBREDDITS)
+        rows.append((
+            f'Meme number {i} with a typical title length',
+            f'https://i.redd.it/{i:013d}.jpeg',
+            subreddit,
+            f'https://reddit.com/r/{subreddit}/comments/{i:07d}/meme_number_{i}/',
+        ))
+    return rows
+
+
+def as_dicts(rows: list) -> list:
+    # json.loads gives every post its own copy of the subreddit name
+    return [{'title': t, 'url': u, 'subreddit': ''.join(list(s)), 'permalink': p}
+            for t, u, s, p in rows]
+
+
+def as_records(rows: list) -> list:
+    return [Meme(t, u, sys.intern(s), p) for t, u, s, p in rows]
+
+
+def as_store(rows: list) -> MemeStore:
+    return MemeStore(Meme(t, u, s, p) for t, u, s, p in rows)
+
+
+def measure(build, rows: list):
+    """Return (container, bytes allocated by building it) excluding the shared strings."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    container = build(rows)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return container, after - before
+
+
+def sample_rate(sample, count: int = 200_000) -> float:
+    started = time.perf_counter()
+    for _ in range(count):
+        sample()
+    return count / (time.perf_counter() - started)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Meme pool storage benchmark')
+    parser.add_argument('--size', type=int, default=1_000_000)
+    args = parser.parse_args()
+    
+    rows = make_rows(args.size)
+    
+    results = []
+    for name, build in (('list of dicts', as_dicts), ('list of Meme', as_records), ('MemeStore', as_store)):
+        container, allocated = measure(build, rows)
+        if isinstance(container, MemeStore):
+            rate = sample_rate(container.sample)
+        else:
+            rate = sample_rate(lambda container=container: random.choice(container))
+        results.append((name, allocated, rate))
+        del container
+    
+    print(f"{args.size:,} memes (title/url/permalink strings shared, not counted)")
+    print(f"{'storage':<16}{'MiB':>10}{'bytes/meme':>12}{'samples/s':>14}")
+    for name, allocated, rate in results:
+        print(f"{name:<16}{allocated / 2**20:>10.1f}{allocated / args.size:>12.1f}{rate:>14,.0f}")
+
+
+if __name__ == '__main__':
+    main()
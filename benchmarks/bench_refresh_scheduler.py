@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""
+Refresh scheduler benchmark: thousands of subreddits on one upstream budget.
+
+simulate    runs RefreshScheduler over --subreddits subreddits, with /meme
+            draws spread over them by a Zipf law and each hot listing
+            turning over at its own rate (log-normal around --change-per-hour).
+            Refreshes are simulated (no HTTP); time is compressed --speedup
+            times, with the scheduler's intervals, half-life and budget
+            scaled to match. The same run is repeated with a fixed
+            round-robin refresh spending the same budget. Both report the
+            share of each listing's current posts the pool was missing when
+            a draw was served, averaged over draws in the second half of
+            the run, plus draws that found a never-filled pool, refreshes
+            per minute and how late refreshes started.
+overhead    times record_draw and a full schedule/pop cycle, and measures
+            memory per scheduled subreddit, at --entries subreddits.
+
+Usage:
+    python benchmarks/bench_refresh_scheduler.py [--subreddits 2000] [--hours 2] [--speedup 120]
+"""
+
+import argparse
+import asyncio
+import itertools
+import math
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import telegram_meme_bot as bot
+from harness import percentile
+
+
+class Simulation:
+    """Subreddits with hidden demand and listing change rates, in compressed time."""
+    
+    def __init__(self, args, seed: int = 42):
+        rng = random.Random(seed)
+        self.args = args
+        self.names = [f'sub{i:05d}' for i in range(args.subreddits)]
+        weights = [1 / (rank + 1) ** args.zipf for rank in range(args.subreddits)]
+        total = sum(weights)
+        # Draws per real second, and share of the listing that is new per real second
+        self.draw_rates = [args.draws_per_minute / 60 * args.speedup * weight / total for weight in weights]
+        self.change_rates = [args.change_per_hour / 3600 * args.speedup * math.exp(rng.gauss(0, 1))
+                             for _ in self.names]
+        self.cumulative = list(itertools.accumulate(self.draw_rates))
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.filled_at = {}
+        self.refreshes = 0
+        self.lateness = []
+        self.staleness = []
+        self.cold = 0
+        self.draws = 0
+    
+    async def refresh(self, subreddit: str, due: float, limit: int = 50):
+        """Simulated listing fetch; returns what ``AsyncMemeFetcher._scheduled_refresh`` would."""
+        started = time.monotonic()
+        self.lateness.append(max(0.0, started - due) * self.args.speedup)
+        self.refreshes += 1
+        await asyncio.sleep(self.args.latency / self.args.speedup)
+        now = time.monotonic()
+        previous = self.filled_at.get(subreddit)
+        self.filled_at[subreddit] = now
+        if previous is None:
+            return 1.0, 0.0
+        elapsed = now - previous
+        return 1 - math.exp(-self.change_rates[self.index[subreddit]] * elapsed), elapsed
+    
+    async def drive(self, record_draw, started: float, duration: float) -> None:
+        """Generate draws until ``duration`` real seconds have passed, scoring them after the first half."""
+        rng = random.Random(7)
+        total_rate = sum(self.draw_rates)
+        tick = 0.01
+        while True:
+            now = time.monotonic()
+            if now - started >= duration:
+                return
+            for _ in range(poisson(rng, total_rate * tick)):
+                subreddit = rng.choices(self.names, cum_weights=self.cumulative)[0]
+                record_draw(subreddit)
+                if now - started < duration / 2:
+                    continue
+                self.draws += 1
+                filled = self.filled_at.get(subreddit)
+                if filled is None:
+                    self.cold += 1
+                    self.staleness.append(1.0)
+                else:
+                    self.staleness.append(1 - math.exp(-self.change_rates[self.index[subreddit]] * (now - filled)))
+            await asyncio.sleep(tick)
+
+
+def poisson(rng: random.Random, mean: float) -> int:
+    """Poisson sample (Knuth for small means, normal approximation for large)."""
+    if mean > 30:
+        return max(0, round(rng.gauss(mean, math.sqrt(mean))))
+    limit, count, product = math.exp(-mean), 0, rng.random()
+    while product > limit:
+        count += 1
+        product *= rng.random()
+    return count
+
+
+def make_scheduler(args) -> bot.RefreshScheduler:
+    """A scheduler with the bot's defaults, compressed ``--speedup`` times."""
+    return bot.RefreshScheduler(
+        rate_per_minute=args.budget * args.speedup,
+        burst=max(1.0, bot.UPSTREAM_BURST * bot.REFRESH_BUDGET_SHARE),
+        min_interval=bot.REFRESH_MIN_INTERVAL / args.speedup,
+        max_interval=bot.REFRESH_MAX_INTERVAL / args.speedup,
+        half_life=bot.REFRESH_DEMAND_HALF_LIFE / args.speedup,
+        change_prior=bot.REFRESH_CHANGE_PRIOR * args.speedup,
+    )
+
+
+async def run_adaptive(args) -> tuple:
+    sim = Simulation(args)
+    scheduler = make_scheduler(args)
+    for name in sim.names:
+        scheduler.add(name)
+    
+    async def refresh(subreddit: str, limit: int):
+        return await sim.refresh(subreddit, scheduler.entries[subreddit].due, limit)
+    
+    duration = args.hours * 3600 / args.speedup
+    started = time.monotonic()
+    runner = asyncio.get_running_loop().create_task(scheduler.run(refresh))
+    try:
+        await sim.drive(scheduler.record_draw, started, duration)
+    finally:
+        runner.cancel()
+        await asyncio.gather(runner, return_exceptions=True)
+    return sim, scheduler, time.monotonic() - started
+
+
+async def run_fixed(args) -> tuple:
+    """Round-robin over every subreddit as fast as the same budget allows."""
+    sim = Simulation(args)
+    budget = bot.TokenBucket(args.budget * args.speedup / 60, max(1.0, bot.UPSTREAM_BURST * bot.REFRESH_BUDGET_SHARE))
+    slots = asyncio.Semaphore(bot.REFRESH_CONCURRENCY)
+    
+    async def refresh_all() -> None:
+        tasks = set()
+        while True:
+            for name in sim.names:
+                await slots.acquire()
+                delay = budget.reserve()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                task = asyncio.get_running_loop().create_task(sim.refresh(name, time.monotonic()))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                task.add_done_callback(lambda done: slots.release())
+    
+    duration = args.hours * 3600 / args.speedup
+    started = time.monotonic()
+    runner = asyncio.get_running_loop().create_task(refresh_all())
+    try:
+        await sim.drive(lambda subreddit: None, started, duration)
+    finally:
+        runner.cancel()
+        await asyncio.gather(runner, return_exceptions=True)
+    return sim, None, time.monotonic() - started
+
+
+async def bench_simulate(args) -> None:
+    print(f"{args.subreddits} subreddits, {args.draws_per_minute:.0f} draws/min (Zipf {args.zipf}), median listing "
+          f"change {args.change_per_hour:.0%}/h, budget {args.budget:.0f} refreshes/min, "
+          f"{args.hours}h simulated at x{args.speedup:.0f}")
+    print(f"{'schedule':<10}{'missing':>9}{'cold':>8}{'refresh/min':>13}{'late p50 s':>12}{'late p99 s':>12}")
+    for name, run in (('fixed', run_fixed), ('adaptive', run_adaptive)):
+        sim, scheduler, elapsed = await run(args)
+        per_minute = sim.refreshes / (elapsed * args.speedup / 60)
+        print(f"{name:<10}{sum(sim.staleness) / max(1, len(sim.staleness)):>9.1%}"
+              f"{sim.cold / max(1, sim.draws):>8.1%}{per_minute:>13.1f}"
+              f"{percentile(sim.lateness, 50):>12.1f}{percentile(sim.lateness, 99):>12.1f}")
+        if scheduler is not None:
+            report_schedules(args, sim, scheduler)
+
+
+def report_schedules(args, sim: Simulation, scheduler: bot.RefreshScheduler) -> None:
+    """Per-subreddit stats for the most drawn-from subreddits and a sample of the rest, in simulated time."""
+    hour = 3600 / args.speedup
+    limits = {}
+    for entry in scheduler.entries.values():
+        limits[entry.limit] = limits.get(entry.limit, 0) + 1
+    print(f"\nadaptive: {len(scheduler) - scheduler._idle} active subreddits; listing limits "
+          f"{', '.join(f'{limit}: {count}' for limit, count in sorted(limits.items()))}")
+    print(f"{'subreddit':<12}{'draws/h':>9}{'change/h':>10}{'true':>8}{'interval s':>12}{'limit':>7}"
+          f"{'changed':>9}{'unchanged':>11}")
+    ranks = [0, 1, 2, 5, 10, 50, 200, 1000, len(sim.names) - 1]
+    for rank in sorted({rank for rank in ranks if rank < len(sim.names)}):
+        entry = scheduler.entries[sim.names[rank]]
+        change = f"{entry.change_rate * hour:.0%}" if entry.change_rate is not None else '-'
+        print(f"{entry.subreddit:<12}{scheduler.demand_rate(entry) * hour:>9.1f}{change:>10}"
+              f"{sim.change_rates[rank] * hour:>8.0%}{entry.interval * args.speedup:>12.0f}{entry.limit:>7}"
+              f"{entry.changed:>9}{entry.unchanged:>11}")
+
+
+def bench_overhead(args) -> None:
+    rng = random.Random(1)
+    names = [f'sub{i:06d}' for i in range(args.entries)]
+    tracemalloc.start()
+    scheduler = bot.RefreshScheduler()
+    now = time.monotonic()
+    for name in names:
+        scheduler.add(name, refreshed_at=now, now=now)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    
+    draws = [rng.choice(names) for _ in range(args.queries)]
+    started = time.perf_counter()
+    for name in draws:
+        scheduler.record_draw(name)
+    draw_seconds = (time.perf_counter() - started) / len(draws)
+    
+    async def cycle() -> float:
+        """Pop due entries and reschedule them, as the run loop does around each refresh."""
+        scheduler._wakeup = asyncio.Event()
+        for entry in scheduler.entries.values():
+            scheduler._push(entry, 0.0)
+        started = time.perf_counter()
+        for _ in range(args.queries):
+            entry = await scheduler._next_due()
+            entry.refreshing = False
+            entry.refreshed_at = time.monotonic()
+            scheduler._schedule(entry, entry.refreshed_at)
+        return (time.perf_counter() - started) / args.queries
+    
+    cycle_seconds = asyncio.run(cycle())
+    print(f"\n{args.entries:,} scheduled subreddits: {memory / args.entries:.0f} bytes each, "
+          f"record_draw {draw_seconds * 1e6:.1f} us, pop + reschedule {cycle_seconds * 1e6:.1f} us")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Adaptive refresh scheduler benchmark')
+    parser.add_argument('--subreddits', type=int, default=2000)
+    parser.add_argument('--draws-per-minute', type=float, default=300, help='/meme draws across all subreddits')
+    parser.add_argument('--zipf', type=float, default=1.1, help='exponent of the draw popularity law')
+    parser.add_argument('--change-per-hour', type=float, default=0.3, help='median share of a listing new per hour')
+    parser.add_argument('--budget', type=float, default=bot.UPSTREAM_RATE_PER_MINUTE * bot.REFRESH_BUDGET_SHARE,
+                        help='refreshes per minute')
+    parser.add_argument('--latency', type=float, default=0.5, help='simulated refresh time in seconds')
+    parser.add_argument('--hours', type=float, default=2.0, help='simulated hours per schedule')
+    parser.add_argument('--speedup', type=float, default=120.0, help='simulated seconds per real second')
+    parser.add_argument('--entries', type=int, default=100_000, help='subreddits for the overhead test')
+    parser.add_argument('--queries', type=int, default=100_000, help='operations to time in the overhead test')
+    args = parser.parse_args()
+    bot.logger.setLevel('ERROR')
+    asyncio.run(bench_simulate(args))
+    bench_overhead(args)
+
+
+if __name__ == '__main__':
+    main()
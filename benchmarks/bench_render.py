@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+/make rendering benchmark.
+
+Renders captions on the bundled templates (or --templates DIR) through
+TemplateRenderer and reports renders/sec and renders/sec per core:
+
+    unique      every request has new captions, so every one is rendered
+    repeated    requests cycle through a few captions, served from the cache
+
+It also renders the unique workload directly on the event loop, the way a
+naive handler would, and reports the worst event loop stall in both modes:
+rendering in the process pool keeps the loop free for /meme.
+
+Usage:
+    python benchmarks/bench_render.py [--renders 200] [--workers 1 2 4]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import meme_templates
+import telegram_meme_bot as bot
+
+WORDS = ('when', 'you', 'finally', 'the', 'code', 'works', 'on', 'friday', 'deploy', 'nobody',
+         'me', 'explaining', 'to', 'my', 'cat', 'why', 'tests', 'pass', 'locally', 'but')
+
+
+def captions(count: int, seed: int = 42) -> list:
+    rng = random.Random(seed)
+    return [(' '.join(rng.choices(WORDS, k=rng.randint(2, 7))), ' '.join(rng.choices(WORDS, k=rng.randint(2, 9))))
+            for _ in range(count)]
+
+
+async def watch_loop(stop: asyncio.Event, interval: float = 0.005) -> float:
+    """Worst lateness of a timer while the workload runs, in seconds."""
+    worst = 0.0
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - started - interval)
+    return worst
+
+
+async def run(renderer: bot.TemplateRenderer, requests: list, concurrency: int) -> tuple:
+    """Render every request; return (seconds, worst loop stall)."""
+    names = list(renderer.templates)
+    queue = list(requests)
+    
+    async def worker() -> None:
+        while queue:
+            top, bottom = queue.pop()
+            await renderer.render(names[len(top) % len(names)], meme_templates.normalize_caption(top),
+                                  meme_templates.normalize_caption(bottom))
+    
+    stop = asyncio.Event()
+    watcher = asyncio.create_task(watch_loop(stop))
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    return elapsed, await watcher
+
+
+async def run_inline(directory: str, requests: list) -> tuple:
+    """Render on the event loop itself; return (seconds, worst loop stall)."""
+    templates = list(meme_templates.find_templates(directory).values())
+    meme_templates.preload(templates)
+    stop = asyncio.Event()
+    watcher = asyncio.create_task(watch_loop(stop))
+    await asyncio.sleep(0)
+    started = time.perf_counter()
+    for top, bottom in requests:
+        meme_templates.render(templates[len(top) % len(templates)], meme_templates.normalize_caption(top),
+                              meme_templates.normalize_caption(bottom))
+        await asyncio.sleep(0)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    return elapsed, await watcher
+
+
+async def main_async(args) -> None:
+    cores = os.cpu_count() or 1
+    unique = captions(args.renders)
+    repeated = [unique[index % 10] for index in range(args.renders)]
+    
+    print(f"{args.renders} renders on {cores} core(s), templates from {args.templates}")
+    print(f"{'mode':<10}{'workers':>8}{'renders/s':>12}{'per core':>10}{'worst stall ms':>16}")
+    elapsed, stall = await run_inline(args.templates, unique)
+    print(f"{'on loop':<10}{'-':>8}{args.renders / elapsed:>12.1f}{args.renders / elapsed:>10.1f}{stall * 1000:>16.1f}")
+    
+    for workers in args.workers:
+        for mode, requests in (('unique', unique), ('repeated', repeated)):
+            renderer = bot.TemplateRenderer(args.templates, workers=workers)
+            # Start the pool (and let it decode the templates) outside the timing
+            await renderer.render(next(iter(renderer.templates)), 'WARM', 'UP')
+            elapsed, stall = await run(renderer, requests, concurrency=workers * 2)
+            renderer.shutdown()
+            rate = args.renders / elapsed
+            print(f"{mode:<10}{workers:>8}{rate:>12.1f}{rate / min(workers, cores):>10.1f}{stall * 1000:>16.1f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='/make rendering benchmark')
+    parser.add_argument('--renders', type=int, default=200)
+    parser.add_argument('--workers', type=int, nargs='+', default=sorted({1, os.cpu_count() or 1}))
+    parser.add_argument('--templates', default=bot.MEME_TEMPLATE_DIR, help='template directory')
+    args = parser.parse_args()
+    bot.logger.setLevel('ERROR')
+    asyncio.run(main_async(args))
+
+
+if __name__ == '__main__':
+    main()
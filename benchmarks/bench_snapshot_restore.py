@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Warm-restart benchmark for the on-disk snapshot.
+
+Writes a snapshot the size a busy bot would leave behind (full pools for
+every subreddit, source health and a full file_id cache), then times how
+long a fresh process needs to restore it.
+
+Usage:
+    python benchmarks/bench_snapshot_restore.py [--pool-size 300] [--file-ids 10000]
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import telegram_meme_bot as bot
+
+
+def write_snapshot(path: str, pool_size: int, file_ids: int) -> None:
+    store = bot.SharedMemeStore(path)
+    for subreddit in bot.SUBREDDITS:
+        store.publish(subreddit, [
+            bot.Meme(f'Meme number {i} with a typical title length',
+                     f'https://i.redd.it/{subreddit}{i:08d}.jpeg', subreddit,
+                     f'https://reddit.com/r/{subreddit}/comments/{i:07d}/meme_number_{i}/')
+            for i in range(pool_size)
+        ])
+    
+    health = bot.SourceHealth()
+    for name in ('reddit:json', 'reddit:rss', 'reddit:top', 'reddit:new', 'reddit:rising', 'giphy'):
+        health.breaker(name).record_success()
+    health.breaker('giphy').record_failure('HTTP 429', rate_limited=True, retry_after=60)
+    store.save_breakers(health.snapshot())
+    
+    cache = bot.FileIdCache(max_entries=file_ids)
+    for i in range(file_ids):
+        cache.put(f'https://i.redd.it/{i:013d}.jpeg', 'photo', f'AgACAgQAAxkBAAI{i:020d}')
+    store.save_file_ids(cache.items(), file_ids)
+    store.close()
+
+
+def restore(path: str, file_ids: int) -> tuple:
+    """Restore like ``post_init`` does; return (pools ms, file_ids ms)."""
+    fetcher = bot.AsyncMemeFetcher(store=bot.SharedMemeStore(path))
+    started = time.perf_counter()
+    fetcher.load_snapshot()
+    pools_done = time.perf_counter()
+    cache = bot.FileIdCache(max_entries=file_ids)
+    cache.restore(fetcher.store.load_file_ids(file_ids))
+    done = time.perf_counter()
+    
+    assert all(len(pool) for pool in fetcher.pools.values()) and len(cache) == file_ids
+    fetcher.store.close()
+    return (pools_done - started) * 1000, (done - pools_done) * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Snapshot restore benchmark')
+    parser.add_argument('--pool-size', type=int, default=300, help='memes per subreddit pool')
+    parser.add_argument('--file-ids', type=int, default=bot.FILE_ID_CACHE_SIZE)
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+    bot.logger.setLevel('ERROR')
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'snapshot.sqlite3')
+        write_snapshot(path, args.pool_size, args.file_ids)
+        size_kb = sum(os.path.getsize(os.path.join(tmp, name)) for name in os.listdir(tmp)) / 1024
+        timings = [restore(path, args.file_ids) for _ in range(args.runs)]
+    
+    pools_ms = statistics.median(t[0] for t in timings)
+    file_ids_ms = statistics.median(t[1] for t in timings)
+    print(f"Snapshot: {len(bot.SUBREDDITS)} pools x {args.pool_size} memes, "
+          f"{args.file_ids} file_ids, {size_kb:.0f} KiB on disk")
+    print(f"Restore (median of {args.runs}): pools+health {pools_ms:.1f}ms, "
+          f"file_ids {file_ids_ms:.1f}ms, total {pools_ms + file_ids_ms:.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Startup benchmark: import time and time to the first /meme.
+
+import      imports meme_core (what the demo and test scripts load) and
+            telegram_meme_bot in fresh interpreters and reports the median
+            import time and which heavy packages each one pulls in.
+first_meme  launches the bot against the mock Telegram and upstream servers
+            with a /meme already queued, the way updates pile up while a
+            container restarts, and times launch to the reply. Each run is
+            done with PREWARM off and on, from an empty store (cold) and from
+            the snapshot the previous run left behind (restart).
+
+Usage:
+    python benchmarks/bench_startup.py [--runs 5] [--latency 0.2] [--telegram-latency 0.1]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import ROOT, bot_env, launch_bot, stop_bot, wait_until
+from mock_telegram import MockTelegramServer, make_command_update
+from mock_upstream import FixtureUpstreamServer
+
+HEAVY_PACKAGES = ('requests', 'httpx', 'telegram', 'telegram.ext', 'PIL')
+
+_IMPORT_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - started
+print(json.dumps([elapsed, [name for name in {heavy!r} if name in sys.modules]]))
+"""
+
+
+def import_time(module: str, runs: int) -> tuple:
+    """Median seconds to import ``module`` in a fresh interpreter, and the heavy packages it loads."""
+    samples = []
+    loaded = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', _IMPORT_PROBE.format(module=module, heavy=HEAVY_PACKAGES)],
+                                cwd=ROOT, capture_output=True, text=True, check=True).stdout
+        elapsed, loaded = json.loads(output.splitlines()[-1])
+        samples.append(elapsed)
+    return statistics.median(samples), loaded
+
+
+async def first_meme(args, store_path: str, prewarm: bool) -> float:
+    """Seconds from launching the bot to its reply to a /meme queued before launch."""
+    upstream = FixtureUpstreamServer(latency=args.latency)
+    telegram = MockTelegramServer(latency=args.telegram_latency, setup_latency=args.telegram_latency,
+                                  deliverable=upstream.deliverable)
+    with upstream, telegram:
+        telegram.push_updates([make_command_update(1, 1)])
+        env = bot_env(telegram.base_url, upstream.base_url, store_path, PREWARM='1' if prewarm else '0')
+        launched = time.monotonic()
+        bot = launch_bot(env)
+        try:
+            await wait_until(lambda: telegram.sent, args.timeout, 'bot did not reply to /meme')
+        finally:
+            stop_bot(bot)
+        return telegram.sent[0][2] - launched
+
+
+async def bench_first_meme(args) -> None:
+    print(f"\nfirst /meme: upstream latency {args.latency}s, Telegram latency {args.telegram_latency}s, "
+          f"median of {args.runs} runs")
+    print(f"{'prewarm':<10}{'cold ms':>10}{'restart ms':>12}")
+    for prewarm in (False, True):
+        cold, restart = [], []
+        for _ in range(args.runs):
+            with tempfile.TemporaryDirectory() as tmp:
+                store_path = os.path.join(tmp, 'memes.sqlite3')
+                cold.append(await first_meme(args, store_path, prewarm))
+                restart.append(await first_meme(args, store_path, prewarm))
+        print(f"{'on' if prewarm else 'off':<10}{statistics.median(cold) * 1000:>10.0f}"
+              f"{statistics.median(restart) * 1000:>12.0f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Bot startup benchmark')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.2, help='mock upstream latency in seconds')
+    parser.add_argument('--telegram-latency', type=float, default=0.1,
+                        help='mock Bot API latency for startup calls and sends, in seconds')
+    parser.add_argument('--timeout', type=float, default=30.0)
+    args = parser.parse_args()
+    
+    print(f"{'module':<20}{'import ms':>10}  loads")
+    for module in ('meme_core', 'telegram_meme_bot'):
+        seconds, loaded = import_time(module, args.runs)
+        print(f"{module:<20}{seconds * 1000:>10.1f}  {', '.join(loaded) or '-'}")
+    asyncio.run(bench_first_meme(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Load test: /meme updates per second in webhook mode vs polling mode.
+
+Starts a fake Telegram Bot API and a mock Reddit locally, runs the real
+bot as a subprocess against them, feeds it synthetic /meme updates
+(POSTed to the webhook, or queued for getUpdates) and measures how fast
+the bot answers them end to end.
+
+With --workers N the webhook run uses the sharded deployment (one fetcher
+process plus N workers sharing a SQLite store); updates are spread across
+the workers' ports round-robin, standing in for a load balancer. Upstream
+requests to the mock Reddit are reported so the fetch cost per mode can be
+compared.
+
+Usage:
+    python benchmarks/bench_webhook_load.py [--updates 2000] [--mode both] [--workers 4]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import httpx
+
+from harness import bot_env, free_port, launch_bot, percentile, stop_bot, wait_until
+from mock_reddit import MockRedditServer
+from mock_telegram import MockTelegramServer, make_command_update
+
+SECRET = 'bench-secret'
+
+
+def start_bot(mode: str, telegram: MockTelegramServer, reddit: MockRedditServer,
+              concurrent_updates: int, webhook_port: int, workers: int,
+              store_path: str) -> subprocess.Popen:
+    # The mock's media links point at the real hosts, so skip the media checks and hashing
+    env = bot_env(telegram.base_url, reddit.base_url, store_path,
+                  CONCURRENT_UPDATES=str(concurrent_updates), VALIDATE_MEDIA='0', DEDUP_MEDIA='0')
+    if mode == 'webhook':
+        env.update({
+            'WEBHOOK_URL': f'http://127.0.0.1:{webhook_port}',
+            'WEBHOOK_LISTEN': '127.0.0.1',
+            'WEBHOOK_PORT': str(webhook_port),
+            'WEBHOOK_SECRET_TOKEN': SECRET,
+            'SHARD_WORKERS': str(workers),
+        })
+    return launch_bot(env)
+
+
+async def post_updates(urls: list, updates: list, concurrency: int) -> list:
+    """POST updates round-robin to the webhook URLs with ``concurrency`` connections; return ack latencies."""
+    latencies = []
+    queue = asyncio.Queue()
+    for update in updates:
+        queue.put_nowait(update)
+    
+    async with httpx.AsyncClient(limits=httpx.Limits(max_connections=concurrency)) as client:
+        async def worker():
+            while not queue.empty():
+                update = queue.get_nowait()
+                url = urls[update['update_id'] % len(urls)]
+                started = time.perf_counter()
+                response = await client.post(
+                    url, content=json.dumps(update),
+                    headers={'Content-Type': 'application/json',
+                             'X-Telegram-Bot-Api-Secret-Token': SECRET},
+                )
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - started)
+        
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies
+
+
+async def run_mode(mode: str, args, reddit: MockRedditServer) -> dict:
+    workers = args.workers if mode == 'webhook' else 0
+    with MockTelegramServer(latency=args.telegram_latency) as telegram, \
+            tempfile.TemporaryDirectory() as tmp:
+        webhook_port = free_port()
+        ports = [webhook_port + index for index in range(max(workers, 1))]
+        upstream_before = reddit.requests_served
+        bot = start_bot(mode, telegram, reddit, args.concurrent_updates, webhook_port,
+                        workers, os.path.join(tmp, 'memes.sqlite3'))
+        try:
+            if mode == 'webhook':
+                # Every worker registers the (same) webhook once it is up
+                await wait_until(lambda: telegram.calls.get('setWebhook', 0) >= len(ports))
+                # Give the webhook server a moment to bind after setWebhook
+                await asyncio.sleep(0.5)
+            else:
+                await wait_until(lambda: telegram.calls.get('getUpdates', 0) > 0)
+            # Let the job queue warm the pools
+            await asyncio.sleep(1.0)
+            
+            updates = [make_command_update(i + 1, 10_000 + i) for i in range(args.updates)]
+            started = time.monotonic()
+            ack_latencies = []
+            if mode == 'webhook':
+                ack_latencies = await post_updates(
+                    [f'http://127.0.0.1:{port}/telegram' for port in ports], updates, args.concurrency
+                )
+            else:
+                telegram.push_updates(updates)
+            
+            await wait_until(lambda: len(telegram.sent) >= args.updates, timeout=args.timeout)
+            elapsed = telegram.sent[-1][2] - started
+        finally:
+            stop_bot(bot)
+    
+    result = {'mode': mode, 'workers': workers, 'updates': args.updates,
+              'seconds': round(elapsed, 3), 'updates_per_sec': round(args.updates / elapsed, 1),
+              'upstream_requests': reddit.requests_served - upstream_before}
+    if ack_latencies:
+        result['ack_p50_ms'] = round(percentile(ack_latencies, 50) * 1000, 2)
+        result['ack_p99_ms'] = round(percentile(ack_latencies, 99) * 1000, 2)
+    return result
+
+
+async def main_async(args) -> None:
+    modes = ['polling', 'webhook'] if args.mode == 'both' else [args.mode]
+    with MockRedditServer(latency=0.01) as reddit:
+        for mode in modes:
+            result = await run_mode(mode, args, reddit)
+            print(json.dumps(result))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Webhook vs polling load test')
+    parser.add_argument('--mode', choices=['polling', 'webhook', 'both'], default='both')
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=32,
+                        help='parallel webhook POST connections')
+    parser.add_argument('--concurrent-updates', type=int, default=64,
+                        help='CONCURRENT_UPDATES for the bot')
+    parser.add_argument('--telegram-latency', type=float, default=0.0,
+                        help='fake Bot API delay for send* calls, in seconds')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='sharded webhook workers (0 runs a single process)')
+    parser.add_argument('--timeout', type=float, default=120.0)
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
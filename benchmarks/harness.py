@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Helpers for benchmarks that run the real bot as a subprocess against the
+local mock services.
+"""
+
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_SCRIPT = os.path.join(ROOT, 'telegram_meme_bot.py')
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(samples: list, pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+
+def bot_env(telegram_url: str, upstream_url: str, store_path: str, **overrides: str) -> Dict[str, str]:
+    """Environment for a bot talking only to local mocks, with per-chat throttling off."""
+    env = dict(os.environ)
+    for name in ('WEBHOOK_URL', 'SHARD_WORKERS', 'SHARD_ROLE', 'FILE_ID_CACHE_PATH'):
+        env.pop(name, None)
+    env.update({
+        'TELEGRAM_BOT_TOKEN': '123456:BENCH',
+        'TELEGRAM_API_BASE_URL': telegram_url,
+        'REDDIT_BASE_URL': upstream_url,
+        'GIPHY_BASE_URL': upstream_url,
+        # Synthetic chats must not be throttled
+        'USER_RATE_PER_MINUTE': '1000000', 'USER_BURST': '1000000',
+        'CHAT_RATE_PER_MINUTE': '1000000', 'CHAT_BURST': '1000000',
+        'UPSTREAM_RATE_PER_MINUTE': '1000000',
+        'MEME_STORE_PATH': store_path,
+    })
+    env.update(overrides)
+    return env
+
+
+def launch_bot(env: Dict[str, str]) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, BOT_SCRIPT], env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def stop_bot(bot: subprocess.Popen) -> None:
+    bot.terminate()
+    try:
+        bot.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        bot.kill()
+        bot.wait()
+
+
+async def wait_until(predicate, timeout: float = 30.0, what: str = 'bot did not become ready') -> None:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise TimeoutError(what)
+        await asyncio.sleep(0.05)
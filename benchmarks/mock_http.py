@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Tiny HTTP/1.1 server base for the local mock services.
+Runs on its own thread and event loop so it keeps answering even when the
+code under test blocks the caller's loop.
+"""
+
+import asyncio
+import threading
+from typing import Dict, Optional, Tuple
+
+# (status, headers, body)
+Response = Tuple[int, Dict[str, str], bytes]
+
+_REASONS = {200: 'OK', 206: 'Partial Content', 304: 'Not Modified', 400: 'Bad Request', 401: 'Unauthorized',
+            404: 'Not Found', 429: 'Too Many Requests', 500: 'Internal Server Error',
+            502: 'Bad Gateway', 503: 'Service Unavailable'}
+
+
+class MockHttpServer:
+    """
+    Keep-alive HTTP server; subclasses implement ``handle_request``.
+    
+    Use as a context manager, or call ``start``/``stop``.
+    """
+    
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        self.host = host
+        self.port = port
+        self.requests_served = 0
+        self.bytes_served = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server = None
+        self._thread: Optional[threading.Thread] = None
+        self._ready = threading.Event()
+    
+    @property
+    def base_url(self) -> str:
+        return f'http://{self.host}:{self.port}'
+    
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self
+    
+    def stop(self) -> None:
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+    
+    def __enter__(self):
+        return self.start()
+    
+    def __exit__(self, *exc) -> None:
+        self.stop()
+    
+    def call_soon(self, callback, *args) -> None:
+        """Run a callback on the server's loop from another thread."""
+        self._loop.call_soon_threadsafe(callback, *args)
+    
+    async def handle_request(self, method: str, path: str, headers: Dict[str, str],
+                             body: bytes) -> Response:
+        raise NotImplementedError
+    
+    def _run(self) -> None:
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._server = self._loop.run_until_complete(
+            asyncio.start_server(self._handle, self.host, self.port, backlog=4096)
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._loop.run_until_complete(self.on_start())
+        self._ready.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            self._server.close()
+            pending = asyncio.all_tasks(self._loop)
+            for task in pending:
+                task.cancel()
+            self._loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            self._loop.close()
+    
+    async def on_start(self) -> None:
+        """Hook run on the server loop before ``start`` returns."""
+    
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                
+                length = int(headers.get('content-length', '0') or 0)
+                body = await reader.readexactly(length) if length else b''
+                
+                method, path = request_line.decode('latin-1').split()[:2]
+                status, response_headers, response_body = await self.handle_request(
+                    method, path, headers, body
+                )
+                
+                # A HEAD answer may declare the length of the body it leaves out
+                length = response_headers.pop('Content-Length', len(response_body))
+                if method == 'HEAD':
+                    response_body = b''
+                head = [f'HTTP/1.1 {status} {_REASONS.get(status, "Status")}',
+                        f'Content-Length: {length}',
+                        'Connection: keep-alive']
+                head.extend(f'{name}: {value}' for name, value in response_headers.items())
+                writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + response_body)
+                await writer.drain()
+                self.requests_served += 1
+                self.bytes_served += len(response_body)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # Server shutdown; don't let asyncio log the cancelled handler
+            pass
+        finally:
+            writer.close()
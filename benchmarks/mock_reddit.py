@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Minimal local stand-in for Reddit's listing endpoints.
+"""
+
+import asyncio
+import hashlib
+import json
+import random
+from typing import Dict, Optional
+from urllib.parse import parse_qs
+from xml.sax.saxutils import escape
+
+from mock_http import MockHttpServer, Response
+
+
+def make_listing(subreddit: str, count: int = 50, offset: int = 0) -> dict:
+    """Build a hot.json-shaped listing with ``count`` image posts, numbered from ``offset``."""
+    children = []
+    for i in range(offset, offset + count):
+        children.append({
+            'kind': 't3',
+            'data': {
+                'id': f'{subreddit[:3]}{i:05d}',
+                'title': f'Test meme {i} from r/{subreddit}',
+                'url': f'https://i.redd.it/{subreddit}{i:05d}.jpg',
+                'permalink': f'/r/{subreddit}/comments/{i:05d}/test_meme_{i}/',
+                'subreddit': subreddit,
+            }
+        })
+    return {'kind': 'Listing', 'data': {'after': None, 'children': children}}
+
+
+def make_feed(subreddit: str, count: int = 50) -> str:
+    """Build an Atom feed shaped like Reddit's /.rss output with ``count`` entries."""
+    entries = []
+    for i in range(count):
+        media = f'https://i.redd.it/{subreddit}{i:05d}.jpg'
+        permalink = f'https://www.reddit.com/r/{subreddit}/comments/{i:05d}/test_meme_{i}/'
+        content = (
+            f'<table> <tr><td> <a href="{permalink}"> '
+            f'<img src="https://preview.redd.it/{subreddit}{i:05d}.jpg?width=640&amp;crop=smart" '
+            f'alt="Test meme {i}" title="Test meme {i}" /> </a> </td><td> '
+            f'submitted by <a href="https://www.reddit.com/user/tester"> /u/tester </a> <br/> '
+            f'<span><a href="{media}">[link]</a></span> &#32; '
+            f'<span><a href="{permalink}">[comments]</a></span> </td></tr></table>'
+        )
+        entries.append(
+            f'<entry><author><name>/u/tester</name></author>'
+            f'<category term="{subreddit}" label="r/{subreddit}"/>'
+            f'<content type="html">{escape(content)}</content>'
+            f'<id>t3_{i:05d}</id><link href="{permalink}" />'
+            f'<updated>2024-01-01T00:00:00+00:00</updated>'
+            f'<title>Test meme {i} from r/{subreddit}</title></entry>'
+        )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<feed xmlns="http://www.w3.org/2005/Atom" xmlns:media="http://search.yahoo.com/mrss/">'
+        f'<title>r/{subreddit}</title>' + ''.join(entries) + '</feed>'
+    )
+
+
+class MockRedditServer(MockHttpServer):
+    """
+    Serves synthetic listings with configurable latency.
+    
+    Args:
+        latency: Base response delay in seconds
+        slow_fraction: Fraction of requests that take ``slow_latency`` instead
+        slow_latency: Delay in seconds for the slow tail
+        error_status: HTTP status to answer with instead of a listing
+            (e.g. 429 or 503); may be changed while the server runs
+        etags: Send ETags and answer matching ``If-None-Match`` with 304
+    
+    Set ``offset`` to shift every JSON listing by that many posts, which
+    simulates new posts arriving (and changes the ETags).
+    """
+    
+    def __init__(self, latency: float = 0.05, slow_fraction: float = 0.0,
+                 slow_latency: float = 1.0, error_status: Optional[int] = None,
+                 etags: bool = False, host: str = '127.0.0.1', port: int = 0):
+        super().__init__(host, port)
+        self.latency = latency
+        self.slow_fraction = slow_fraction
+        self.slow_latency = slow_latency
+        self.error_status = error_status
+        self.etags = etags
+        self.offset = 0
+        self.not_modified = 0
+        self._listings = {}
+    
+    async def handle_request(self, method: str, path: str, headers: Dict[str, str],
+                             body: bytes) -> Response:
+        delay = self.latency
+        if self.slow_fraction and random.random() < self.slow_fraction:
+            delay = self.slow_latency
+        await asyncio.sleep(delay)
+        
+        if self.error_status:
+            return self.error_status, {'Content-Type': 'application/json'}, b'{}'
+        
+        body = self._body_for(path)
+        if not self.etags:
+            return 200, {'Content-Type': 'application/json'}, body
+        
+        etag = '"%s"' % hashlib.blake2b(body, digest_size=8).hexdigest()
+        if headers.get('if-none-match') == etag:
+            self.not_modified += 1
+            return 304, {'ETag': etag}, b''
+        return 200, {'Content-Type': 'application/json', 'ETag': etag}, body
+    
+    def _body_for(self, path: str) -> bytes:
+        # /r/<subreddit>/<sort>.json?..., /r/<a+b+c>/hot.json?... or /r/<subreddit>/hot/.rss?...
+        route, _, query = path.partition('?')
+        parts = route.strip('/').split('/')
+        subreddit = parts[1] if len(parts) > 1 and parts[0] == 'r' else 'memes'
+        params = parse_qs(query)
+        
+        if route.endswith('.rss'):
+            key = (subreddit, 'feed')
+            if key not in self._listings:
+                self._listings[key] = make_feed(subreddit).encode()
+            return self._listings[key]
+        
+        if '+' in subreddit:
+            return self._combined_page(subreddit.split('+'), params)
+        
+        key = (subreddit, 'json', self.offset)
+        if key not in self._listings:
+            self._listings[key] = json.dumps(make_listing(subreddit, offset=self.offset)).encode()
+        return self._listings[key]
+    
+    def _combined_page(self, subreddits: list, params: dict) -> bytes:
+        """One page of a combined listing, interleaving the subreddits' posts."""
+        listings = [make_listing(subreddit, 100, self.offset)['data']['children'] for subreddit in subreddits]
+        merged = [post for group in zip(*listings) for post in group]
+        limit = int(params.get('limit', ['25'])[0])
+        start = int(params.get('after', ['0'])[0] or 0)
+        page = merged[start:start + limit]
+        after = str(start + limit) if start + limit < len(merged) else None
+        return json.dumps({'kind': 'Listing', 'data': {'after': after, 'children': page}}).encode()
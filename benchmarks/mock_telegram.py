@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Minimal fake of the Telegram Bot API for offline benchmarks.
+
+Implements just enough of the API for python-telegram-bot to start in
+polling or webhook mode and for the bot's handlers to reply: getMe,
+setWebhook/deleteWebhook, getUpdates (fed from a local queue), the
+send* methods and sendChatAction. Every send is recorded with a timestamp;
+media uploaded as multipart bytes rather than passed by URL is counted.
+"""
+
+import asyncio
+import json
+import re
+import time
+from typing import Callable, Dict, List, Optional
+from urllib.parse import parse_qs
+
+from mock_http import MockHttpServer, Response
+
+SEND_METHODS = frozenset({'sendMessage', 'sendPhoto', 'sendAnimation', 'sendVideo', 'sendDocument'})
+_MEDIA_FIELDS = {'sendPhoto': 'photo', 'sendAnimation': 'animation',
+                 'sendVideo': 'video', 'sendDocument': 'document'}
+_DISPOSITION = re.compile(r'Content-Disposition: form-data; name="([^"]*)"(?:; filename="([^"]*)")?', re.I)
+
+
+def make_command_update(update_id: int, chat_id: int, text: str = '/meme') -> dict:
+    """A private-chat message update carrying a bot command."""
+    command = text.split()[0]
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private', 'first_name': 'Bench'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Bench'},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}],
+        },
+    }
+
+
+class MockTelegramServer(MockHttpServer):
+    """
+    Fake Bot API server.
+    
+    Args:
+        latency: Delay in seconds before answering send* calls
+        deliverable: Predicate for media sent by URL; URLs it rejects get the
+            400 Telegram answers when it can't fetch a URL
+        setup_latency: Delay in seconds before answering the calls a bot
+            makes while starting up (getMe, setWebhook, deleteWebhook)
+    """
+    
+    def __init__(self, latency: float = 0.0, deliverable: Optional[Callable[[str], bool]] = None,
+                 setup_latency: float = 0.0, host: str = '127.0.0.1', port: int = 0):
+        super().__init__(host, port)
+        self.latency = latency
+        self.setup_latency = setup_latency
+        self.deliverable = deliverable
+        self.failed_sends = 0
+        self.uploads = 0
+        self.calls: Dict[str, int] = {}
+        self.sent: List[tuple] = []  # (method, chat_id, monotonic time)
+        self.webhook_url: Optional[str] = None
+        self._updates: List[dict] = []
+        self._updates_available: Optional[asyncio.Event] = None
+        self._file_counter = 0
+    
+    async def on_start(self) -> None:
+        self._updates_available = asyncio.Event()
+    
+    def push_updates(self, updates: List[dict]) -> None:
+        """Queue updates for getUpdates (thread-safe)."""
+        self.call_soon(self._push, updates)
+    
+    def _push(self, updates: List[dict]) -> None:
+        self._updates.extend(updates)
+        self._updates_available.set()
+    
+    @staticmethod
+    def _params(headers: Dict[str, str], body: bytes) -> dict:
+        content_type = headers.get('content-type', '')
+        if content_type.startswith('application/json'):
+            return json.loads(body or b'{}')
+        if content_type.startswith('application/x-www-form-urlencoded'):
+            return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+        if content_type.startswith('multipart/form-data'):
+            # Uploaded files stand in as a marker; only the other fields matter
+            boundary = content_type.split('boundary=', 1)[1].strip('"').encode('latin-1')
+            params = {}
+            for part in body.split(b'--' + boundary)[1:-1]:
+                head, _, value = part.strip(b'\r\n').partition(b'\r\n\r\n')
+                disposition = _DISPOSITION.search(head.decode('latin-1'))
+                if disposition is None:
+                    continue
+                name, filename = disposition.groups()
+                params[name] = 'upload' if filename is not None else value.decode()
+            return params
+        return {}
+    
+    async def handle_request(self, method: str, path: str, headers: Dict[str, str],
+                             body: bytes) -> Response:
+        # /bot<token>/<method>
+        api_method = path.split('?', 1)[0].rstrip('/').rsplit('/', 1)[-1]
+        params = self._params(headers, body)
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        
+        if api_method in ('getMe', 'setWebhook', 'deleteWebhook') and self.setup_latency:
+            await asyncio.sleep(self.setup_latency)
+        
+        if api_method == 'getUpdates':
+            result = await self._get_updates(params)
+        elif api_method in SEND_METHODS:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            media = params.get(_MEDIA_FIELDS.get(api_method, ''), '')
+            if media == 'upload':
+                self.uploads += 1
+            if self.deliverable and media.startswith('http') and not self.deliverable(media):
+                self.failed_sends += 1
+                payload = json.dumps({'ok': False, 'error_code': 400,
+                                      'description': 'Bad Request: failed to get HTTP URL content'}).encode()
+                return 400, {'Content-Type': 'application/json'}, payload
+            result = self._message(api_method, params)
+            self.sent.append((api_method, result['chat']['id'], time.monotonic()))
+        elif api_method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot',
+                      'can_join_groups': True, 'can_read_all_group_messages': False,
+                      'supports_inline_queries': True}
+        elif api_method == 'setWebhook':
+            self.webhook_url = params.get('url')
+            result = True
+        elif api_method == 'deleteWebhook':
+            self.webhook_url = None
+            result = True
+        else:
+            # sendChatAction, answerInlineQuery, ...
+            result = True
+        
+        payload = json.dumps({'ok': True, 'result': result}).encode()
+        return 200, {'Content-Type': 'application/json'}, payload
+    
+    async def _get_updates(self, params: dict) -> list:
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+        
+        # Telegram forgets updates below the confirmed offset
+        self._updates = [u for u in self._updates if u['update_id'] >= offset]
+        if not self._updates and timeout:
+            self._updates_available.clear()
+            try:
+                await asyncio.wait_for(self._updates_available.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:limit]
+    
+    def _message(self, api_method: str, params: dict) -> dict:
+        chat_id = int(params.get('chat_id') or 0)
+        message = {
+            'message_id': len(self.sent) + 1,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private', 'first_name': 'Bench'},
+        }
+        field = _MEDIA_FIELDS.get(api_method)
+        if field is None:
+            message['text'] = params.get('text', '')
+            return message
+        
+        self._file_counter += 1
+        media = {'file_id': f'file{self._file_counter}', 'file_unique_id': f'u{self._file_counter}',
+                 'width': 640, 'height': 480, 'duration': 1}
+        message[field] = [media] if field == 'photo' else media
+        return message
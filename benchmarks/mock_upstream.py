@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for Reddit and Giphy that replays recorded fixtures.
+
+Serves the gzip-compressed payloads in benchmarks/fixtures/ (see
+record_fixtures.py) at the paths the bot requests:
+
+    /r/<subreddit>/{hot,top,new,rising}.json   recorded hot listing
+    /r/<a+b+c>/hot.json?after=...              merged listings, paged by fullname
+    /r/<subreddit>/hot/.rss                    recorded Atom feed
+    /v1/gifs/trending                          recorded Giphy trending
+    /media/<host>/<path>                       the media those payloads link to
+
+Subreddits without a fixture get a copy of a recorded one, relabelled, so
+any subreddit list can be benchmarked. Latency, 5xx errors, 429s and a
+full Reddit outage are configurable and may be changed while it runs.
+
+Media links in the payloads (i.redd.it, v.redd.it, i.imgur.com, giphy) are
+rewritten to this server's /media/ path. A fixed, hash-chosen fraction of
+them is undeliverable, the way real listings are: HTML pages instead of
+media, deleted files and files over Telegram's size limit. ``deliverable``
+tells which, for a fake Telegram to reject them like the real one would.
+Hosts in ``blocked_hosts`` serve the bot normally but are undeliverable
+by URL, like a CDN that blocks Telegram's fetcher.
+
+Image links serve real, generated pictures. A ``dup_rate`` fraction of
+them are reposts: the same picture as other links, re-encoded at another
+size and quality, the way cross-posts show up under different URLs.
+``content_key`` names the picture behind a link.
+"""
+
+import asyncio
+import copy
+import gzip
+import hashlib
+import io
+import json
+import os
+import random
+import re
+from typing import Dict, Iterable, List, Optional
+from urllib.parse import parse_qs
+
+from PIL import Image, ImageDraw
+
+from mock_http import MockHttpServer, Response
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+_MEDIA_LINK = re.compile(rb'https://((?:i|v|preview)\.redd\.it|i\.imgur\.com|media\d?\.giphy\.com)/')
+_CONTENT_TYPES = {'.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png', '.webp': 'image/webp',
+                  '.gif': 'image/gif', '.mp4': 'video/mp4'}
+# Hosts that answer HEAD with 405, so clients must fall back to a range GET
+_NO_HEAD_HOSTS = frozenset({'i.imgur.com'})
+_MEDIA_SIZE = 400 * 1024
+_OVERSIZE = 30 * 1024 * 1024
+_IMAGE_FORMATS = {'.jpg': 'JPEG', '.jpeg': 'JPEG', '.png': 'PNG', '.webp': 'WEBP', '.gif': 'GIF'}
+# Reposted links all show one of this many popular pictures
+_REPOSTED_PICTURES = 10
+
+
+def _roll(text: str) -> float:
+    """Stable pseudo-random number in [0, 1) for a string."""
+    return int(hashlib.blake2b(text.encode(), digest_size=4).hexdigest(), 16) / 2 ** 32
+
+
+def load_fixture(name: str) -> bytes:
+    with gzip.open(os.path.join(FIXTURES, name), 'rb') as f:
+        return f.read()
+
+
+class FixtureUpstreamServer(MockHttpServer):
+    """
+    Replays recorded Reddit and Giphy responses.
+    
+    Args:
+        latency: Base response delay in seconds
+        jitter: Extra uniformly random delay, up to this many seconds
+        error_rate: Fraction of requests answered with ``error_status``
+        error_status: HTTP status for injected errors
+        rate_limit_rate: Fraction of requests answered 429 with ``Retry-After``
+        retry_after: Seconds sent in ``Retry-After`` on injected 429s
+        reddit_outage: Answer every Reddit request with 503
+        etags: Send ETags and answer matching ``If-None-Match`` with 304
+        seed: Seed for the injected-fault random generator
+        media_latency: Response delay for /media/ requests in seconds
+        html_rate: Fraction of media links that are HTML pages
+        missing_rate: Fraction of media links that answer 404
+        oversize_rate: Fraction of media files over Telegram's 20 MB limit
+        blocked_hosts: Media hosts whose links Telegram can't fetch by URL
+        dup_rate: Fraction of image links that are reposts of a popular picture
+    """
+    
+    def __init__(self, latency: float = 0.05, jitter: float = 0.0, error_rate: float = 0.0,
+                 error_status: int = 503, rate_limit_rate: float = 0.0, retry_after: int = 5,
+                 reddit_outage: bool = False, etags: bool = False, seed: Optional[int] = 0,
+                 media_latency: float = 0.02, html_rate: float = 0.05, missing_rate: float = 0.02,
+                 oversize_rate: float = 0.02, blocked_hosts: Iterable[str] = (),
+                 dup_rate: float = 0.0, host: str = '127.0.0.1', port: int = 0):
+        super().__init__(host, port)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.reddit_outage = reddit_outage
+        self.etags = etags
+        self.media_latency = media_latency
+        self.html_rate = html_rate
+        self.missing_rate = missing_rate
+        self.oversize_rate = oversize_rate
+        self.blocked_hosts = frozenset(blocked_hosts)
+        self.dup_rate = dup_rate
+        self._images: Dict[str, bytes] = {}
+        self.statuses: Dict[int, int] = {}
+        self.reddit_requests = 0
+        self.giphy_requests = 0
+        self.media_requests = 0
+        self._random = random.Random(seed)
+        self._recorded: Dict[str, List[dict]] = {}
+        self._bodies: Dict[tuple, bytes] = {}
+        self._feeds: Dict[str, str] = {}
+        self._giphy: dict = {}
+    
+    async def on_start(self) -> None:
+        for name in sorted(os.listdir(FIXTURES)):
+            if name.startswith('reddit_') and name.endswith('_hot.json.gz'):
+                subreddit = name[len('reddit_'):-len('_hot.json.gz')]
+                self._recorded[subreddit] = json.loads(load_fixture(name))['data']['children']
+                self._feeds[subreddit] = load_fixture(f'reddit_{subreddit}_hot.rss.gz').decode()
+        self._giphy = json.loads(load_fixture('giphy_trending.json.gz'))
+    
+    def deliverable(self, url: str) -> bool:
+        """False for media links on this server that Telegram couldn't send."""
+        prefix = f'{self.base_url}/media/'
+        if not url.startswith(prefix):
+            return True
+        path = url[len(prefix):].split('?', 1)[0]
+        return path.split('/', 1)[0] not in self.blocked_hosts and self._media_problem(path) is None
+    
+    def content_key(self, url: str) -> str:
+        """Name of the picture a media link shows; reposts share one."""
+        prefix = f'{self.base_url}/media/'
+        path = url[len(prefix):].split('?', 1)[0] if url.startswith(prefix) else url
+        if os.path.splitext(path)[1].lower() not in _IMAGE_FORMATS:
+            return path
+        roll = _roll('repost:' + path)
+        if roll < self.dup_rate:
+            return f'popular{int(roll / self.dup_rate * _REPOSTED_PICTURES)}'
+        return path
+    
+    def _image(self, path: str) -> bytes:
+        """A generated picture for a media path, encoded per its extension."""
+        body = self._images.get(path)
+        if body is None:
+            # Same shapes for every link to one picture; size and quality vary per link
+            shapes = random.Random(self.content_key(path))
+            image = Image.new('RGB', (320, 320), tuple(shapes.randrange(256) for _ in range(3)))
+            draw = ImageDraw.Draw(image)
+            for _ in range(12):
+                x, y = shapes.randrange(280), shapes.randrange(280)
+                size = shapes.randrange(20, 120)
+                draw.rectangle([x, y, x + size, y + size], fill=tuple(shapes.randrange(256) for _ in range(3)))
+            
+            variant = _roll('variant:' + path)
+            width = 240 + int(variant * 400)
+            image = image.resize((width, width))
+            extension = os.path.splitext(path)[1].lower()
+            buffer = io.BytesIO()
+            if extension in ('.jpg', '.jpeg', '.webp'):
+                image.save(buffer, _IMAGE_FORMATS[extension], quality=50 + int(variant * 45))
+            else:
+                image.save(buffer, _IMAGE_FORMATS[extension])
+            body = self._images[path] = buffer.getvalue()
+        return body
+    
+    def _media_problem(self, path: str) -> Optional[str]:
+        """'html', 'missing', 'oversize' or None, fixed per media path."""
+        if os.path.splitext(path)[1].lower() not in _CONTENT_TYPES:
+            return 'html'  # e.g. a v.redd.it player page
+        if path.split('/', 1)[0].endswith('giphy.com'):
+            return None  # Giphy's API only links files it serves
+        roll = _roll(path)
+        for problem, rate in (('html', self.html_rate), ('missing', self.missing_rate),
+                              ('oversize', self.oversize_rate)):
+            if roll < rate:
+                return problem
+            roll -= rate
+        return None
+    
+    def _serve_media(self, method: str, path: str, headers: Dict[str, str]) -> Response:
+        problem = self._media_problem(path)
+        if problem == 'missing':
+            return 404, {'Content-Type': 'text/html'}, b'<h1>404 Not Found</h1>'
+        if problem == 'html':
+            return 200, {'Content-Type': 'text/html; charset=utf-8'}, b'<html><body>album</body></html>'
+        
+        if method == 'HEAD' and path.split('/', 1)[0] in _NO_HEAD_HOSTS:
+            return 405, {'Content-Type': 'text/plain'}, b''
+        
+        extension = os.path.splitext(path)[1].lower()
+        content_type = _CONTENT_TYPES[extension]
+        if problem == 'oversize':
+            body = None
+            size = _OVERSIZE
+        elif extension in _IMAGE_FORMATS:
+            body = self._image(path)
+            size = len(body)
+        else:
+            body = None
+            size = _MEDIA_SIZE
+        
+        if method == 'HEAD':
+            return 200, {'Content-Type': content_type, 'Content-Length': str(size)}, b''
+        if 'range' in headers:
+            return 206, {'Content-Type': content_type, 'Content-Range': f'bytes 0-0/{size}'}, b'\0'
+        return 200, {'Content-Type': content_type}, body if body is not None else b'\0' * size
+    
+    async def handle_request(self, method: str, path: str, headers: Dict[str, str],
+                             body: bytes) -> Response:
+        route, _, query = path.partition('?')
+        if route.startswith('/media/'):
+            self.media_requests += 1
+            if self.media_latency:
+                await asyncio.sleep(self.media_latency)
+            return self._serve_media(method, route[len('/media/'):], headers)
+        
+        delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay:
+            await asyncio.sleep(delay)
+        
+        is_reddit = route.startswith('/r/')
+        if is_reddit:
+            self.reddit_requests += 1
+        elif route.startswith('/v1/gifs/'):
+            self.giphy_requests += 1
+        
+        status, response_headers, response_body = self._fault(is_reddit) or self._serve(route, parse_qs(query), headers)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        return status, response_headers, response_body
+    
+    def _fault(self, is_reddit: bool) -> Optional[Response]:
+        """An injected error response, or None to serve normally."""
+        if is_reddit and self.reddit_outage:
+            return 503, {'Content-Type': 'text/html'}, b'<h1>all servers are busy</h1>'
+        roll = self._random.random()
+        if roll < self.rate_limit_rate:
+            return 429, {'Content-Type': 'application/json', 'Retry-After': str(self.retry_after)}, \
+                b'{"message": "Too Many Requests", "error": 429}'
+        if roll < self.rate_limit_rate + self.error_rate:
+            return self.error_status, {'Content-Type': 'application/json'}, b'{}'
+        return None
+    
+    def _serve(self, route: str, params: dict, headers: Dict[str, str]) -> Response:
+        parts = route.strip('/').split('/')
+        if parts[0] == 'r' and len(parts) >= 3:
+            subreddit = parts[1]
+            if route.endswith('.rss'):
+                key = (subreddit, 'rss')
+                content_type = 'application/atom+xml; charset=UTF-8'
+            elif '+' in subreddit:
+                key = (subreddit, 'combined', params.get('after', [''])[0], int(params.get('limit', ['25'])[0]))
+                content_type = 'application/json; charset=UTF-8'
+            else:
+                key = (subreddit, 'json', int(params.get('limit', ['25'])[0]))
+                content_type = 'application/json; charset=UTF-8'
+        elif route == '/v1/gifs/trending':
+            key = ('giphy', int(params.get('limit', ['25'])[0]))
+            content_type = 'application/json'
+        else:
+            return 404, {'Content-Type': 'application/json'}, b'{"message": "Not Found", "error": 404}'
+        
+        body = self._bodies.get(key)
+        if body is None:
+            body = self._bodies[key] = _MEDIA_LINK.sub(f'{self.base_url}/media/'.encode() + rb'\1/',
+                                                       self._render(key))
+        
+        response_headers = {'Content-Type': content_type}
+        if self.etags:
+            etag = '"%s"' % hashlib.blake2b(body, digest_size=8).hexdigest()
+            if headers.get('if-none-match') == etag:
+                return 304, {'ETag': etag}, b''
+            response_headers['ETag'] = etag
+        return 200, response_headers, body
+    
+    def _render(self, key: tuple) -> bytes:
+        if key[0] == 'giphy':
+            payload = dict(self._giphy, data=self._giphy['data'][:key[1]])
+            return json.dumps(payload).encode()
+        
+        subreddit, kind = key[:2]
+        if kind == 'rss':
+            if subreddit in self._feeds:
+                return self._feeds[subreddit].encode()
+            recorded = sorted(self._feeds)[0]
+            return self._feeds[recorded].replace(f'r/{recorded}', f'r/{subreddit}').replace(
+                f'term="{recorded}"', f'term="{subreddit}"').encode()
+        if kind == 'json':
+            return self._listing_body(self._posts(subreddit)[:key[2]])
+        
+        # Reddit merges the subreddits by rank; newest-first is close enough
+        after, limit = key[2], key[3]
+        merged = sorted((post for name in subreddit.split('+') for post in self._posts(name)),
+                        key=lambda post: post['data']['created_utc'], reverse=True)
+        start = 0
+        if after:
+            names = [post['data']['name'] for post in merged]
+            start = names.index(after) + 1 if after in names else len(merged)
+        return self._listing_body(merged[start:start + limit], more=start + limit < len(merged))
+    
+    def _posts(self, subreddit: str) -> List[dict]:
+        """Recorded posts for a subreddit, relabelling another fixture if it has none."""
+        posts = self._recorded.get(subreddit)
+        if posts is None:
+            recorded = sorted(self._recorded)
+            prefix = hashlib.blake2b(subreddit.encode(), digest_size=2).hexdigest()
+            source = self._recorded[recorded[int(prefix, 16) % len(recorded)]]
+            posts = copy.deepcopy(source)
+            for post in posts:
+                data = post['data']
+                data['subreddit'] = subreddit
+                data['subreddit_name_prefixed'] = f'r/{subreddit}'
+                data['id'] = prefix + data['id']
+                data['name'] = f"t3_{data['id']}"
+                data['permalink'] = f"/r/{subreddit}/comments/{data['id']}/"
+            self._recorded[subreddit] = posts
+        return posts
+    
+    @staticmethod
+    def _listing_body(children: List[dict], more: bool = True) -> bytes:
+        after = children[-1]['data']['name'] if children and more else None
+        return json.dumps({'kind': 'Listing', 'data': {
+            'after': after, 'dist': len(children), 'modhash': '', 'geo_filter': None,
+            'children': children, 'before': None,
+        }}).encode()
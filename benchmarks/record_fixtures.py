@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Record live Reddit and Giphy responses as fixtures for the offline suite.
+
+Saves, gzip-compressed under benchmarks/fixtures/:
+    reddit_<subreddit>_hot.json.gz   /r/<subreddit>/hot.json?limit=100
+    reddit_<subreddit>_hot.rss.gz    /r/<subreddit>/hot/.rss
+    giphy_trending.json.gz           /v1/gifs/trending
+
+Needs network access; the benchmarks themselves never do. Re-record when
+the upstream formats change, then rerun the suite to get a new baseline.
+
+Usage:
+    python benchmarks/record_fixtures.py [--subreddits memes dankmemes wholesomememes]
+"""
+
+import argparse
+import gzip
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+sys.path.insert(0, ROOT)
+
+import httpx
+
+from meme_core import GIPHY_PARAMS, SUBREDDITS, USER_AGENT
+
+
+def save(name: str, body: bytes) -> None:
+    path = os.path.join(FIXTURES, name)
+    with gzip.open(path, 'wb') as f:
+        f.write(body)
+    print(f"{name}: {len(body)} bytes")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Record upstream fixtures')
+    parser.add_argument('--subreddits', nargs='+', default=SUBREDDITS)
+    args = parser.parse_args()
+    
+    os.makedirs(FIXTURES, exist_ok=True)
+    with httpx.Client(headers={'User-Agent': USER_AGENT}, follow_redirects=True, timeout=30) as client:
+        for subreddit in args.subreddits:
+            response = client.get(f"https://www.reddit.com/r/{subreddit}/hot.json", params={'limit': 100})
+            response.raise_for_status()
+            save(f"reddit_{subreddit}_hot.json.gz", response.content)
+            
+            response = client.get(f"https://www.reddit.com/r/{subreddit}/hot/.rss")
+            response.raise_for_status()
+            save(f"reddit_{subreddit}_hot.rss.gz", response.content)
+        
+        response = client.get("https://api.giphy.com/v1/gifs/trending", params=GIPHY_PARAMS)
+        response.raise_for_status()
+        save("giphy_trending.json.gz", response.content)
+
+
+if __name__ == '__main__':
+    main()
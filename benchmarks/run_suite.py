@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark suite: the real bot against recorded upstream fixtures.
+
+Each scenario starts a fixture-replaying Reddit/Giphy stand-in
+(mock_upstream.py) and a fake Telegram Bot API (mock_telegram.py), runs
+the bot as a subprocess in polling mode with a fresh SQLite store, feeds
+it /meme commands from distinct chats and times each one from the moment
+the update is queued to the moment the reply reaches the fake Bot API.
+Like the real API, the fake refuses media URLs that don't lead to a
+sendable file; those show up as failed sends (and apology replies).
+
+Scenarios:
+    cold_start      commands arrive as soon as the bot polls, before any pool is warm
+    steady_state    a constant command rate against warm pools
+    reddit_outage   every Reddit request fails with 503 from startup; Giphy still works
+    concurrent_1k   1000 chats send /meme at the same instant against warm pools
+
+Results (throughput, latency percentiles, failed sends, where memes came
+from, upstream traffic) are written as JSON. Pass a previous results file as --baseline
+to print the change per scenario; --max-regression turns that into a
+pass/fail check.
+
+Usage:
+    python benchmarks/run_suite.py [--output bench_results.json] [--baseline old.json]
+    python benchmarks/run_suite.py --scenarios steady_state --error-rate 0.05 --rate-limit-rate 0.05
+    python benchmarks/run_suite.py --media-cache --blocked-hosts i.imgur.com
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import httpx
+
+from harness import ROOT, bot_env, free_port, launch_bot, percentile, stop_bot, wait_until
+from mock_telegram import MockTelegramServer, make_command_update
+from mock_upstream import FixtureUpstreamServer
+
+_SAMPLE = re.compile(r'^(\w+)(?:\{(.*)\})? (\S+)$')
+_LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def parse_metrics(text: str) -> Dict[str, Dict[tuple, float]]:
+    """Prometheus text exposition -> {metric: {((label, value), ...): sample}}."""
+    samples: Dict[str, Dict[tuple, float]] = {}
+    for line in text.splitlines():
+        match = _SAMPLE.match(line)
+        if match:
+            name, labels, value = match.groups()
+            samples.setdefault(name, {})[tuple(_LABEL.findall(labels or ''))] = float(value)
+    return samples
+
+
+class BotRun:
+    """One bot subprocess wired to fresh mock services."""
+    
+    def __init__(self, args, **upstream_options):
+        options = dict(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                       rate_limit_rate=args.rate_limit_rate, etags=args.etags,
+                       blocked_hosts=args.blocked_hosts, dup_rate=args.dup_rate)
+        options.update(upstream_options)
+        self.args = args
+        self.upstream = FixtureUpstreamServer(**options)
+        self.telegram = MockTelegramServer(latency=args.telegram_latency, deliverable=self.upstream.deliverable)
+        self.metrics_port = free_port()
+        self.queued: Dict[int, float] = {}  # chat_id -> monotonic time the update was queued
+        self.launched = 0.0
+        self._tmp = None
+        self._bot = None
+        self._next_update = 1
+    
+    async def __aenter__(self):
+        self.upstream.start()
+        self.telegram.start()
+        self._tmp = tempfile.TemporaryDirectory()
+        env = bot_env(self.telegram.base_url, self.upstream.base_url,
+                      os.path.join(self._tmp.name, 'memes.sqlite3'),
+                      METRICS_PORT=str(self.metrics_port),
+                      CONCURRENT_UPDATES=str(self.args.concurrent_updates),
+                      VALIDATE_MEDIA='0' if self.args.no_validate else '1',
+                      DEDUP_MEDIA='0' if self.args.no_dedup else '1',
+                      MEDIA_CACHE_DIR=os.path.join(self._tmp.name, 'media') if self.args.media_cache else '')
+        self.launched = time.monotonic()
+        self._bot = launch_bot(env)
+        return self
+    
+    async def __aexit__(self, *exc) -> None:
+        stop_bot(self._bot)
+        self.telegram.stop()
+        self.upstream.stop()
+        self._tmp.cleanup()
+    
+    async def polling(self) -> float:
+        """Wait for the bot's first getUpdates; return seconds since launch."""
+        await wait_until(lambda: self.telegram.calls.get('getUpdates', 0) > 0, self.args.timeout)
+        return time.monotonic() - self.launched
+    
+    async def metrics(self) -> Dict[str, Dict[tuple, float]]:
+        async with httpx.AsyncClient() as client:
+            response = await client.get(f'http://127.0.0.1:{self.metrics_port}/metrics')
+        return parse_metrics(response.text)
+    
+    async def warm(self) -> None:
+        """Wait until every subreddit pool has memes and media validation and hashing have gone quiet."""
+        deadline = time.monotonic() + self.args.timeout
+        checked = None
+        while True:
+            try:
+                samples = await self.metrics()
+                pools = samples.get('meme_pool_size', {})
+                validations = sum(samples.get('meme_media_validations_total', {}).values()) + \
+                    sum(samples.get('meme_dedup_total', {}).values())
+                if pools and all(size > 0 for size in pools.values()) and validations == checked:
+                    return
+                checked = validations
+            except httpx.HTTPError:
+                pass  # metrics server not up yet
+            if time.monotonic() > deadline:
+                raise TimeoutError('pools did not warm up')
+            await asyncio.sleep(0.25)
+    
+    def send(self, count: int) -> List[int]:
+        """Queue /meme from ``count`` new chats; return their chat ids."""
+        updates = []
+        now = time.monotonic()
+        for _ in range(count):
+            chat_id = 100_000 + self._next_update
+            updates.append(make_command_update(self._next_update, chat_id))
+            self.queued[chat_id] = now
+            self._next_update += 1
+        self.telegram.push_updates(updates)
+        return [update['message']['chat']['id'] for update in updates]
+    
+    async def replies(self) -> Dict[int, float]:
+        """Wait for a reply to every queued chat; return chat_id -> reply latency in seconds."""
+        await wait_until(lambda: len(self._replied()) >= len(self.queued), self.args.timeout,
+                         'not every chat got a reply')
+        replied = self._replied()
+        return {chat_id: replied[chat_id] - queued for chat_id, queued in self.queued.items()}
+    
+    def _replied(self) -> Dict[int, float]:
+        first = {}
+        for _method, chat_id, at in list(self.telegram.sent):
+            first.setdefault(chat_id, at)
+        return first
+    
+    async def report(self, latencies: Dict[int, float], **extra) -> dict:
+        samples = list(latencies.values())
+        finished = max(queued + latencies[chat_id] for chat_id, queued in self.queued.items())
+        elapsed = finished - min(self.queued.values())
+        served = (await self.metrics()).get('meme_served_total', {})
+        result = {
+            'chats': len(samples),
+            'seconds': round(elapsed, 3),
+            'throughput_per_sec': round(len(samples) / elapsed, 1) if elapsed else None,
+            'latency_ms': {
+                'p50': round(percentile(samples, 50) * 1000, 2),
+                'p90': round(percentile(samples, 90) * 1000, 2),
+                'p99': round(percentile(samples, 99) * 1000, 2),
+                'max': round(max(samples) * 1000, 2),
+                'mean': round(sum(samples) / len(samples) * 1000, 2),
+            },
+            'served_by': {dict(labels)['origin']: int(count) for labels, count in sorted(served.items())},
+            'failed_sends': self.telegram.failed_sends,
+            'uploads': self.telegram.uploads,
+            'upstream': {
+                'reddit_requests': self.upstream.reddit_requests,
+                'giphy_requests': self.upstream.giphy_requests,
+                'media_requests': self.upstream.media_requests,
+                'statuses': {str(status): count for status, count in sorted(self.upstream.statuses.items())},
+            },
+        }
+        result.update(extra)
+        return result
+
+
+async def cold_start(args) -> dict:
+    async with BotRun(args) as run:
+        startup = await run.polling()
+        run.send(args.chats)
+        latencies = await run.replies()
+        return await run.report(latencies, startup_seconds=round(startup, 3),
+                                first_reply_ms=round(min(latencies.values()) * 1000, 2))
+
+
+async def steady_state(args) -> dict:
+    async with BotRun(args) as run:
+        await run.polling()
+        await run.warm()
+        interval = 0.1
+        per_tick = max(1, round(args.rate * interval))
+        started = time.monotonic()
+        ticks = int(args.duration / interval)
+        for tick in range(ticks):
+            run.send(per_tick)
+            await asyncio.sleep(max(0.0, started + (tick + 1) * interval - time.monotonic()))
+        return await run.report(await run.replies(), offered_per_sec=round(per_tick / interval, 1))
+
+
+async def reddit_outage(args) -> dict:
+    async with BotRun(args, reddit_outage=True) as run:
+        await run.polling()
+        run.send(args.chats)
+        return await run.report(await run.replies())
+
+
+async def concurrent_1k(args) -> dict:
+    async with BotRun(args) as run:
+        await run.polling()
+        await run.warm()
+        run.send(args.burst)
+        return await run.report(await run.replies())
+
+
+SCENARIOS = {
+    'cold_start': cold_start,
+    'steady_state': steady_state,
+    'reddit_outage': reddit_outage,
+    'concurrent_1k': concurrent_1k,
+}
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def compare(baseline: dict, results: dict, max_regression: float) -> bool:
+    """Print per-scenario changes against a baseline; return False if any exceeds ``max_regression`` %."""
+    ok = True
+    print(f"{'scenario':<16}{'metric':<20}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, current in results['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if not previous:
+            continue
+        rows = [('throughput_per_sec', previous.get('throughput_per_sec'), current.get('throughput_per_sec'), True)]
+        rows += [(f'latency_ms.{pct}', previous['latency_ms'][pct], current['latency_ms'][pct], False)
+                 for pct in ('p50', 'p99')]
+        for metric, old, new, higher_is_better in rows:
+            if not old or new is None:
+                continue
+            change = (new - old) / old * 100
+            worse = -change if higher_is_better else change
+            flag = ''
+            if max_regression is not None and worse > max_regression:
+                flag = '  REGRESSION'
+                ok = False
+            print(f"{name:<16}{metric:<20}{old:>12}{new:>12}{change:>+9.1f}%{flag}")
+    return ok
+
+
+async def main_async(args) -> dict:
+    results = {
+        'meta': {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'config': {key: value for key, value in vars(args).items()
+                       if key not in ('output', 'baseline', 'max_regression')},
+        },
+        'scenarios': {},
+    }
+    for name in args.scenarios:
+        result = await SCENARIOS[name](args)
+        results['scenarios'][name] = result
+        latency = result['latency_ms']
+        print(f"{name:<16}{result['throughput_per_sec']:>10} /s   p50 {latency['p50']:>8} ms   "
+              f"p99 {latency['p99']:>8} ms   failed sends {result['failed_sends']:>4}   "
+              f"uploads {result['uploads']:>4}   "
+              f"served_by {result['served_by']}")
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Offline benchmark suite against recorded fixtures')
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--output', default='bench_results.json', help='JSON results file')
+    parser.add_argument('--baseline', help='previous results file to compare against')
+    parser.add_argument('--max-regression', type=float,
+                        help='exit non-zero if throughput or p50/p99 latency is this many percent worse than --baseline')
+    parser.add_argument('--chats', type=int, default=200, help='chats in cold_start and reddit_outage')
+    parser.add_argument('--burst', type=int, default=1000, help='chats in concurrent_1k')
+    parser.add_argument('--rate', type=float, default=50, help='steady_state commands per second')
+    parser.add_argument('--duration', type=float, default=10, help='steady_state seconds')
+    parser.add_argument('--latency', type=float, default=0.05, help='upstream response delay, seconds')
+    parser.add_argument('--jitter', type=float, default=0.05, help='extra random upstream delay, up to seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of upstream requests answered 503')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='fraction of upstream requests answered 429')
+    parser.add_argument('--etags', action='store_true', help='upstream sends ETags and answers 304')
+    parser.add_argument('--no-validate', action='store_true', help='run the bot with VALIDATE_MEDIA=0')
+    parser.add_argument('--no-dedup', action='store_true', help='run the bot with DEDUP_MEDIA=0')
+    parser.add_argument('--dup-rate', type=float, default=0.15,
+                        help='fraction of media links that are reposts of another image')
+    parser.add_argument('--media-cache', action='store_true',
+                        help='give the bot a MEDIA_CACHE_DIR so it can upload media by bytes')
+    parser.add_argument('--blocked-hosts', nargs='*', default=[],
+                        help='media hosts the fake Telegram cannot fetch by URL, e.g. i.imgur.com')
+    parser.add_argument('--telegram-latency', type=float, default=0.0, help='fake Bot API delay for send* calls')
+    parser.add_argument('--concurrent-updates', type=int, default=64, help='CONCURRENT_UPDATES for the bot')
+    parser.add_argument('--timeout', type=float, default=120.0)
+    args = parser.parse_args()
+    
+    results = asyncio.run(main_async(args))
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {args.output}")
+    
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if not compare(baseline, results, args.max_regression):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,10 +7,10 @@ This script demonstrates the bot's functionality without requiring a real Telegr
 import sys
 import os
 
-# Add the current directory to Python path to import the bot module
+# Add the current directory to Python path to import the fetcher module
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from telegram_meme_bot import MemeFetcher
+from meme_core import MemeFetcher
 
 def demo_meme_fetching():
     """Demonstrate the meme fetching functionality."""
@@ -32,15 +32,9 @@ def demo_meme_fetching():
             meme = fetcher.get_random_meme()
             
             if meme:
-                print(f"   📝 Title: {meme['title']}")
-                print(f"   🔗 URL: {meme['url']}")
-                
-                if meme.get('source') == 'Giphy':
-                    print(f"   📍 Source: {meme['source']}")
-                elif meme.get('source') == 'Fallback':
-                    print(f"   📍 Source: Classic Memes")
-                else:
-                    print(f"   📍 Source: r/{meme['subreddit']}")
+                print(f"   📝 Title: {meme.title}")
+                print(f"   🔗 URL: {meme.url}")
+                print(f"   📍 Source: {meme.source_label}")
                 
                 print()
             else:
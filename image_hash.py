@@ -0,0 +1,144 @@
+"""
+Perceptual hashing and near-duplicate lookup for meme images.
+
+``dhash`` reduces an image to a 64-bit difference hash that survives
+resizing and recompression, so the same meme re-uploaded to another host
+hashes within a few bits of the original. ``MultiIndexHashTable`` finds
+stored hashes within a Hamming distance of a query without scanning them
+all, and stays fast at millions of entries.
+"""
+
+import io
+from array import array
+from itertools import combinations
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image
+
+HASH_BITS = 64
+
+
+def dhash(data: bytes) -> Optional[int]:
+    """
+    Difference hash of an image: one bit per horizontally adjacent pixel
+    pair of a 9x8 grayscale thumbnail, set where brightness increases.
+    
+    JPEGs are decoded at reduced scale, so hashing a large photo costs
+    little more than hashing a thumbnail. Animated images use their first
+    frame.
+    
+    Args:
+        data: Encoded image bytes
+    
+    Returns:
+        The 64-bit hash, or None if the data isn't a decodable image
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.draft('L', (64, 64))
+            pixels = list(image.convert('L').resize((9, 8), Image.BILINEAR).getdata())
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    
+    value = 0
+    for row in range(8):
+        for column in range(8):
+            left = pixels[row * 9 + column]
+            value = value << 1 | (left < pixels[row * 9 + column + 1])
+    return value
+
+
+def hamming(a: int, b: int) -> int:
+    """Number of differing bits between two hashes."""
+    return bin(a ^ b).count('1')
+
+
+class MultiIndexHashTable:
+    """
+    Near-duplicate index for 64-bit hashes using multi-index hashing.
+    
+    Each hash is split into ``chunks`` equal substrings, and each substring
+    position has its own table of exact buckets. If two hashes are within
+    Hamming distance ``max_distance``, then by pigeonhole at least one pair
+    of substrings is within ``max_distance // chunks`` bits. A query
+    therefore probes, per table, only the buckets that close to its own
+    substring, and compares the few candidates in them.
+    
+    Entries carry an integer key (e.g. a digest of the meme URL) and live in
+    fixed slots; past ``capacity`` the oldest entry is evicted. Slots, keys
+    and buckets are ``array`` columns, so a million entries take tens of
+    megabytes rather than hundreds.
+    """
+    
+    def __init__(self, max_distance: int = 6, chunks: int = 4, capacity: int = 1_000_000):
+        if HASH_BITS % chunks:
+            raise ValueError(f"chunks must divide {HASH_BITS}")
+        self.max_distance = max_distance
+        self.chunks = chunks
+        self.capacity = capacity
+        self._width = HASH_BITS // chunks
+        self._chunk_mask = (1 << self._width) - 1
+        self._values = array('Q')
+        self._keys = array('Q')
+        self._next = 0
+        self._tables: List[Dict[int, array]] = [{} for _ in range(chunks)]
+        # Every substring offset within max_distance // chunks bits
+        radius = max_distance // chunks
+        self._probes = [sum(1 << bit for bit in bits)
+                        for flips in range(radius + 1)
+                        for bits in combinations(range(self._width), flips)]
+    
+    def __len__(self) -> int:
+        return len(self._values)
+    
+    def _substrings(self, value: int) -> List[int]:
+        return [(value >> (self._width * index)) & self._chunk_mask for index in range(self.chunks)]
+    
+    def add(self, value: int, key: int) -> None:
+        """Store a hash with its key, evicting the oldest entry when full."""
+        if len(self._values) < self.capacity:
+            slot = len(self._values)
+            self._values.append(value)
+            self._keys.append(key)
+        else:
+            slot = self._next
+            self._next = (slot + 1) % self.capacity
+            for table, substring in zip(self._tables, self._substrings(self._values[slot])):
+                bucket = table[substring]
+                bucket.remove(slot)
+                if not bucket:
+                    del table[substring]
+            self._values[slot] = value
+            self._keys[slot] = key
+        
+        for table, substring in zip(self._tables, self._substrings(value)):
+            bucket = table.get(substring)
+            if bucket is None:
+                table[substring] = array('I', (slot,))
+            else:
+                bucket.append(slot)
+    
+    def nearest(self, value: int) -> Optional[Tuple[int, int]]:
+        """
+        Find the closest stored hash within ``max_distance``.
+        
+        Returns:
+            ``(key, distance)`` of the closest entry, or None if there is none
+        """
+        best: Optional[Tuple[int, int]] = None
+        checked = set()
+        for table, substring in zip(self._tables, self._substrings(value)):
+            for probe in self._probes:
+                bucket = table.get(substring ^ probe)
+                if bucket is None:
+                    continue
+                for slot in bucket:
+                    if slot in checked:
+                        continue
+                    checked.add(slot)
+                    distance = hamming(value, self._values[slot])
+                    if distance <= self.max_distance and (best is None or distance < best[1]):
+                        best = (self._keys[slot], distance)
+                        if distance == 0:
+                            return best
+        return best
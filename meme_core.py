@@ -0,0 +1,603 @@
+"""
+Import-light core of the meme fetcher.
+
+Media URL classification, the ``Meme`` record, listing and feed parsing,
+and the synchronous ``MemeFetcher`` used by the demo and test scripts. It
+imports only the standard library; ``requests`` is imported and its
+session created on the first fetch, so scripts that only need the fetcher
+don't pay for the Telegram and async HTTP stacks the bot loads.
+"""
+
+import html
+import logging
+import os
+import random
+import re
+import sys
+from enum import Enum
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence
+from xml.etree import ElementTree
+
+logger = logging.getLogger(__name__)
+
+# Subreddits to fetch memes from
+SUBREDDITS = ['memes', 'dankmemes', 'wholesomememes']
+
+# Base URLs for upstream sources (overridable for local testing)
+REDDIT_BASE_URL = os.getenv('REDDIT_BASE_URL', 'https://www.reddit.com')
+GIPHY_BASE_URL = os.getenv('GIPHY_BASE_URL', 'https://api.giphy.com')
+
+# Per-request timeout in seconds
+REQUEST_TIMEOUT = 10
+
+# Read size when streaming feed bodies
+FEED_CHUNK_SIZE = 8192
+
+# Giphy trending query (no API key required for basic usage)
+GIPHY_PARAMS = {
+    'api_key': 'dc6zaTOxFJmzC',  # Public beta key
+    'limit': 50,
+    'rating': 'g'
+}
+
+# User agent to avoid being blocked by Reddit
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+
+# Fallback meme URLs (popular meme images)
+FALLBACK_MEMES = [
+    {
+        'title': 'Classic Doge Meme',
+        'url': 'https://i.imgur.com/8tBcQ4A.jpg',
+        'subreddit': 'classic'
+    },
+    {
+        'title': 'Grumpy Cat',
+        'url': 'https://i.imgur.com/8tBcQ4A.jpg',
+        'subreddit': 'classic'
+    },
+    {
+        'title': 'Success Kid',
+        'url': 'https://i.imgur.com/8tBcQ4A.jpg',
+        'subreddit': 'classic'
+    },
+    {
+        'title': 'One Does Not Simply',
+        'url': 'https://i.imgur.com/8tBcQ4A.jpg',
+        'subreddit': 'classic'
+    },
+    {
+        'title': 'Y U No',
+        'url': 'https://i.imgur.com/8tBcQ4A.jpg',
+        'subreddit': 'classic'
+    }
+]
+
+
+class MediaKind(Enum):
+    """Kind of media a URL points to."""
+    
+    IMAGE = 'image'
+    GIF = 'gif'
+    VIDEO = 'video'
+    
+    @property
+    def send_method(self) -> str:
+        """Telegram media type used to send this kind: photo, animation or video."""
+        return _SEND_METHODS[self]
+
+
+_SEND_METHODS = {
+    MediaKind.IMAGE: 'photo',
+    MediaKind.GIF: 'animation',
+    MediaKind.VIDEO: 'video',
+}
+
+# File extension (lowercase, with dot) -> media kind
+_EXTENSION_KINDS = {
+    '.jpg': MediaKind.IMAGE,
+    '.jpeg': MediaKind.IMAGE,
+    '.png': MediaKind.IMAGE,
+    '.webp': MediaKind.IMAGE,
+    '.gif': MediaKind.GIF,
+    '.mp4': MediaKind.VIDEO,
+    '.gifv': MediaKind.VIDEO,
+    '.webm': MediaKind.VIDEO,
+}
+
+# Media hosts whose URLs need no file extension
+_HOST_KINDS = {
+    'i.redd.it': MediaKind.IMAGE,
+    'preview.redd.it': MediaKind.IMAGE,
+    'external-preview.redd.it': MediaKind.IMAGE,
+    'v.redd.it': MediaKind.VIDEO,
+    'imgur.com': MediaKind.IMAGE,
+    'i.imgur.com': MediaKind.IMAGE,
+    'gfycat.com': MediaKind.VIDEO,
+}
+
+# Registered domains whose every subdomain serves media (media0-4.giphy.com, ...)
+_DOMAIN_KINDS = {
+    'giphy.com': MediaKind.GIF,
+    'tenor.com': MediaKind.GIF,
+}
+
+# File extensions recognised as media
+MEDIA_EXTENSIONS = frozenset(_EXTENSION_KINDS)
+
+_MEDIA_HOSTS = frozenset(_HOST_KINDS)
+_MEDIA_DOMAINS = frozenset(_DOMAIN_KINDS)
+_WEB_SCHEMES = frozenset({'http:', 'https:', ''})  # '' for protocol-relative '//host/path'
+
+
+def classify_media_url(url: str) -> Optional[MediaKind]:
+    """
+    Classify a URL as image, gif or video media.
+    
+    Only the host and the path's file extension are considered, so a
+    media domain or extension appearing in a query string doesn't count.
+    
+    Args:
+        url: URL to check
+        
+    Returns:
+        The media kind, or None if the URL isn't recognised as media
+    """
+    if not url:
+        return None
+    
+    # 'https://host/path?query' -> ['https:', '', 'host', 'path']
+    parts = url.split('?', 1)[0].split('#', 1)[0].split('/', 3)
+    if len(parts) < 3 or parts[1] or parts[0].lower() not in _WEB_SCHEMES:
+        return None
+    
+    if len(parts) == 4:
+        path = parts[3]
+        dot = path.rfind('.')
+        if dot > path.rfind('/'):
+            kind = _EXTENSION_KINDS.get(path[dot:].lower())
+            if kind is not None:
+                return kind
+    
+    host = parts[2].lower()
+    if '@' in host or ':' in host:
+        host = host.rpartition('@')[2].partition(':')[0]
+    if host in _MEDIA_HOSTS:
+        return _HOST_KINDS[host]
+    
+    domain = host[host.rfind('.', 0, host.rfind('.')) + 1:]
+    if domain in _MEDIA_DOMAINS:
+        return _DOMAIN_KINDS[domain]
+    
+    return None
+
+
+def delivery_url(url: str) -> str:
+    """Rewrite a media URL into one Telegram can download directly."""
+    # Imgur's .gifv is an HTML page wrapping an mp4 of the same name
+    if url.lower().endswith('.gifv'):
+        return url[:-len('.gifv')] + '.mp4'
+    return url
+
+
+class MemeSource(Enum):
+    """Where a meme came from; the value is shown in the caption."""
+    
+    REDDIT = 'Reddit'
+    GIPHY = 'Giphy'
+    FALLBACK = 'Classic Memes'
+
+
+class Meme(NamedTuple):
+    """A single meme post. Immutable and tuple-backed, so it needs no per-instance dict."""
+    
+    title: str
+    url: str
+    subreddit: str
+    permalink: str = ''
+    source: MemeSource = MemeSource.REDDIT
+    
+    @property
+    def source_label(self) -> str:
+        """Human-readable origin, e.g. 'r/memes' or 'Giphy'."""
+        if self.source is MemeSource.REDDIT:
+            return f"r/{self.subreddit}"
+        return self.source.value
+
+
+class FeedParser:
+    """
+    Incremental parser for Reddit RSS 2.0 and Atom feeds.
+    
+    Feed it the response body chunk by chunk as it streams in. Each
+    ``<item>``/``<entry>`` is turned into a meme post as soon as its closing
+    tag arrives and is then dropped from the tree, so memory stays bounded
+    by one entry regardless of feed size. Once ``limit`` media posts have
+    been found ``done`` becomes True and the rest of the body can be skipped.
+    """
+    
+    # Media candidates inside the entry's HTML description, in preference order:
+    # the post's "[link]" target first, then any embedded image
+    _HREF = re.compile(r'<a\s[^>]*href=["\']([^"\']+)["\'][^>]*>\s*\[link\]', re.IGNORECASE)
+    _IMG_SRC = re.compile(r'<img\s[^>]*src=["\']([^"\']+)["\']', re.IGNORECASE)
+    
+    def __init__(self, subreddit: str, limit: int):
+        self.subreddit = sys.intern(subreddit)
+        self.limit = limit
+        self.posts: List[Meme] = []
+        self.done = False
+        self._parser = ElementTree.XMLPullParser(events=('start', 'end'))
+        self._stack: list = []
+    
+    def feed(self, chunk: bytes) -> None:
+        """Parse another chunk of the feed body."""
+        if self.done:
+            return
+        
+        try:
+            self._parser.feed(chunk)
+            for event, elem in self._parser.read_events():
+                if event == 'start':
+                    self._stack.append(elem)
+                    continue
+                
+                self._stack.pop()
+                if self._local_name(elem.tag) in ('item', 'entry'):
+                    self._handle_entry(elem)
+                    # Detach the finished entry so the tree doesn't grow
+                    if self._stack:
+                        self._stack[-1].remove(elem)
+                    if len(self.posts) >= self.limit:
+                        self.done = True
+                        return
+        except ElementTree.ParseError as e:
+            logger.debug("Stopped parsing feed for r/%s: %s", self.subreddit, e)
+            self.done = True
+    
+    @staticmethod
+    def _local_name(tag: str) -> str:
+        return tag.rsplit('}', 1)[-1]
+    
+    def _handle_entry(self, entry) -> None:
+        title = 'No title'
+        link = ''
+        description = ''
+        
+        for child in entry:
+            name = self._local_name(child.tag)
+            if name == 'title':
+                title = (child.text or '').strip() or title
+            elif name == 'link':
+                # RSS: <link>url</link>; Atom: <link href="url"/>
+                link = child.get('href') or (child.text or '').strip()
+            elif name in ('description', 'content'):
+                # Already entity-decoded by the XML parser
+                description = child.text or ''
+        
+        candidates = self._HREF.findall(description) + self._IMG_SRC.findall(description)
+        for candidate in candidates:
+            url = html.unescape(candidate)
+            if classify_media_url(url) is not None:
+                self.posts.append(Meme(title, url, self.subreddit, link))
+                break  # Use first valid media per post
+
+
+class BaseMemeFetcher:
+    """Shared parsing and selection logic for the sync and async fetchers."""
+    
+    def _pick_meme(self, memes: Sequence[Meme], subreddit: str) -> Optional[Meme]:
+        """Randomly select a meme from a subreddit listing."""
+        if not memes:
+            logger.warning("No valid memes found in r/%s", subreddit)
+            return None
+        
+        meme = memes[random.randrange(len(memes))]
+        logger.info("Selected Reddit meme: %s... from r/%s", meme.title[:50], subreddit)
+        
+        return meme
+    
+    def _parse_listing(self, data: Dict[str, Any], subreddit: str,
+                       known: Optional[Dict[str, Optional[Meme]]] = None) -> list:
+        """
+        Extract media posts from a Reddit JSON listing.
+        
+        Args:
+            data: Decoded listing JSON
+            subreddit: Name of the subreddit the listing belongs to
+            known: Optional post ID map from the previous parse of the same
+                endpoint; see ``_post_converter``
+            
+        Returns:
+            List of meme posts with image/video URLs
+        """
+        convert = self._post_converter(known)
+        posts = []
+        
+        for post in data['data']['children']:
+            meme = convert(post['data'], subreddit)
+            if meme:
+                posts.append(meme)
+        
+        return posts
+    
+    def _parse_combined_listing(self, data: Dict[str, Any], subreddits: list,
+                                known: Optional[Dict[str, Optional[Meme]]] = None) -> Dict[str, list]:
+        """
+        Split a combined ``/r/a+b+c`` listing into per-subreddit buckets.
+        
+        Args:
+            data: Decoded listing JSON
+            subreddits: Subreddit names the listing was requested for
+            known: Optional post ID map from the previous parse of the same
+                endpoint; see ``_post_converter``
+            
+        Returns:
+            Mapping of each requested subreddit to its media posts
+        """
+        # Reddit reports the subreddit's canonical casing, which may differ from ours
+        names = {subreddit.lower(): subreddit for subreddit in subreddits}
+        buckets: Dict[str, list] = {subreddit: [] for subreddit in subreddits}
+        convert = self._post_converter(known)
+        
+        for post in data['data']['children']:
+            post_data = post['data']
+            subreddit = names.get(post_data.get('subreddit', '').lower())
+            if subreddit is None:
+                continue
+            
+            meme = convert(post_data, subreddit)
+            if meme:
+                buckets[subreddit].append(meme)
+        
+        return buckets
+    
+    def _post_converter(self, known: Optional[Dict[str, Optional[Meme]]]
+                        ) -> Callable[[Dict[str, Any], str], Optional[Meme]]:
+        """
+        Return a post-to-meme function that skips posts parsed last time.
+        
+        ``known`` maps post IDs from the previous parse of an endpoint to
+        their meme (None for posts without media). Posts found there are
+        reused without being re-validated, and ``known`` is refilled in place
+        with the posts of the listing being parsed.
+        """
+        if known is None:
+            return self._post_to_meme
+        
+        previous = dict(known)
+        known.clear()
+        
+        def convert(post_data: Dict[str, Any], subreddit: str) -> Optional[Meme]:
+            post_id = post_data.get('id')
+            if post_id in previous:
+                meme = previous[post_id]
+            else:
+                meme = self._post_to_meme(post_data, subreddit)
+            if post_id is not None:
+                known[post_id] = meme
+            return meme
+        
+        return convert
+    
+    def _post_to_meme(self, post_data: Dict[str, Any], subreddit: str) -> Optional[Meme]:
+        """Turn one listing post into a meme, or None if it has no media or is NSFW."""
+        if post_data.get('over_18'):
+            return None
+        
+        # Check if post has media content
+        url = post_data.get('url', '')
+        title = post_data.get('title', 'No title')
+        
+        # v.redd.it links are player pages; the listing carries a direct mp4
+        video = (post_data.get('secure_media') or post_data.get('media') or {}).get('reddit_video')
+        if video and video.get('fallback_url'):
+            url = video['fallback_url']
+        
+        # Filter for image/video content
+        if not self._is_valid_media_url(url):
+            return None
+        
+        return Meme(
+            title,
+            url,
+            sys.intern(subreddit),
+            f"https://reddit.com{post_data.get('permalink', '')}"
+        )
+    
+    def _parse_giphy(self, data: Dict[str, Any]) -> Optional[Meme]:
+        """Pick a random gif from a Giphy trending response."""
+        if 'data' in data and data['data']:
+            # Randomly select a gif
+            gif = random.choice(data['data'])
+            
+            meme = Meme(
+                gif.get('title', 'Random Meme'),
+                gif['images']['original']['url'],
+                'giphy',
+                gif.get('url', ''),
+                MemeSource.GIPHY
+            )
+            
+            logger.info("Selected Giphy meme: %s...", meme.title[:50])
+            return meme
+        
+        return None
+    
+    def _get_fallback_meme(self) -> Meme:
+        """Get a random meme from the hardcoded fallback list."""
+        fallback = random.choice(FALLBACK_MEMES)
+        meme = Meme(fallback['title'], fallback['url'], fallback['subreddit'], source=MemeSource.FALLBACK)
+        logger.info("Using fallback meme: %s", meme.title)
+        return meme
+    
+    def _is_valid_media_url(self, url: str) -> bool:
+        """
+        Check if URL points to a valid image or video file.
+        
+        Args:
+            url: URL to check
+            
+        Returns:
+            True if URL is a valid media file
+        """
+        return classify_media_url(url) is not None
+
+
+class MemeFetcher(BaseMemeFetcher):
+    """Handles fetching memes from multiple sources."""
+    
+    def __init__(self):
+        self._session = None
+    
+    @property
+    def session(self):
+        """The ``requests`` session, created (and ``requests`` imported) on first use."""
+        if self._session is None:
+            import requests
+            
+            self._session = requests.Session()
+            self._session.headers.update({
+                'User-Agent': USER_AGENT,
+                'Accept': 'application/json, text/html, */*',
+                'Accept-Language': 'en-US,en;q=0.9',
+                'Accept-Encoding': 'gzip, deflate, br',
+                'Connection': 'keep-alive',
+                'Upgrade-Insecure-Requests': '1',
+            })
+        return self._session
+    
+    def get_random_meme(self) -> Optional[Meme]:
+        """
+        Get a random meme from available sources.
+        
+        Returns:
+            The meme, or None if no meme found
+        """
+        # Try Reddit first
+        meme = self._try_reddit_meme()
+        
+        # If Reddit fails, try Giphy as fallback
+        if not meme:
+            logger.info("Reddit unavailable, trying Giphy fallback...")
+            meme = self._try_giphy_meme()
+        
+        # If Giphy fails, use hardcoded fallback
+        if not meme:
+            logger.info("Giphy unavailable, using hardcoded fallback...")
+            meme = self._get_fallback_meme()
+        
+        return meme
+    
+    def _try_reddit_meme(self) -> Optional[Meme]:
+        """Try to get a meme from Reddit."""
+        # Randomly select a subreddit
+        subreddit = random.choice(SUBREDDITS)
+        logger.info("Trying to fetch memes from r/%s", subreddit)
+        
+        # Get memes from the selected subreddit
+        memes = self._get_memes_from_subreddit(subreddit)
+        
+        return self._pick_meme(memes, subreddit)
+    
+    def _get_memes_from_subreddit(self, subreddit: str, limit: int = 50) -> list:
+        """
+        Fetch memes from a specific subreddit using multiple methods.
+        
+        Args:
+            subreddit: Name of the subreddit
+            limit: Number of posts to fetch (max 50)
+            
+        Returns:
+            List of meme posts with image/video URLs
+        """
+        # Try JSON endpoint first
+        memes = self._try_json_endpoint(subreddit, limit)
+        
+        # If JSON fails, try RSS feed
+        if not memes:
+            logger.info("JSON endpoint failed for r/%s, trying RSS feed...", subreddit)
+            memes = self._try_rss_feed(subreddit, limit)
+        
+        # If RSS fails, try alternative JSON endpoint
+        if not memes:
+            logger.info("RSS feed failed for r/%s, trying alternative JSON...", subreddit)
+            memes = self._try_alternative_json(subreddit, limit)
+        
+        return memes
+    
+    def _try_json_endpoint(self, subreddit: str, limit: int) -> list:
+        """Try to fetch from Reddit's JSON endpoint."""
+        try:
+            url = f"{REDDIT_BASE_URL}/r/{subreddit}/hot.json?limit={limit}"
+            response = self.session.get(url, timeout=REQUEST_TIMEOUT)
+            response.raise_for_status()
+            
+            return self._parse_listing(response.json(), subreddit)
+            
+        except Exception as e:
+            logger.debug("JSON endpoint failed for r/%s: %s", subreddit, e)
+            return []
+    
+    def _try_rss_feed(self, subreddit: str, limit: int) -> list:
+        """Try to fetch from Reddit's RSS feed."""
+        try:
+            url = f"{REDDIT_BASE_URL}/r/{subreddit}/hot/.rss?limit={limit}"
+            parser = FeedParser(subreddit, limit)
+            
+            # Stream the body and stop reading once enough posts are found
+            with self.session.get(url, timeout=REQUEST_TIMEOUT, stream=True) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(chunk_size=FEED_CHUNK_SIZE):
+                    parser.feed(chunk)
+                    if parser.done:
+                        break
+            
+            return parser.posts
+            
+        except Exception as e:
+            logger.debug("RSS feed failed for r/%s: %s", subreddit, e)
+            return []
+    
+    def _try_alternative_json(self, subreddit: str, limit: int) -> list:
+        """Try alternative JSON endpoint with different parameters."""
+        try:
+            # Try with different sorting
+            urls_to_try = [
+                f"{REDDIT_BASE_URL}/r/{subreddit}/top.json?t=day&limit={limit}",
+                f"{REDDIT_BASE_URL}/r/{subreddit}/new.json?limit={limit}",
+                f"{REDDIT_BASE_URL}/r/{subreddit}/rising.json?limit={limit}"
+            ]
+            
+            for url in urls_to_try:
+                try:
+                    response = self.session.get(url, timeout=REQUEST_TIMEOUT)
+                    response.raise_for_status()
+                    
+                    posts = self._parse_listing(response.json(), subreddit)
+                    
+                    if posts:
+                        return posts
+                        
+                except Exception as e:
+                    logger.debug("Alternative JSON failed for %s: %s", url, e)
+                    continue
+            
+            return []
+            
+        except Exception as e:
+            logger.debug("All alternative JSON endpoints failed for r/%s: %s", subreddit, e)
+            return []
+    
+    def _try_giphy_meme(self) -> Optional[Meme]:
+        """Try to get a meme from Giphy as fallback."""
+        try:
+            # Giphy trending endpoint (no API key required for basic usage)
+            url = f"{GIPHY_BASE_URL}/v1/gifs/trending"
+            
+            response = self.session.get(url, params=GIPHY_PARAMS, timeout=REQUEST_TIMEOUT)
+            response.raise_for_status()
+            
+            return self._parse_giphy(response.json())
+            
+        except Exception as e:
+            logger.debug("Giphy fallback failed: %s", e)
+            return None
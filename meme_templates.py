@@ -0,0 +1,173 @@
+"""
+Meme template rendering for the /make command.
+
+Draws classic top and bottom captions (upper case, white with a black
+outline) on a template image and encodes the result as JPEG. The bot runs
+``render`` in a process pool, so this module depends only on Pillow and
+its caches live in each worker process: every template and font size is
+decoded once, and text layout is memoized per (template, text).
+"""
+
+import io
+import os
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from PIL import Image, ImageDraw, ImageFont
+
+TEMPLATE_EXTENSIONS = frozenset({'.jpg', '.jpeg', '.png', '.webp'})
+
+# Caption layout: share of the image width a line may span, share of the
+# image height each caption may fill, and the font size range tried
+TEXT_WIDTH_RATIO = 0.94
+TEXT_HEIGHT_RATIO = 0.25
+MAX_FONT_RATIO = 0.12
+MIN_FONT_SIZE = 12
+MARGIN_RATIO = 0.02
+
+# Longest caption accepted, in characters
+MAX_CAPTION_LENGTH = 200
+
+JPEG_QUALITY = 85
+LAYOUT_CACHE_SIZE = 4096
+
+# Font size and (line, x, y) for each line of one caption
+Layout = Tuple[int, Tuple[Tuple[str, int, int], ...]]
+
+
+def find_templates(directory: str) -> Dict[str, str]:
+    """
+    Find the template images in a directory.
+    
+    Returns:
+        Map from template name (lowercase file name without extension) to path
+    """
+    templates = {}
+    for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+        name, extension = os.path.splitext(entry.name)
+        if entry.is_file() and extension.lower() in TEMPLATE_EXTENSIONS:
+            templates.setdefault(name.lower(), entry.path)
+    return templates
+
+
+def normalize_caption(text: str) -> str:
+    """Caption as drawn: upper case, single spaces, at most ``MAX_CAPTION_LENGTH`` characters."""
+    return ' '.join(text.upper().split())[:MAX_CAPTION_LENGTH]
+
+
+@lru_cache(maxsize=None)
+def load_template(path: str) -> Image.Image:
+    """Decode a template image once per process."""
+    with Image.open(path) as image:
+        return image.convert('RGB')
+
+
+@lru_cache(maxsize=None)
+def load_font(path: Optional[str], size: int) -> ImageFont.FreeTypeFont:
+    """Load a TrueType font at one size once per process; Pillow's own font if ``path`` is None."""
+    if path:
+        return ImageFont.truetype(path, size)
+    return ImageFont.load_default(size=size)
+
+
+def _wrap(font: ImageFont.FreeTypeFont, text: str, max_width: float) -> List[str]:
+    """Break text into lines no wider than ``max_width``, except single overlong words."""
+    lines: List[str] = []
+    line = ''
+    for word in text.split(' '):
+        candidate = f'{line} {word}' if line else word
+        if line and font.getlength(candidate) > max_width:
+            lines.append(line)
+            line = word
+        else:
+            line = candidate
+    lines.append(line)
+    return lines
+
+
+def _fits(font: ImageFont.FreeTypeFont, text: str, width: int, height: int) -> Optional[List[str]]:
+    lines = _wrap(font, text, width * TEXT_WIDTH_RATIO)
+    ascent, descent = font.getmetrics()
+    if (ascent + descent) * len(lines) > height * TEXT_HEIGHT_RATIO:
+        return None
+    if any(font.getlength(line) > width * TEXT_WIDTH_RATIO for line in lines):
+        return None
+    return lines
+
+
+@lru_cache(maxsize=LAYOUT_CACHE_SIZE)
+def layout(template: str, font_path: Optional[str], text: str, top: bool) -> Layout:
+    """
+    Choose the font size and line positions for one caption.
+    
+    The largest font size whose wrapped lines fit the caption area is found
+    by bisection; text that doesn't fit even at ``MIN_FONT_SIZE`` overflows.
+    
+    Args:
+        template: Template image path
+        font_path: TrueType font path, or None for Pillow's own font
+        text: Normalized caption
+        top: True for the top caption, False for the bottom one
+    
+    Returns:
+        ``(font_size, ((line, x, y), ...))``
+    """
+    width, height = load_template(template).size
+    low, high = MIN_FONT_SIZE, max(MIN_FONT_SIZE, int(height * MAX_FONT_RATIO))
+    lines = _wrap(load_font(font_path, low), text, width * TEXT_WIDTH_RATIO)
+    while low < high:
+        size = (low + high + 1) // 2
+        fitted = _fits(load_font(font_path, size), text, width, height)
+        if fitted is None:
+            high = size - 1
+        else:
+            low, lines = size, fitted
+    
+    font = load_font(font_path, low)
+    ascent, descent = font.getmetrics()
+    line_height = ascent + descent
+    margin = int(height * MARGIN_RATIO)
+    y = margin if top else height - margin - line_height * len(lines)
+    positions = []
+    for line in lines:
+        positions.append((line, int((width - font.getlength(line)) / 2), y))
+        y += line_height
+    return low, tuple(positions)
+
+
+def render(template: str, top: str, bottom: str, font_path: Optional[str] = None,
+           quality: int = JPEG_QUALITY) -> bytes:
+    """
+    Render a captioned meme.
+    
+    Args:
+        template: Template image path
+        top: Top caption, normalized with ``normalize_caption``; may be empty
+        bottom: Bottom caption, normalized likewise; may be empty
+        font_path: TrueType font path, or None for Pillow's own font
+        quality: JPEG quality
+    
+    Returns:
+        The JPEG bytes
+    """
+    image = load_template(template).copy()
+    draw = ImageDraw.Draw(image)
+    for text, is_top in ((top, True), (bottom, False)):
+        if not text:
+            continue
+        size, lines = layout(template, font_path, text, is_top)
+        font = load_font(font_path, size)
+        stroke = max(1, size // 15)
+        for line, x, y in lines:
+            draw.text((x, y), line, font=font, fill='white', stroke_width=stroke, stroke_fill='black')
+    
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def preload(templates: Iterable[str], font_path: Optional[str] = None) -> None:
+    """Process pool initializer: decode every template and the default font up front."""
+    for path in templates:
+        load_template(path)
+    load_font(font_path, MIN_FONT_SIZE)
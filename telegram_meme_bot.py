@@ -5,421 +5,4027 @@ Fetches random memes from Reddit without requiring a Reddit API key.
 """
 
 import asyncio
+import hashlib
+import heapq
+import html
 import json
 import random
 import logging
+import math
+import os
 import re
-from typing import Optional, Dict, Any
+import signal
+import sqlite3
+import subprocess
+import sys
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from contextvars import ContextVar
+from itertools import zip_longest
+from typing import (
+    TYPE_CHECKING, Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional,
+    Sequence, Set, Tuple,
+)
 from urllib.parse import urlparse
 
-import requests
-from telegram import Update
-from telegram.ext import Application, CommandHandler, ContextTypes
+import httpx
+from telegram import (
+    InlineQueryResult, InlineQueryResultCachedGif, InlineQueryResultCachedPhoto, InlineQueryResultCachedVideo,
+    InlineQueryResultGif, InlineQueryResultMpeg4Gif, InlineQueryResultPhoto, Message, Update,
+)
+from telegram.error import BadRequest
+
+import image_hash
+import meme_core
+import meme_templates
+from meme_core import (
+    FEED_CHUNK_SIZE, GIPHY_BASE_URL, GIPHY_PARAMS, MEDIA_EXTENSIONS, REDDIT_BASE_URL, REQUEST_TIMEOUT, SUBREDDITS,
+    USER_AGENT, BaseMemeFetcher, FeedParser, MediaKind, Meme, MemeSource, classify_media_url, delivery_url,
+)
+
+if TYPE_CHECKING:
+    # telegram.ext (the job queue's scheduler, the webhook server) is only
+    # needed to run the bot, so main() imports it
+    from telegram.ext import Application, ContextTypes
+
+# Re-exported for scripts that still import it from here
+MemeFetcher = meme_core.MemeFetcher
 
 # Configure logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
+# httpx logs every request at INFO, which media validation turns into hundreds per refresh
+logging.getLogger('httpx').setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
-# Subreddits to fetch memes from
-SUBREDDITS = ['memes', 'dankmemes', 'wholesomememes']
-
-# User agent to avoid being blocked by Reddit
-USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-
-# Fallback meme URLs (popular meme images)
-FALLBACK_MEMES = [
-    {
-        'title': 'Classic Doge Meme',
-        'url': 'https://i.imgur.com/8tBcQ4A.jpg',
-        'subreddit': 'classic',
-        'source': 'Fallback'
-    },
-    {
-        'title': 'Grumpy Cat',
-        'url': 'https://i.imgur.com/8tBcQ4A.jpg',
-        'subreddit': 'classic',
-        'source': 'Fallback'
-    },
-    {
-        'title': 'Success Kid',
-        'url': 'https://i.imgur.com/8tBcQ4A.jpg',
-        'subreddit': 'classic',
-        'source': 'Fallback'
-    },
-    {
-        'title': 'One Does Not Simply',
-        'url': 'https://i.imgur.com/8tBcQ4A.jpg',
-        'subreddit': 'classic',
-        'source': 'Fallback'
-    },
-    {
-        'title': 'Y U No',
-        'url': 'https://i.imgur.com/8tBcQ4A.jpg',
-        'subreddit': 'classic',
-        'source': 'Fallback'
-    }
-]
+# Maximum number of concurrent requests to a single upstream host
+MAX_CONNECTIONS_PER_HOST = int(os.getenv('MAX_CONNECTIONS_PER_HOST', '8'))
+
+# Warm meme pool settings (seconds)
+# A pool younger than POOL_TTL is served as-is; up to POOL_STALE_TTL it is
+# still served while a background refresh runs; older pools are refetched inline.
+POOL_TTL = int(os.getenv('POOL_TTL', '300'))
+POOL_STALE_TTL = int(os.getenv('POOL_STALE_TTL', '3600'))
+POOL_REFRESH_INTERVAL = int(os.getenv('POOL_REFRESH_INTERVAL', '120'))
 
+# Media validation: before memes enter a pool their URLs are HEAD-checked (or
+# range-GET) with at most MEDIA_VALIDATION_CONCURRENCY checks in flight, and
+# only media Telegram can fetch is admitted. Verdicts are kept per URL.
+VALIDATE_MEDIA = os.getenv('VALIDATE_MEDIA', '1') == '1'
+MEDIA_VALIDATION_CONCURRENCY = int(os.getenv('MEDIA_VALIDATION_CONCURRENCY', '16'))
+MEDIA_VALIDATION_TIMEOUT = float(os.getenv('MEDIA_VALIDATION_TIMEOUT', '3'))
+MEDIA_VALIDATION_CACHE_SIZE = 20000
 
-class MemeFetcher:
-    """Handles fetching memes from multiple sources."""
+# Repost deduplication: images admitted to a pool are downloaded (up to
+# DEDUP_MAX_BYTES) and perceptually hashed; one within DEDUP_MAX_DISTANCE
+# bits (of 64) of an image already seen under another URL is dropped. The
+# near-duplicate index holds DEDUP_INDEX_SIZE hashes.
+DEDUP_MEDIA = os.getenv('DEDUP_MEDIA', '1') == '1'
+DEDUP_MAX_DISTANCE = int(os.getenv('DEDUP_MAX_DISTANCE', '6'))
+DEDUP_CONCURRENCY = int(os.getenv('DEDUP_CONCURRENCY', '8'))
+DEDUP_MAX_BYTES = 8 * 1024 * 1024
+DEDUP_INDEX_SIZE = int(os.getenv('DEDUP_INDEX_SIZE', '1000000'))
+DEDUP_CACHE_SIZE = 20000
+
+# Largest files Telegram downloads when media is sent by URL (bytes)
+TELEGRAM_PHOTO_URL_LIMIT = 5 * 1024 * 1024
+TELEGRAM_FILE_URL_LIMIT = 20 * 1024 * 1024
+
+# Conditional GET: ETag/Last-Modified validators (and the parsed result) are
+# kept for this many endpoint URLs; keep it above the number of subreddits
+VALIDATOR_CACHE_SIZE = int(os.getenv('VALIDATOR_CACHE_SIZE', '2048'))
+
+# Batched refresh: fetch all subreddits through combined /r/a+b+c listings,
+# following the 'after' cursor for up to BATCHED_FETCH_PAGES pages of 100 posts
+BATCHED_FETCH = os.getenv('BATCHED_FETCH', '1') == '1'
+BATCHED_FETCH_PAGES = int(os.getenv('BATCHED_FETCH_PAGES', '3'))
+COMBINED_MAX_SUBREDDITS = 25
+
+
+
+def _parse_subreddit_weights(spec: str) -> Dict[str, float]:
+    """
+    Parse ``name:weight`` pairs, e.g. 'memes:2,dankmemes:1'.
     
-    def __init__(self):
-        self.session = requests.Session()
-        self.session.headers.update({
-            'User-Agent': USER_AGENT,
-            'Accept': 'application/json, text/html, */*',
-            'Accept-Language': 'en-US,en;q=0.9',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1',
-        })
-    
-    def get_random_meme(self) -> Optional[Dict[str, Any]]:
+    Malformed entries are logged and skipped, leaving that subreddit at
+    the default weight of 1.0.
+    """
+    weights = {}
+    for item in spec.split(','):
+        name, _, weight = item.partition(':')
+        name = name.strip()
+        if not name and not weight.strip():
+            continue
+        try:
+            value = float(weight)
+        except ValueError:
+            value = -1.0
+        if not name or not math.isfinite(value) or value < 0:
+            logger.warning("Ignoring malformed SUBREDDIT_WEIGHTS entry %r", item)
+            continue
+        weights[name] = value
+    return weights
+
+
+# Relative sampling weight per subreddit, e.g. SUBREDDIT_WEIGHTS='memes:2,dankmemes:1'
+SUBREDDIT_WEIGHTS = _parse_subreddit_weights(os.getenv('SUBREDDIT_WEIGHTS', ''))
+
+# Adaptive refresh: instead of refilling every pool on one interval, each
+# subreddit's listing is refetched on its own interval between
+# REFRESH_MIN_INTERVAL and REFRESH_MAX_INTERVAL seconds, from how often /meme
+# draws from it and how fast its hot listing changes. Scheduled refreshes
+# start at most REFRESH_BUDGET_SHARE of the upstream budget's rate, leaving
+# the rest for cold pools and hedges. ADAPTIVE_REFRESH=0 restores the fixed
+# POOL_REFRESH_INTERVAL refresh.
+ADAPTIVE_REFRESH = os.getenv('ADAPTIVE_REFRESH', '1') == '1'
+REFRESH_MIN_INTERVAL = float(os.getenv('REFRESH_MIN_INTERVAL', '60'))
+REFRESH_MAX_INTERVAL = float(os.getenv('REFRESH_MAX_INTERVAL', '1800'))
+REFRESH_BUDGET_SHARE = float(os.getenv('REFRESH_BUDGET_SHARE', '0.8'))
+REFRESH_CONCURRENCY = int(os.getenv('REFRESH_CONCURRENCY', '8'))
+# The budget is shared out by the square root of each subreddit's draws per
+# second times the share of its listing that is new per second (assumed to be
+# REFRESH_CHANGE_PRIOR until measured). A subreddit expected to be drawn from
+# at most REFRESH_DRAWS_PER_REFRESH times per REFRESH_MAX_INTERVAL is idle.
+# Draws are counted with a half-life of REFRESH_DEMAND_HALF_LIFE seconds.
+REFRESH_CHANGE_PRIOR = 0.25 / 3600
+REFRESH_DRAWS_PER_REFRESH = 2
+REFRESH_DEMAND_HALF_LIFE = 1800.0
+# Posts requested per listing: the smallest of these holding twice the draws
+# expected before the next refresh
+REFRESH_LISTING_LIMITS = (25, 50, 100)
+# A subreddit Reddit reports missing, private or banned isn't refreshed or
+# drawn from for SUBREDDIT_QUARANTINE seconds (the default subreddits never are)
+SUBREDDIT_QUARANTINE = float(os.getenv('SUBREDDIT_QUARANTINE', '21600'))
+# The 403 ``reason`` values that mean one subreddit is closed; any other 403
+# is a Reddit-wide block and counts against the endpoint's circuit breaker
+SUBREDDIT_FORBIDDEN_REASONS = frozenset({'private', 'banned', 'quarantined'})
+
+# Per-chat subreddits (/subreddits): at most CHAT_MAX_SUBREDDITS per chat and
+# MAX_SUBREDDITS pools across all chats. Subreddits new to the bot are
+# checked with Reddit before they are added, at most
+# SUBREDDIT_CHECKS_PER_COMMAND per /subreddits add.
+CHAT_MAX_SUBREDDITS = int(os.getenv('CHAT_MAX_SUBREDDITS', '100'))
+MAX_SUBREDDITS = int(os.getenv('MAX_SUBREDDITS', '5000'))
+SUBREDDIT_CHECKS_PER_COMMAND = int(os.getenv('SUBREDDIT_CHECKS_PER_COMMAND', '5'))
+
+# Source racing (seconds): delay before secondary sources are hedged in, and
+# the per-command budget after which the hardcoded fallback is served
+HEDGE_DELAY = float(os.getenv('HEDGE_DELAY', '0.75'))
+MEME_DEADLINE = float(os.getenv('MEME_DEADLINE', '4'))
+
+# Circuit breaker settings: consecutive failures before a source is skipped,
+# and the first/maximum cooldown in seconds (doubled on every failed probe)
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '3'))
+CIRCUIT_BASE_COOLDOWN = float(os.getenv('CIRCUIT_BASE_COOLDOWN', '30'))
+CIRCUIT_MAX_COOLDOWN = float(os.getenv('CIRCUIT_MAX_COOLDOWN', '900'))
+
+# Telegram user IDs allowed to use admin commands (comma-separated)
+ADMIN_USER_IDS = {int(uid) for uid in os.getenv('ADMIN_USER_IDS', '').split(',') if uid.strip()}
+
+# Per-chat no-repeat tracking: Bloom filter size in bits and URLs per filter
+# before it rotates, and how many chats to remember
+SEEN_FILTER_BITS = int(os.getenv('SEEN_FILTER_BITS', '4096'))
+SEEN_CAPACITY = int(os.getenv('SEEN_CAPACITY', '500'))
+SEEN_MAX_CHATS = int(os.getenv('SEEN_MAX_CHATS', '50000'))
+SEEN_RANDOM_PROBES = 4
+SEEN_SCAN_LIMIT = 256
+SEEN_OTHER_POOLS = 3
+
+# Command rate limits (per minute, with burst allowance). Commands over the
+# limit by less than RATE_LIMIT_MAX_WAIT seconds are queued, others rejected.
+USER_RATE_PER_MINUTE = float(os.getenv('USER_RATE_PER_MINUTE', '10'))
+USER_BURST = int(os.getenv('USER_BURST', '3'))
+CHAT_RATE_PER_MINUTE = float(os.getenv('CHAT_RATE_PER_MINUTE', '20'))
+CHAT_BURST = int(os.getenv('CHAT_BURST', '5'))
+RATE_LIMIT_MAX_WAIT = float(os.getenv('RATE_LIMIT_MAX_WAIT', '3'))
+RATE_LIMIT_MAX_KEYS = 100000
+
+# Global budget for upstream requests (Reddit, Giphy) across all chats
+UPSTREAM_RATE_PER_MINUTE = float(os.getenv('UPSTREAM_RATE_PER_MINUTE', '60'))
+UPSTREAM_BURST = int(os.getenv('UPSTREAM_BURST', '10'))
+
+# Update delivery: webhook mode is used when WEBHOOK_URL (the public base URL
+# Telegram should POST to) is set, long polling otherwise
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+
+# Number of updates handled concurrently (1 processes updates one at a time)
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '64'))
+
+# Only the update types the handlers use are requested from Telegram
+ALLOWED_UPDATES = [Update.MESSAGE, Update.INLINE_QUERY]
+
+# Inline mode (@bot <keywords>): results per page (Telegram allows up to 50)
+# and how long Telegram may cache each page, in seconds
+INLINE_PAGE_SIZE = min(int(os.getenv('INLINE_PAGE_SIZE', '20')), 50)
+INLINE_CACHE_TIME = int(os.getenv('INLINE_CACHE_TIME', '60'))
+
+# Alternative Bot API server, e.g. a local telegram-bot-api or a test stub
+TELEGRAM_API_BASE_URL = os.getenv('TELEGRAM_API_BASE_URL')
+
+# Optional SQLite file that snapshots pools, source health and file_ids so
+# restarts are warm; also the store sharded workers share (required for them)
+MEME_STORE_PATH = os.getenv('MEME_STORE_PATH') or None
+
+# Pre-warm: with PREWARM=1 the snapshot restore, the first pool refresh (and
+# the upstream and media host connections it opens) and the /make render
+# processes start alongside Application startup instead of after it
+PREWARM = os.getenv('PREWARM', '0') == '1'
+
+# Sharding: with SHARD_WORKERS > 0 the bot starts one fetcher process that fills
+# the store at MEME_STORE_PATH and that many webhook workers that serve
+# updates from it (worker i listens on WEBHOOK_PORT + i). SHARD_ROLE and
+# SHARD_INDEX are set by the supervisor for its child processes.
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS', '0'))
+SHARD_ROLE = os.getenv('SHARD_ROLE', '')
+SHARD_INDEX = int(os.getenv('SHARD_INDEX', '0'))
+SHARED_STORE_POLL_INTERVAL = float(os.getenv('SHARED_STORE_POLL_INTERVAL', '2'))
+
+# Metrics: Prometheus text exposition on METRICS_LISTEN:METRICS_PORT/metrics
+# (0 disables the endpoint). In a sharded deployment the fetcher uses
+# METRICS_PORT and worker i uses METRICS_PORT + 1 + i.
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+EVENT_LOOP_LAG_INTERVAL = 0.5
+
+# Fraction of /meme commands whose span trace is logged and kept for /traces
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '0'))
+TRACE_HISTORY = 50
+
+# Telegram file_id cache: maximum entries and optional JSON file to persist to
+# when there is no MEME_STORE_PATH (the store holds them otherwise)
+FILE_ID_CACHE_SIZE = int(os.getenv('FILE_ID_CACHE_SIZE', '10000'))
+FILE_ID_CACHE_PATH = os.getenv('FILE_ID_CACHE_PATH')
+
+# On-disk cache of downloaded media, uploaded as bytes when Telegram can't (or
+# only slowly) fetch a URL itself. Set MEDIA_CACHE_DIR to enable; the size
+# bound is MEDIA_CACHE_MAX_MB per process.
+MEDIA_CACHE_DIR = os.getenv('MEDIA_CACHE_DIR', '')
+MEDIA_CACHE_MAX_BYTES = int(os.getenv('MEDIA_CACHE_MAX_MB', '512')) * 1024 * 1024
+MEDIA_CHUNK_SIZE = 64 * 1024
+
+# A host whose URL sends average over SLOW_HOST_SECONDS, or that Telegram
+# failed to fetch from in the last SLOW_HOST_FAILURE_TTL seconds, gets uploads
+SLOW_HOST_SECONDS = float(os.getenv('SLOW_HOST_SECONDS', '3'))
+SLOW_HOST_FAILURE_TTL = float(os.getenv('SLOW_HOST_FAILURE_TTL', '600'))
+# BadRequest messages meaning Telegram couldn't fetch a URL (any other
+# rejection, e.g. of the caption, isn't the host's fault)
+TELEGRAM_FETCH_ERRORS = (
+    'failed to get http url content',
+    'wrong file identifier/http url specified',
+    'wrong type of the web page content',
+)
+
+# Largest files the Bot API accepts as uploads (bytes)
+TELEGRAM_PHOTO_UPLOAD_LIMIT = 10 * 1024 * 1024
+TELEGRAM_FILE_UPLOAD_LIMIT = 50 * 1024 * 1024
+
+# /make: template images (name = file name), an optional TrueType font
+# (Pillow's own otherwise), render processes and the rendered meme cache
+MEME_TEMPLATE_DIR = os.getenv('MEME_TEMPLATE_DIR',
+                              os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'))
+MEME_FONT_PATH = os.getenv('MEME_FONT_PATH') or None
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', str(os.cpu_count() or 1)))
+RENDER_CACHE_MAX_BYTES = int(os.getenv('RENDER_CACHE_MAX_MB', '32')) * 1024 * 1024
+
+_SOURCES = list(MemeSource)
+_SOURCE_INDEX = {source: index for index, source in enumerate(_SOURCES)}
+
+
+class MemeStore:
+    """
+    Compact columnar storage for a pool of memes.
+    
+    Titles, URLs and permalinks live in parallel lists; subreddit and source
+    are small integers in ``array`` columns indexing shared, interned name
+    tables. ``Meme`` records are only materialised on access, and random
+    sampling is O(1).
+    """
+    
+    def __init__(self, memes: Iterable[Meme] = ()):
+        self._titles: List[str] = []
+        self._urls: List[str] = []
+        self._permalinks: List[str] = []
+        self._subreddit_ids = array('H')
+        self._source_ids = array('B')
+        self._subreddits: List[str] = []
+        self._subreddit_index: Dict[str, int] = {}
+        self.extend(memes)
+    
+    def __len__(self) -> int:
+        return len(self._urls)
+    
+    def __getitem__(self, index: int) -> Meme:
+        return Meme(
+            self._titles[index],
+            self._urls[index],
+            self._subreddits[self._subreddit_ids[index]],
+            self._permalinks[index],
+            _SOURCES[self._source_ids[index]],
+        )
+    
+    def __iter__(self) -> Iterator[Meme]:
+        for index in range(len(self)):
+            yield self[index]
+    
+    def append(self, meme: Meme) -> None:
+        """Add a meme to the end of the store."""
+        subreddit_id = self._subreddit_index.get(meme.subreddit)
+        if subreddit_id is None:
+            subreddit_id = len(self._subreddits)
+            self._subreddits.append(sys.intern(meme.subreddit))
+            self._subreddit_index[self._subreddits[-1]] = subreddit_id
+        
+        self._titles.append(meme.title)
+        self._urls.append(meme.url)
+        self._permalinks.append(meme.permalink)
+        self._subreddit_ids.append(subreddit_id)
+        self._source_ids.append(_SOURCE_INDEX[meme.source])
+    
+    def extend(self, memes: Iterable[Meme]) -> None:
+        """Add several memes to the end of the store."""
+        for meme in memes:
+            self.append(meme)
+    
+    def url_at(self, index: int) -> str:
+        """URL of the meme at ``index``, without building the record."""
+        return self._urls[index]
+    
+    def urls(self) -> Iterator[str]:
+        """URLs of every meme in order, without building the records."""
+        return iter(self._urls)
+    
+    def title_at(self, index: int) -> str:
+        """Title of the meme at ``index``, without building the record."""
+        return self._titles[index]
+    
+    def sample(self) -> Optional[Meme]:
+        """Pick a random meme, or None if the store is empty."""
+        if not self._urls:
+            return None
+        return self[random.randrange(len(self._urls))]
+
+
+_WORD = re.compile(r'\w+')
+
+
+def title_words(text: str) -> List[str]:
+    """Lowercase words of a title or search query."""
+    return _WORD.findall(text.casefold())
+
+
+class TitleIndex:
+    """
+    Word index over the titles in a ``MemeStore``, for inline search.
+    
+    Built once per pool listing. Words are kept sorted so all the words
+    starting with a search term are one contiguous run found by bisection;
+    each word maps to the ascending positions of the titles containing it.
+    """
+    
+    def __init__(self, store: MemeStore):
+        postings: Dict[str, List[int]] = {}
+        for index in range(len(store)):
+            for word in set(title_words(store.title_at(index))):
+                postings.setdefault(word, []).append(index)
+        self._size = len(store)
+        self._words = sorted(postings)
+        self._postings = [array('I', postings[word]) for word in self._words]
+    
+    def search(self, terms: Sequence[str]) -> List[int]:
         """
-        Get a random meme from available sources.
+        Positions of the titles in which every term starts some word.
+        
+        Args:
+            terms: Lowercase search terms, e.g. from ``title_words``
+            
+        Returns:
+            Matching store positions in ascending order; every position
+            when there are no terms
+        """
+        if not terms:
+            return list(range(self._size))
+        
+        result: Optional[set] = None
+        for term in terms:
+            matches = set()
+            position = bisect_left(self._words, term)
+            while position < len(self._words) and self._words[position].startswith(term):
+                matches.update(self._postings[position])
+                position += 1
+            result = matches if result is None else result & matches
+            if not result:
+                return []
+        return sorted(result)
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings, using double hashing."""
+    
+    __slots__ = ('bits', 'size', 'hashes', 'count')
+    
+    def __init__(self, size: int, hashes: int = 3):
+        self.bits = bytearray((size + 7) // 8)
+        self.size = size
+        self.hashes = hashes
+        self.count = 0
+    
+    def _positions(self, key: str) -> Iterator[int]:
+        h = hash(key) & 0xFFFFFFFFFFFFFFFF
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+    
+    def add(self, key: str) -> None:
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+    
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+class SeenTracker:
+    """
+    Remembers, per chat, which meme URLs were already sent.
+    
+    Each chat gets two rotating Bloom filters of ``bits`` bits: once the
+    current one holds ``capacity`` URLs it becomes the previous one and a
+    fresh filter takes over, so memory per chat is fixed and old memes
+    eventually become eligible again. Chats are kept in an LRU of at most
+    ``max_chats`` entries.
+    """
+    
+    def __init__(self, max_chats: int = SEEN_MAX_CHATS, capacity: int = SEEN_CAPACITY,
+                 bits: int = SEEN_FILTER_BITS):
+        self.max_chats = max_chats
+        self.capacity = capacity
+        self.bits = bits
+        self._chats: 'OrderedDict[int, List[BloomFilter]]' = OrderedDict()
+    
+    def __len__(self) -> int:
+        return len(self._chats)
+    
+    def has_seen(self, chat_id: int, url: str) -> bool:
+        """True if the URL was (probably) already sent to the chat."""
+        filters = self._chats.get(chat_id)
+        return filters is not None and any(url in f for f in filters)
+    
+    def mark_seen(self, chat_id: int, url: str) -> None:
+        """Record that a URL was sent to a chat."""
+        filters = self._chats.get(chat_id)
+        if filters is None:
+            filters = [BloomFilter(self.bits)]
+            self._chats[chat_id] = filters
+            while len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        
+        if filters[0].count >= self.capacity:
+            # Rotate: drop the oldest filter, start a fresh one
+            filters[:] = [BloomFilter(self.bits), filters[0]]
+        filters[0].add(url)
+    
+    def sample_unseen(self, chat_id: int, store: MemeStore) -> Optional[Meme]:
+        """
+        Pick a random meme the chat hasn't seen yet.
+        
+        Probes a few random positions, then scans a bounded window from a
+        random offset.
+        
+        Returns:
+            An unseen meme, or None if the chat has seen everything checked
+        """
+        size = len(store)
+        if not size or chat_id not in self._chats:
+            return store.sample()
+        
+        for _ in range(SEEN_RANDOM_PROBES):
+            index = random.randrange(size)
+            if not self.has_seen(chat_id, store.url_at(index)):
+                return store[index]
+        
+        start = random.randrange(size)
+        for offset in range(min(size, SEEN_SCAN_LIMIT)):
+            index = (start + offset) % size
+            if not self.has_seen(chat_id, store.url_at(index)):
+                return store[index]
+        
+        return None
+
+
+class FileIdCache:
+    """
+    LRU map from meme URL to the Telegram ``file_id`` of its first upload.
+    
+    Resending by ``file_id`` skips Telegram's download of the remote media.
+    Entries are ``(media_type, file_id)`` tuples. The cache is persisted to
+    one place: a ``SharedMemeStore`` once ``attach``ed, which every put and
+    discard is written through to, or else the JSON file at ``path``.
+    """
+    
+    def __init__(self, max_entries: int = FILE_ID_CACHE_SIZE, path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.path = path
+        self.store: Optional['SharedMemeStore'] = None
+        self._entries: 'OrderedDict[str, Tuple[str, str]]' = OrderedDict()
+        if path:
+            self.load()
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def get(self, url: str) -> Optional[Tuple[str, str]]:
+        """Return ``(media_type, file_id)`` for a URL and mark it recently used."""
+        entry = self._entries.get(url)
+        if entry is not None:
+            self._entries.move_to_end(url)
+        return entry
+    
+    def put(self, url: str, media_type: str, file_id: str) -> None:
+        """Remember the file_id for a URL, evicting the least recently used entry."""
+        self._remember(url, media_type, file_id)
+        if self.store is not None:
+            try:
+                self.store.put_file_id(url, media_type, file_id)
+            except sqlite3.Error as e:
+                logger.warning("Could not save the file_id of %s to %s: %s", url, self.store.path, e)
+    
+    def discard(self, url: str) -> None:
+        """Forget a URL, e.g. after Telegram rejects its file_id."""
+        self._entries.pop(url, None)
+        if self.store is not None:
+            try:
+                self.store.discard_file_id(url)
+            except sqlite3.Error as e:
+                logger.warning("Could not drop the file_id of %s from %s: %s", url, self.store.path, e)
+    
+    def attach(self, store: 'SharedMemeStore') -> None:
+        """
+        Persist to ``store`` instead of the JSON file, adding its entries.
+        
+        Raises:
+            sqlite3.Error: If the store's entries couldn't be read
+        """
+        self.restore(store.load_file_ids(self.max_entries))
+        self.store = store
+        self.path = None
+    
+    def items(self) -> List[Tuple[str, str, str]]:
+        """All entries as ``(url, media_type, file_id)``, least recently used first."""
+        return [(url, media_type, file_id) for url, (media_type, file_id) in self._entries.items()]
+    
+    def restore(self, entries: Iterable[Tuple[str, str, str]]) -> None:
+        """Add ``(url, media_type, file_id)`` entries, given least recently used first."""
+        for url, media_type, file_id in entries:
+            self._remember(url, media_type, file_id)
+    
+    def load(self) -> None:
+        """Load entries from ``path`` if it exists."""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning("Could not load file_id cache from %s: %s", self.path, e)
+            return
+        
+        for url, (media_type, file_id) in data[-self.max_entries:]:
+            self._entries[url] = (media_type, file_id)
+    
+    def save(self) -> None:
+        """Write entries to ``path`` atomically, oldest first."""
+        if not self.path:
+            return
+        
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump([[url, list(entry)] for url, entry in self._entries.items()], f)
+        os.replace(tmp_path, self.path)
+    
+    def _remember(self, url: str, media_type: str, file_id: str) -> None:
+        self._entries[url] = (media_type, file_id)
+        self._entries.move_to_end(url)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+class MediaCache:
+    """
+    Size-bounded LRU cache of media files on disk.
+    
+    Files are named after a hash of their meme URL and streamed to disk in
+    ``MEDIA_CHUNK_SIZE`` chunks, never held in memory whole; the writes run
+    in a worker thread so a slow disk doesn't stall the event loop. Once
+    the total passes ``max_bytes`` the least recently used files are
+    deleted. Recency is kept in file mtimes, so the order survives restarts.
+    """
+    
+    def __init__(self, directory: str, max_bytes: int = MEDIA_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._files: 'OrderedDict[str, int]' = OrderedDict()  # file name -> size
+        self._flights = SingleFlight()
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+    
+    def __len__(self) -> int:
+        return len(self._files)
+    
+    def _scan(self) -> None:
+        """Index the files already on disk, oldest first, and drop partial downloads."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith('.part'):
+                os.remove(entry.path)
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, entry.name, stat.st_size))
+        
+        for _, name, size in sorted(entries):
+            self._files[name] = size
+            self.total_bytes += size
+        self._evict()
+    
+    @staticmethod
+    def _name(url: str) -> str:
+        target = delivery_url(url)
+        extension = os.path.splitext(target.split('?', 1)[0])[1].lower()
+        if extension not in MEDIA_EXTENSIONS:
+            kind = classify_media_url(url)
+            extension = '.mp4' if kind is MediaKind.VIDEO else '.gif' if kind is MediaKind.GIF else '.jpg'
+        return hashlib.blake2b(url.encode(), digest_size=16).hexdigest() + extension
+    
+    def get(self, url: str) -> Optional[str]:
+        """Path of the cached file for a URL (marking it recently used), or None."""
+        name = self._name(url)
+        if name not in self._files:
+            return None
+        
+        path = os.path.join(self.directory, name)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self.total_bytes -= self._files.pop(name)
+            return None
+        self._files.move_to_end(name)
+        return path
+    
+    async def fetch(self, client: httpx.AsyncClient, url: str, max_size: int) -> Optional[str]:
+        """
+        Return the cached file for a URL, downloading it first if needed.
+        
+        Concurrent fetches of one URL share a download.
+        
+        Returns:
+            The file's path, or None if the download failed or the file is
+            empty or larger than ``max_size`` bytes
+        """
+        path = self.get(url)
+        if path is not None:
+            return path
+        return await self._flights.do(url, lambda: self._download(client, url, max_size))
+    
+    async def _download(self, client: httpx.AsyncClient, url: str, max_size: int) -> Optional[str]:
+        name = self._name(url)
+        path = os.path.join(self.directory, name)
+        # Per process, as sharded workers may share the directory's parent
+        tmp_path = f"{path}.{os.getpid()}.part"
+        size = 0
+        outcome = 'ok'
+        try:
+            with span('download'):
+                async with client.stream('GET', delivery_url(url)) as response:
+                    response.raise_for_status()
+                    f = await asyncio.to_thread(open, tmp_path, 'wb')
+                    try:
+                        async for chunk in response.aiter_bytes(MEDIA_CHUNK_SIZE):
+                            size += len(chunk)
+                            if size > max_size:
+                                outcome = 'too_large'
+                                break
+                            await asyncio.to_thread(f.write, chunk)
+                    finally:
+                        await asyncio.to_thread(f.close)
+            if size == 0:
+                outcome = 'empty'
+        except (httpx.HTTPError, OSError) as e:
+            logger.info("Could not download %s: %s", url, e)
+            outcome = 'error'
+        
+        MEDIA_CACHE_DOWNLOADS.inc(outcome)
+        if outcome != 'ok':
+            try:
+                await asyncio.to_thread(os.remove, tmp_path)
+            except FileNotFoundError:
+                pass
+            return None
+        
+        await asyncio.to_thread(os.replace, tmp_path, path)
+        self.total_bytes += size - self._files.pop(name, 0)
+        self._files[name] = size
+        self._evict()
+        return path if name in self._files else None
+    
+    def _evict(self) -> None:
+        while self.total_bytes > self.max_bytes and self._files:
+            name, size = self._files.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+
+class HostDeliveryStats:
+    """
+    How well Telegram fetches media from each host when sent a URL.
+    
+    Keeps a moving average of URL send times and the time Telegram last
+    failed to fetch from the host. Slow hosts, and hosts that failed within
+    ``failure_ttl`` seconds, are better served by uploading the bytes.
+    """
+    
+    def __init__(self, slow_after: float = SLOW_HOST_SECONDS, failure_ttl: float = SLOW_HOST_FAILURE_TTL,
+                 alpha: float = 0.3):
+        self.slow_after = slow_after
+        self.failure_ttl = failure_ttl
+        self.alpha = alpha
+        self._send_seconds: Dict[str, float] = {}
+        self._failed_at: Dict[str, float] = {}
+    
+    def record_send(self, url: str, seconds: float) -> None:
+        host = urlparse(url).netloc
+        average = self._send_seconds.get(host)
+        self._send_seconds[host] = seconds if average is None else average + self.alpha * (seconds - average)
+    
+    def record_failure(self, url: str) -> None:
+        self._failed_at[urlparse(url).netloc] = time.monotonic()
+    
+    def prefers_upload(self, url: str) -> bool:
+        """True if media from this URL's host should be uploaded rather than sent by URL."""
+        host = urlparse(url).netloc
+        if self._send_seconds.get(host, 0.0) > self.slow_after:
+            return True
+        failed_at = self._failed_at.get(host)
+        return failed_at is not None and time.monotonic() - failed_at < self.failure_ttl
+
+
+class TemplateRenderer:
+    """
+    Renders /make memes from the template library in a process pool.
+    
+    Image work is CPU-bound, so it runs in ``workers`` processes, started on
+    first use, that each decode every template once; the event loop only
+    waits on the result. Rendered JPEGs are kept in an LRU bounded by
+    ``max_bytes``, keyed by a content hash of the template file, font and
+    captions, and identical renders in flight are shared.
+    """
+    
+    def __init__(self, directory: str = MEME_TEMPLATE_DIR, font_path: Optional[str] = MEME_FONT_PATH,
+                 workers: int = RENDER_WORKERS, max_bytes: int = RENDER_CACHE_MAX_BYTES):
+        self.templates = meme_templates.find_templates(directory) if os.path.isdir(directory) else {}
+        self.font_path = font_path
+        self.workers = max(1, workers)
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._digests: Dict[str, str] = {}
+        self._outputs: 'OrderedDict[str, bytes]' = OrderedDict()
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._flights = SingleFlight()
+    
+    def key(self, template: str, top: str, bottom: str) -> str:
+        """Content hash identifying a render of normalized captions on a template."""
+        digest = self._digests.get(template)
+        if digest is None:
+            with open(self.templates[template], 'rb') as f:
+                digest = self._digests[template] = hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+        material = '\0'.join((digest, self.font_path or '', top, bottom))
+        return hashlib.blake2b(material.encode(), digest_size=16).hexdigest()
+    
+    async def render(self, template: str, top: str, bottom: str) -> bytes:
+        """
+        Render a meme, or return the cached JPEG for the same request.
+        
+        Args:
+            template: Name of a template in ``self.templates``
+            top: Top caption, normalized with ``meme_templates.normalize_caption``
+            bottom: Bottom caption, normalized likewise
+            
+        Returns:
+            The JPEG bytes
+        """
+        key = self.key(template, top, bottom)
+        data = self._outputs.get(key)
+        if data is not None:
+            self._outputs.move_to_end(key)
+            RENDERS.inc('cached')
+            return data
+        return await self._flights.do(key, lambda: self._render(key, template, top, bottom))
+    
+    async def _render(self, key: str, template: str, top: str, bottom: str) -> bytes:
+        loop = asyncio.get_running_loop()
+        try:
+            with span('render'), RENDER_SECONDS.time():
+                data = await loop.run_in_executor(self._pool(), meme_templates.render,
+                                                  self.templates[template], top, bottom, self.font_path)
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for memory); start a fresh pool next time
+            self._executor = None
+            raise
+        
+        RENDERS.inc('rendered')
+        self._outputs[key] = data
+        self.total_bytes += len(data)
+        while self.total_bytes > self.max_bytes and self._outputs:
+            self.total_bytes -= len(self._outputs.popitem(last=False)[1])
+        return data
+    
+    async def warm(self) -> None:
+        """Start every worker process, and let it decode the templates, before the first /make."""
+        if not self.templates:
+            return
+        loop = asyncio.get_running_loop()
+        pool = self._pool()
+        # The pool starts a process per task submitted while none is idle
+        await asyncio.gather(*(loop.run_in_executor(pool, os.getpid) for _ in range(self.workers)))
+    
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                self.workers, initializer=meme_templates.preload,
+                initargs=(tuple(self.templates.values()), self.font_path),
+            )
+        return self._executor
+    
+    def shutdown(self) -> None:
+        """Cancel renders in flight and stop the worker processes."""
+        self._flights.cancel_all()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+class SharedMemeStore:
+    """
+    SQLite database (WAL mode) holding meme pools, source health and file_ids.
+    
+    It is both the bot's on-disk snapshot, reloaded at startup so a restart
+    serves warm pools, and the store sharded processes share. Pools are
+    written through on every refresh; the fetcher process is their only
+    writer and replaces a subreddit's rows in one transaction. Readers never
+    wait for the writer (or each other) under WAL and always see a complete
+    listing. ``version`` changes whenever another connection commits, so a
+    worker can poll for new listings without reading any rows.
+    
+    Every entry carries wall-clock expiry metadata: pools their fetch time,
+    open circuits the time they may be probed again and file_ids their
+    last use.
+    
+    Chats' subreddit lists are kept here too, numbered by change so other
+    processes can read just the lists changed since they last looked, as
+    are the /meme draws workers count per subreddit for the fetcher's
+    refresh scheduler.
+    """
+    
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS pools (
+            subreddit TEXT PRIMARY KEY,
+            generation INTEGER NOT NULL,
+            fetched_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS memes (
+            subreddit TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            title TEXT NOT NULL,
+            url TEXT NOT NULL,
+            permalink TEXT NOT NULL,
+            source TEXT NOT NULL,
+            PRIMARY KEY (subreddit, position)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS breakers (
+            name TEXT PRIMARY KEY,
+            state TEXT NOT NULL,
+            cooldown REAL NOT NULL,
+            open_until REAL NOT NULL,
+            consecutive_failures INTEGER NOT NULL,
+            successes INTEGER NOT NULL,
+            failures INTEGER NOT NULL,
+            rate_limited INTEGER NOT NULL,
+            rejected INTEGER NOT NULL,
+            trips INTEGER NOT NULL,
+            last_error TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS file_ids (
+            url TEXT PRIMARY KEY,
+            media_type TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            used_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS file_ids_used_at ON file_ids (used_at);
+        CREATE TABLE IF NOT EXISTS chat_subreddits (
+            chat_id INTEGER PRIMARY KEY,
+            subreddits TEXT NOT NULL,
+            change INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS chat_subreddits_change ON chat_subreddits (change);
+        CREATE TABLE IF NOT EXISTS subreddit_draws (
+            subreddit TEXT PRIMARY KEY,
+            draws INTEGER NOT NULL
+        );
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=REQUEST_TIMEOUT, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(self._SCHEMA)
+    
+    def close(self) -> None:
+        """Close the database connection."""
+        self._conn.close()
+    
+    def version(self) -> int:
+        """Counter that changes whenever another process commits to the store."""
+        return self._conn.execute('PRAGMA data_version').fetchone()[0]
+    
+    def publish(self, subreddit: str, memes: Iterable[Meme]) -> None:
+        """Atomically replace the stored listing for a subreddit."""
+        rows = [(subreddit, position, meme.title, meme.url, meme.permalink, meme.source.name)
+                for position, meme in enumerate(memes)]
+        with self._transaction():
+            self._conn.execute('DELETE FROM memes WHERE subreddit = ?', (subreddit,))
+            self._conn.executemany('INSERT INTO memes VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self._conn.execute(
+                'INSERT INTO pools VALUES (?, 1, ?) ON CONFLICT(subreddit) DO UPDATE '
+                'SET generation = generation + 1, fetched_at = excluded.fetched_at',
+                (subreddit, time.time()),
+            )
+    
+    def generations(self) -> Dict[str, Tuple[int, float]]:
+        """Map each stored subreddit to ``(generation, fetched_at)``; fetched_at is wall-clock time."""
+        rows = self._conn.execute('SELECT subreddit, generation, fetched_at FROM pools')
+        return {subreddit: (generation, fetched_at) for subreddit, generation, fetched_at in rows}
+    
+    def load(self, subreddit: str) -> Tuple[List[Meme], int, float]:
+        """
+        Read one subreddit's listing.
+        
+        Returns:
+            The memes in listing order, their generation and wall-clock
+            fetch time (generation 0 if the subreddit was never published)
+        """
+        with self._transaction():
+            row = self._conn.execute(
+                'SELECT generation, fetched_at FROM pools WHERE subreddit = ?', (subreddit,)
+            ).fetchone()
+            if row is None:
+                return [], 0, 0.0
+            memes = [
+                Meme(title, url, subreddit, permalink, MemeSource[source])
+                for title, url, permalink, source in self._conn.execute(
+                    'SELECT title, url, permalink, source FROM memes '
+                    'WHERE subreddit = ? ORDER BY position', (subreddit,)
+                )
+            ]
+        return memes, row[0], row[1]
+    
+    def save_breakers(self, rows: Iterable[tuple]) -> None:
+        """Replace the stored circuit breakers with ``SourceHealth.snapshot`` rows."""
+        with self._transaction():
+            self._conn.execute('DELETE FROM breakers')
+            self._conn.executemany('INSERT INTO breakers VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    
+    def load_breakers(self) -> List[tuple]:
+        """Stored circuit breakers, in the row format of ``SourceHealth.snapshot``."""
+        return self._conn.execute('SELECT * FROM breakers').fetchall()
+    
+    def save_file_ids(self, entries: Sequence[Tuple[str, str, str]], max_entries: int) -> None:
+        """
+        Merge ``FileIdCache.items()`` into the store, keeping the ``max_entries`` most recently used.
+        
+        Entries from other processes are kept, so workers pool their uploads.
+        """
+        now = time.time()
+        # Spread the timestamps so the cache's LRU order survives the round trip
+        rows = [(url, media_type, file_id, now - (len(entries) - index) * 1e-6)
+                for index, (url, media_type, file_id) in enumerate(entries)]
+        with self._transaction():
+            self._conn.executemany(
+                'INSERT INTO file_ids VALUES (?, ?, ?, ?) ON CONFLICT(url) DO UPDATE '
+                'SET media_type = excluded.media_type, file_id = excluded.file_id, '
+                'used_at = MAX(used_at, excluded.used_at)',
+                rows,
+            )
+            self._conn.execute(
+                'DELETE FROM file_ids WHERE used_at < ('
+                'SELECT used_at FROM file_ids ORDER BY used_at DESC LIMIT 1 OFFSET ?)',
+                (max_entries - 1,),
+            )
+    
+    def put_file_id(self, url: str, media_type: str, file_id: str) -> None:
+        """Store one file_id as just used; ``save_file_ids`` trims the table."""
+        with self._transaction():
+            self._conn.execute(
+                'INSERT INTO file_ids VALUES (?, ?, ?, ?) ON CONFLICT(url) DO UPDATE '
+                'SET media_type = excluded.media_type, file_id = excluded.file_id, used_at = excluded.used_at',
+                (url, media_type, file_id, time.time()),
+            )
+    
+    def discard_file_id(self, url: str) -> None:
+        """Forget a file_id Telegram rejected, so no process restores it."""
+        with self._transaction():
+            self._conn.execute('DELETE FROM file_ids WHERE url = ?', (url,))
+    
+    def load_file_ids(self, max_entries: int) -> List[Tuple[str, str, str]]:
+        """The ``max_entries`` most recently used file_ids, least recently used first."""
+        rows = self._conn.execute(
+            'SELECT url, media_type, file_id FROM file_ids ORDER BY used_at DESC LIMIT ?', (max_entries,)
+        ).fetchall()
+        rows.reverse()
+        return rows
+    
+    def save_chat_subreddits(self, chat_id: int, subreddits: Sequence[str]) -> None:
+        """Store a chat's subreddit list (empty for the defaults) as the latest change."""
+        with self._transaction():
+            self._conn.execute(
+                'INSERT INTO chat_subreddits VALUES (?, ?, (SELECT COALESCE(MAX(change), 0) + 1 FROM chat_subreddits)) '
+                'ON CONFLICT(chat_id) DO UPDATE SET subreddits = excluded.subreddits, change = excluded.change',
+                (chat_id, ','.join(subreddits)),
+            )
+    
+    def load_chat_subreddits(self, since: int = 0) -> Tuple[Dict[int, Tuple[str, ...]], int]:
+        """
+        Read the chat subreddit lists changed after change number ``since``.
         
         Returns:
-            Dictionary containing meme data or None if no meme found
+            The changed lists by chat (empty tuples for chats reset to the
+            defaults) and the latest change number, to pass as ``since`` next
         """
-        # Try Reddit first
-        meme = self._try_reddit_meme()
+        rows = self._conn.execute(
+            'SELECT chat_id, subreddits, change FROM chat_subreddits WHERE change > ? ORDER BY change', (since,)
+        ).fetchall()
+        changes = {chat_id: tuple(filter(None, subreddits.split(','))) for chat_id, subreddits, _ in rows}
+        return changes, rows[-1][2] if rows else since
+    
+    def add_draws(self, draws: Dict[str, int]) -> None:
+        """Add per-subreddit /meme draw counts for the fetcher to collect."""
+        with self._transaction():
+            self._conn.executemany(
+                'INSERT INTO subreddit_draws VALUES (?, ?) ON CONFLICT(subreddit) DO UPDATE '
+                'SET draws = draws + excluded.draws',
+                draws.items(),
+            )
+    
+    def take_draws(self) -> Dict[str, int]:
+        """Collect and clear the draw counts added since the last call."""
+        with self._transaction():
+            draws = dict(self._conn.execute('SELECT subreddit, draws FROM subreddit_draws'))
+            self._conn.execute('DELETE FROM subreddit_draws')
+        return draws
+    
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        """Run statements in one transaction (a consistent snapshot for readers)."""
+        self._conn.execute('BEGIN')
+        try:
+            yield
+        except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+        self._conn.execute('COMMIT')
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of making a request to a source whose circuit is open."""
+
+
+class CircuitBreaker:
+    """
+    Tracks the health of one upstream source and decides whether to call it.
+    
+    The circuit opens after ``failure_threshold`` consecutive failures, or
+    immediately on an HTTP 429. While open, requests are refused without
+    touching the network. Once the cooldown elapses a single half-open
+    probe is let through: success closes the circuit, failure reopens it
+    with the cooldown doubled (up to ``max_cooldown``).
+    """
+    
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+    
+    def __init__(self, name: str, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 base_cooldown: float = CIRCUIT_BASE_COOLDOWN, max_cooldown: float = CIRCUIT_MAX_COOLDOWN):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+        self.state = self.CLOSED
+        self.cooldown = base_cooldown
+        self.opened_at = 0.0
+        self.consecutive_failures = 0
+        self.successes = 0
+        self.failures = 0
+        self.rate_limited = 0
+        self.rejected = 0
+        self.trips = 0
+        self.last_error = ''
+        self._probe_in_flight = False
+    
+    def retry_in(self, now: Optional[float] = None) -> float:
+        """Seconds until an open circuit allows a probe."""
+        if self.state != self.OPEN:
+            return 0.0
+        now = now if now is not None else time.monotonic()
+        return max(0.0, self.opened_at + self.cooldown - now)
+    
+    def allow_request(self, now: Optional[float] = None) -> bool:
+        """Return True if a request may be made now."""
+        if self.state == self.CLOSED:
+            return True
+        
+        if self.state == self.OPEN and self.retry_in(now) == 0.0:
+            self.state = self.HALF_OPEN
+        
+        if self.state == self.HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        
+        self.rejected += 1
+        return False
+    
+    def record_success(self) -> None:
+        """Close the circuit after a successful request."""
+        self.successes += 1
+        self.consecutive_failures = 0
+        self.cooldown = self.base_cooldown
+        self._probe_in_flight = False
+        if self.state != self.CLOSED:
+            logger.info("Circuit for %s closed", self.name)
+        self.state = self.CLOSED
+    
+    def record_failure(self, error: str, rate_limited: bool = False,
+                       retry_after: Optional[float] = None) -> None:
+        """Count a failed request and open the circuit if warranted."""
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.last_error = error
+        if rate_limited:
+            self.rate_limited += 1
+        
+        if self.state == self.HALF_OPEN:
+            # Failed probe: back off exponentially
+            self._open(min(self.cooldown * 2, self.max_cooldown), retry_after)
+        elif rate_limited or self.consecutive_failures >= self.failure_threshold:
+            self._open(self.cooldown, retry_after)
+    
+    def release_probe(self) -> None:
+        """Give back a half-open probe slot whose request was cancelled."""
+        self._probe_in_flight = False
+    
+    def _open(self, cooldown: float, retry_after: Optional[float]) -> None:
+        if retry_after:
+            cooldown = min(max(cooldown, retry_after), self.max_cooldown)
+        self.cooldown = cooldown
+        self.opened_at = time.monotonic()
+        self._probe_in_flight = False
+        if self.state != self.OPEN:
+            self.trips += 1
+        self.state = self.OPEN
+        logger.warning("Circuit for %s opened for %.0fs: %s", self.name, cooldown, self.last_error)
+
+
+class SourceHealth:
+    """Registry of circuit breakers, one per source endpoint."""
+    
+    def __init__(self):
+        self.breakers: Dict[str, CircuitBreaker] = {}
+    
+    def breaker(self, name: str) -> CircuitBreaker:
+        """Get the breaker for a source, creating it on first use."""
+        breaker = self.breakers.get(name)
+        if breaker is None:
+            breaker = CircuitBreaker(name)
+            self.breakers[name] = breaker
+        return breaker
+    
+    def scoreboard(self) -> str:
+        """Render a plain-text table of every breaker's state and counters."""
+        if not self.breakers:
+            return 'No requests made yet.'
+        
+        now = time.monotonic()
+        lines = [f"{'source':<14}{'state':<10}{'ok':>6}{'fail':>6}{'429':>5}{'trips':>6}{'retry':>7}"]
+        for name in sorted(self.breakers):
+            b = self.breakers[name]
+            retry = f"{b.retry_in(now):.0f}s" if b.state == CircuitBreaker.OPEN else '-'
+            lines.append(f"{name:<14}{b.state:<10}{b.successes:>6}{b.failures:>6}"
+                         f"{b.rate_limited:>5}{b.trips:>6}{retry:>7}")
+        return '\n'.join(lines)
+    
+    def snapshot(self) -> List[tuple]:
+        """Every breaker as a row for ``SharedMemeStore.save_breakers``; open_until is wall-clock time."""
+        offset = time.time() - time.monotonic()
+        rows = []
+        for b in self.breakers.values():
+            open_until = b.opened_at + b.cooldown + offset if b.state != CircuitBreaker.CLOSED else 0.0
+            rows.append((b.name, b.state, b.cooldown, open_until, b.consecutive_failures, b.successes,
+                         b.failures, b.rate_limited, b.rejected, b.trips, b.last_error))
+        return rows
+    
+    def restore(self, rows: Iterable[tuple]) -> None:
+        """
+        Load breakers saved by ``snapshot``.
+        
+        A circuit that was open (or probing) comes back open until its saved
+        ``open_until``; one whose cooldown has since passed allows a probe
+        straight away.
+        """
+        offset = time.time() - time.monotonic()
+        for (name, state, cooldown, open_until, consecutive_failures, successes,
+             failures, rate_limited, rejected, trips, last_error) in rows:
+            b = self.breaker(name)
+            b.cooldown = cooldown
+            b.consecutive_failures = consecutive_failures
+            b.successes, b.failures, b.rate_limited = successes, failures, rate_limited
+            b.rejected, b.trips, b.last_error = rejected, trips, last_error
+            if state != CircuitBreaker.CLOSED:
+                b.state = CircuitBreaker.OPEN
+                b.opened_at = open_until - offset - cooldown
+
+
+class TokenBucket:
+    """
+    Classic token bucket: ``rate`` tokens per second, holding at most ``capacity``.
+    
+    Tokens may be reserved ahead of time, driving the balance negative;
+    ``reserve`` then reports how long the caller has to wait for its turn.
+    """
+    
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def wait_time(self, now: Optional[float] = None) -> float:
+        """Seconds until one token is available (0 if one is available now)."""
+        self._refill(now if now is not None else time.monotonic())
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+    
+    def try_acquire(self, now: Optional[float] = None) -> bool:
+        """Take a token if one is available now."""
+        if self.wait_time(now) > 0:
+            return False
+        self.tokens -= 1
+        return True
+    
+    def reserve(self, now: Optional[float] = None) -> float:
+        """Take a token, possibly in advance; return the seconds to wait before using it."""
+        delay = self.wait_time(now)
+        self.tokens -= 1
+        return delay
+
+
+class CommandRateLimiter:
+    """
+    Per-user and per-chat token buckets for bot commands.
+    
+    A command that is over its limit by at most ``max_wait`` seconds is
+    queued (the caller sleeps for the returned delay); anything further
+    over is rejected outright. Buckets live in an LRU of ``max_keys``.
+    """
+    
+    def __init__(self, user_rate: float = USER_RATE_PER_MINUTE, user_burst: int = USER_BURST,
+                 chat_rate: float = CHAT_RATE_PER_MINUTE, chat_burst: int = CHAT_BURST,
+                 max_wait: float = RATE_LIMIT_MAX_WAIT, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.user_rate = user_rate / 60.0
+        self.user_burst = user_burst
+        self.chat_rate = chat_rate / 60.0
+        self.chat_burst = chat_burst
+        self.max_wait = max_wait
+        self.max_keys = max_keys
+        self._buckets: 'OrderedDict[Tuple[str, int], TokenBucket]' = OrderedDict()
+        self._notified: Dict[int, float] = {}
+    
+    def _bucket(self, kind: str, key: int, rate: float, burst: int) -> TokenBucket:
+        bucket = self._buckets.get((kind, key))
+        if bucket is None:
+            bucket = TokenBucket(rate, burst)
+            self._buckets[(kind, key)] = bucket
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end((kind, key))
+        return bucket
+    
+    def acquire(self, user_id: Optional[int], chat_id: int) -> Optional[float]:
+        """
+        Admit a command from a user in a chat.
+        
+        Returns:
+            Seconds to wait before running the command (0 to run now),
+            or None if it should be rejected
+        """
+        now = time.monotonic()
+        buckets = [self._bucket('chat', chat_id, self.chat_rate, self.chat_burst)]
+        if user_id is not None:
+            buckets.append(self._bucket('user', user_id, self.user_rate, self.user_burst))
+        
+        delay = max(bucket.wait_time(now) for bucket in buckets)
+        if delay > self.max_wait:
+            return None
+        
+        return max(bucket.reserve(now) for bucket in buckets)
+    
+    def should_notify(self, chat_id: int, interval: float = 30.0) -> bool:
+        """True at most once per ``interval`` seconds per chat, to avoid replying to spam."""
+        now = time.monotonic()
+        if now - self._notified.get(chat_id, float('-inf')) < interval:
+            return False
+        self._notified[chat_id] = now
+        if len(self._notified) > self.max_keys:
+            self._notified.clear()
+        return True
+
+
+class UpstreamBudgetExceeded(Exception):
+    """Raised instead of making a request when the global upstream budget is spent."""
+
+
+class SubredditUnavailable(Exception):
+    """Raised when Reddit reports a subreddit missing, private or banned (or NSFW, when checking one)."""
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key into one running task.
+    
+    Callers asking for a key that is already in flight share its result
+    instead of starting a duplicate fetch.
+    """
+    
+    def __init__(self):
+        self._tasks: Dict[Any, asyncio.Task] = {}
+    
+    def start(self, key: Any, factory: Callable[[], Awaitable[Any]]) -> asyncio.Task:
+        """Return the running task for ``key``, starting ``factory()`` if there is none."""
+        task = self._tasks.get(key)
+        if task is None or task.done():
+            task = asyncio.get_running_loop().create_task(factory())
+            self._tasks[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        return task
+    
+    async def do(self, key: Any, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Await the shared result for ``key``.
+        
+        Shielded, so a cancelled caller doesn't abort the call for others.
+        """
+        return await asyncio.shield(self.start(key, factory))
+    
+    def cancel_all(self) -> None:
+        """Cancel every call in flight."""
+        for task in list(self._tasks.values()):
+            task.cancel()
+        self._tasks.clear()
+    
+    def _forget(self, key: Any, task: asyncio.Task) -> None:
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if not task.cancelled() and task.exception() is not None:
+            logger.debug("Coalesced call %r failed: %s", key, task.exception())
+
+
+class ValidatedResponse(NamedTuple):
+    """Validators and parse result of the last full response from one endpoint."""
+    
+    etag: str
+    last_modified: str
+    payload: Any
+    known: Dict[str, Optional[Meme]]
+    body_bytes: int
+    parse_seconds: float
+
+
+class ConditionalStats:
+    """Counters for the work saved by conditional requests and post reuse."""
+    
+    def __init__(self):
+        self.requests = 0
+        self.not_modified = 0
+        self.bytes_saved = 0
+        self.parse_seconds_saved = 0.0
+        self.posts_reused = 0
+        self.posts_parsed = 0
+    
+    def summary(self) -> str:
+        """One line for the /health report."""
+        return (f"conditional GETs: {self.not_modified}/{self.requests} not modified, "
+                f"{self.bytes_saved / 1024:.0f} KiB and {self.parse_seconds_saved * 1000:.0f}ms parse saved, "
+                f"{self.posts_reused}/{self.posts_reused + self.posts_parsed} posts reused")
+
+
+class Metric:
+    """
+    Base for a labelled metric in the Prometheus text format.
+    
+    Values are kept per tuple of label values. A metric built with
+    ``collect`` reads its values from that callback at scrape time instead.
+    """
+    
+    kind = 'untyped'
+    
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 collect: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.collect = collect
+        self._values: Dict[Tuple[str, ...], float] = {}
+    
+    def samples(self) -> Iterator[Tuple[str, Tuple[Tuple[str, str], ...], float]]:
+        """Yield ``(sample name, label pairs, value)`` for rendering."""
+        values = self.collect() if self.collect is not None else self._values
+        for key, value in values.items():
+            yield self.name, tuple(zip(self.labels, key)), value
+
+
+class Counter(Metric):
+    """Monotonically increasing count."""
+    
+    kind = 'counter'
+    
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+
+class Gauge(Metric):
+    """Value that can go up and down."""
+    
+    kind = 'gauge'
+    
+    def set(self, value: float, *labels: str) -> None:
+        self._values[labels] = value
+
+
+class Histogram(Metric):
+    """Distribution of observed values over fixed cumulative buckets."""
+    
+    kind = 'histogram'
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        self._counts: Dict[Tuple[str, ...], List[int]] = {}
+        self._sums: Dict[Tuple[str, ...], float] = {}
+    
+    def observe(self, value: float, *labels: str) -> None:
+        counts = self._counts.get(labels)
+        if counts is None:
+            counts = self._counts[labels] = [0] * (len(self.buckets) + 1)
+            self._sums[labels] = 0.0
+        counts[bisect_left(self.buckets, value)] += 1
+        self._sums[labels] += value
+    
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        """Observe the wall time spent in the block."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+    
+    def samples(self) -> Iterator[Tuple[str, Tuple[Tuple[str, str], ...], float]]:
+        for key, counts in self._counts.items():
+            pairs = tuple(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield f"{self.name}_bucket", pairs + (('le', le),), cumulative
+            yield f"{self.name}_sum", pairs, self._sums[key]
+            yield f"{self.name}_count", pairs, cumulative
+
+
+class MetricsRegistry:
+    """The process's metrics, rendered for the /metrics endpoint."""
+    
+    def __init__(self):
+        self._metrics: List[Metric] = []
+    
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+    
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, pairs, value in metric.samples():
+                if pairs:
+                    labels = ','.join(f'{key}="{_escape_label(str(val))}"' for key, val in pairs)
+                    lines.append(f"{name}{{{labels}}} {value:g}")
+                else:
+                    lines.append(f"{name} {value:g}")
+        return '\n'.join(lines) + '\n'
+
+
+def _escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Trace:
+    """
+    Span timings for one command, rendered as a single log line.
+    
+    Spans are opened with ``span()`` from anywhere in the command's task (or
+    tasks it starts), found through a context variable. Spans that end after
+    the trace has finished, e.g. from a background refresh, are dropped.
+    """
+    
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans: List[Tuple[str, float, float]] = []
+        self.total = 0.0
+        self.finished = False
+    
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        """Time the block as a span starting at its offset into the trace."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            if not self.finished:
+                self.spans.append((name, started - self.started, time.perf_counter() - started))
+    
+    def finish(self) -> None:
+        self.total = time.perf_counter() - self.started
+        self.finished = True
+    
+    def render(self) -> str:
+        """e.g. ``/meme 812ms: rate_limit +0ms 0ms, fetch +1ms 640ms, ...``"""
+        spans = ', '.join(f"{name} +{offset * 1000:.0f}ms {duration * 1000:.0f}ms"
+                          for name, offset, duration in sorted(self.spans, key=lambda span: span[1]))
+        return f"{self.name} {self.total * 1000:.0f}ms: {spans}"
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar('current_trace', default=None)
+recent_traces: 'deque[str]' = deque(maxlen=TRACE_HISTORY)
+
+
+def span(name: str):
+    """Context manager timing a span of the current command's trace, if it is traced."""
+    trace = _current_trace.get()
+    return trace.span(name) if trace is not None else nullcontext()
+
+
+metrics = MetricsRegistry()
+SOURCE_LATENCY = metrics.register(Histogram(
+    'meme_source_request_seconds', 'Upstream request latency, from sending the request to reading the body', ['source']))
+SOURCE_REQUESTS = metrics.register(Counter(
+    'meme_source_requests_total', 'Upstream requests by outcome', ['source', 'outcome']))
+PARSE_SECONDS = metrics.register(Histogram(
+    'meme_parse_seconds', 'Time spent decoding and parsing JSON responses', ['source'],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)))
+TIER_RESULTS = metrics.register(Counter(
+    'meme_tier_results_total', 'Fallback tier attempts on a pool miss by outcome', ['tier', 'outcome']))
+MEMES_SERVED = metrics.register(Counter(
+    'meme_served_total', 'Memes served by where they came from', ['origin']))
+POOL_LOOKUPS = metrics.register(Counter(
+    'meme_pool_lookups_total', 'Pool lookups by result (hit or miss)', ['result']))
+FILE_ID_LOOKUPS = metrics.register(Counter(
+    'telegram_file_id_cache_lookups_total', 'file_id cache lookups by result (hit or miss)', ['result']))
+TELEGRAM_SEND_SECONDS = metrics.register(Histogram(
+    'telegram_send_seconds', 'Telegram send call latency', ['method', 'via']))
+COMMAND_SECONDS = metrics.register(Histogram(
+    'meme_command_seconds', 'End-to-end /meme handling time', ['outcome']))
+INLINE_QUERY_SECONDS = metrics.register(Histogram(
+    'meme_inline_query_seconds', 'Inline query handling time', ['outcome']))
+RENDER_SECONDS = metrics.register(Histogram(
+    'meme_render_seconds', 'Template render time in the process pool'))
+RENDERS = metrics.register(Counter(
+    'meme_renders_total', '/make memes by how they were served (file_id, cached, rendered)', ['result']))
+MEDIA_CACHE_DOWNLOADS = metrics.register(Counter(
+    'meme_media_cache_downloads_total', 'Media downloads into the on-disk cache by outcome', ['outcome']))
+MEDIA_VALIDATIONS = metrics.register(Counter(
+    'meme_media_validations_total', 'Media URL checks before pool admission by result', ['result']))
+DEDUP_RESULTS = metrics.register(Counter(
+    'meme_dedup_total', 'Pool admission deduplication by result (unique, duplicate, unhashed)', ['result']))
+REFRESH_LATENESS = metrics.register(Histogram(
+    'meme_refresh_lateness_seconds', 'How long after falling due each scheduled pool refresh started',
+    buckets=(0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0)))
+EVENT_LOOP_LAG = metrics.register(Histogram(
+    'event_loop_lag_seconds', 'How late the event loop woke a periodic timer',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)))
+
+
+async def monitor_event_loop_lag(interval: float = EVENT_LOOP_LAG_INTERVAL) -> None:
+    """Sample event loop lag forever: how much later than asked a sleep returns."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0.0, loop.time() - started - interval))
+
+
+async def _serve_metrics_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """Answer one GET /metrics or /traces request and close the connection."""
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        path = request_line.split()[1].decode('latin-1') if len(request_line.split()) > 1 else '/'
+        
+        if path == '/metrics':
+            status, body = '200 OK', metrics.render()
+        elif path == '/traces':
+            status, body = '200 OK', '\n'.join(recent_traces) + '\n'
+        else:
+            status, body = '404 Not Found', 'Not found\n'
+        
+        payload = body.encode()
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload
+        )
+        await writer.drain()
+    except (ConnectionError, IndexError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host: str = METRICS_LISTEN, port: int = METRICS_PORT) -> asyncio.AbstractServer:
+    """Serve /metrics and /traces on ``host:port``."""
+    server = await asyncio.start_server(_serve_metrics_request, host, port)
+    logger.info("Serving metrics on http://%s:%s/metrics", host, port)
+    return server
+
+
+# Content types (prefixes) a URL of each kind must answer with to be sendable
+_ACCEPTED_CONTENT_TYPES = {
+    MediaKind.IMAGE: ('image/',),
+    MediaKind.GIF: ('image/gif', 'video/mp4'),
+    MediaKind.VIDEO: ('video/',),
+}
+
+
+def _content_size(headers: httpx.Headers) -> Optional[int]:
+    """Full size of a resource from a HEAD or range GET response, if known."""
+    # 'bytes 0-0/123456' on a 206, Content-Length otherwise
+    total = headers.get('content-range', '').rpartition('/')[2]
+    if total.isdigit():
+        return int(total)
+    length = headers.get('content-length', '')
+    return int(length) if length.isdigit() else None
+
+
+def media_verdict(kind: MediaKind, response: httpx.Response) -> str:
+    """
+    Judge whether Telegram could send a probed media URL.
+    
+    Returns:
+        'ok', 'rejected_status' (4xx), 'unavailable' (5xx), 'rejected_type'
+        (e.g. an HTML album page) or 'rejected_size' (over Telegram's limit)
+    """
+    if response.status_code >= 500:
+        return 'unavailable'
+    if not response.is_success:
+        return 'rejected_status'
+    
+    content_type = response.headers.get('content-type', '').partition(';')[0].strip().lower()
+    if not content_type.startswith(_ACCEPTED_CONTENT_TYPES[kind]):
+        return 'rejected_type'
+    
+    size = _content_size(response.headers)
+    limit = TELEGRAM_PHOTO_URL_LIMIT if kind is MediaKind.IMAGE else TELEGRAM_FILE_URL_LIMIT
+    if size is not None and size > limit:
+        return 'rejected_size'
+    return 'ok'
+
+
+class MediaValidator:
+    """
+    Admission check that keeps undeliverable media out of the pools.
+    
+    Each URL is probed as Telegram would fetch it (after ``delivery_url``),
+    with a HEAD request or, for hosts that refuse HEAD, a one-byte range
+    GET, at most ``concurrency`` at a time; concurrent checks of one URL
+    share a single probe. Verdicts are cached per URL, except for 5xx
+    answers and unreachable hosts: the former are rejected and retried on
+    the next refresh, the latter admitted, since our own network failing
+    says nothing about Telegram's.
+    """
+    
+    def __init__(self, client: httpx.AsyncClient, concurrency: int = MEDIA_VALIDATION_CONCURRENCY,
+                 timeout: float = MEDIA_VALIDATION_TIMEOUT, max_entries: int = MEDIA_VALIDATION_CACHE_SIZE):
+        self.client = client
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._verdicts: 'OrderedDict[str, bool]' = OrderedDict()
+        self._flights = SingleFlight()
+    
+    def __len__(self) -> int:
+        return len(self._verdicts)
+    
+    def cancel_all(self) -> None:
+        """Cancel every probe in flight."""
+        self._flights.cancel_all()
+    
+    async def filter(self, memes: Sequence[Meme]) -> list:
+        """Return the deliverable memes, in their original order."""
+        if not memes:
+            return []
+        with span('validate'):
+            verdicts = await asyncio.gather(*(self.is_deliverable(meme.url) for meme in memes))
+        admitted = [meme for meme, ok in zip(memes, verdicts) if ok]
+        if len(admitted) < len(memes):
+            logger.debug("Media validation dropped %s of %s memes", len(memes) - len(admitted), len(memes))
+        return admitted
+    
+    async def is_deliverable(self, url: str) -> bool:
+        """True if Telegram should be able to send the media at ``url``."""
+        verdict = self._verdicts.get(url)
+        if verdict is not None:
+            self._verdicts.move_to_end(url)
+            MEDIA_VALIDATIONS.inc('cached')
+            return verdict
+        return await self._flights.do(url, lambda: self._validate(url))
+    
+    async def _validate(self, url: str) -> bool:
+        async with self._semaphore:
+            result = await self._probe(url)
+        MEDIA_VALIDATIONS.inc(result)
+        
+        if result == 'unreachable':
+            return True
+        if result == 'unavailable':
+            return False
+        
+        self._verdicts[url] = result == 'ok'
+        while len(self._verdicts) > self.max_entries:
+            self._verdicts.popitem(last=False)
+        return result == 'ok'
+    
+    async def _probe(self, url: str) -> str:
+        kind = classify_media_url(url)
+        if kind is None:
+            return 'rejected_type'
+        
+        target = delivery_url(url)
+        try:
+            response = await self.client.head(target, timeout=self.timeout)
+            if response.status_code in (403, 405, 501) or 'content-type' not in response.headers:
+                # Only the headers are needed; the body is never read
+                async with self.client.stream('GET', target, headers={'Range': 'bytes=0-0'},
+                                              timeout=self.timeout) as response:
+                    pass
+        except httpx.HTTPError as e:
+            logger.debug("Could not probe %s: %s", target, e)
+            return 'unreachable'
+        return media_verdict(kind, response)
+
+
+class MediaDeduplicator:
+    """
+    Admission stage that collapses reposts of one image into a single meme.
+    
+    Each candidate image (GIFs by their first frame; videos pass through) is
+    downloaded, at most ``concurrency`` at a time, and reduced to a
+    perceptual hash in a worker thread. Hashes are cached per URL, so a
+    refresh only downloads new posts. The first URL seen with a picture owns
+    it in a ``MultiIndexHashTable``; memes under other URLs whose hash is
+    within ``max_distance`` bits of it are dropped. Images that can't be
+    downloaded or decoded are admitted unhashed.
+    """
+    
+    def __init__(self, client: httpx.AsyncClient, concurrency: int = DEDUP_CONCURRENCY,
+                 max_distance: int = DEDUP_MAX_DISTANCE, max_bytes: int = DEDUP_MAX_BYTES,
+                 capacity: int = DEDUP_INDEX_SIZE, max_entries: int = DEDUP_CACHE_SIZE):
+        self.client = client
+        self.concurrency = concurrency
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.index = image_hash.MultiIndexHashTable(max_distance, capacity=capacity)
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._hashes: 'OrderedDict[str, Optional[int]]' = OrderedDict()
+        self._flights = SingleFlight()
+    
+    def cancel_all(self) -> None:
+        """Cancel every download in flight."""
+        self._flights.cancel_all()
+    
+    async def filter(self, memes: Sequence[Meme]) -> list:
+        """Return the memes that aren't reposts of an image seen under another URL, in order."""
+        if not memes:
+            return []
+        with span('dedup'):
+            hashes = await asyncio.gather(*(self.hash_of(meme.url) for meme in memes))
+        
+        # Claimed in listing order, so the first of several reposts in one listing wins
+        admitted = []
+        for meme, value in zip(memes, hashes):
+            if value is None:
+                DEDUP_RESULTS.inc('unhashed')
+                admitted.append(meme)
+            elif self._claim(meme.url, value):
+                DEDUP_RESULTS.inc('unique')
+                admitted.append(meme)
+            else:
+                DEDUP_RESULTS.inc('duplicate')
+        if len(admitted) < len(memes):
+            logger.debug("Deduplication dropped %s of %s memes", len(memes) - len(admitted), len(memes))
+        return admitted
+    
+    def _claim(self, url: str, value: int) -> bool:
+        """True if ``url`` owns its picture, registering it if the picture is new."""
+        key = int.from_bytes(hashlib.blake2b(url.encode(), digest_size=8).digest(), 'big')
+        found = self.index.nearest(value)
+        if found is None:
+            self.index.add(value, key)
+            return True
+        return found[0] == key
+    
+    async def hash_of(self, url: str) -> Optional[int]:
+        """Perceptual hash of the image at ``url``, or None for media that isn't hashed."""
+        if url in self._hashes:
+            self._hashes.move_to_end(url)
+            return self._hashes[url]
+        return await self._flights.do(url, lambda: self._hash(url))
+    
+    async def _hash(self, url: str) -> Optional[int]:
+        if classify_media_url(url) not in (MediaKind.IMAGE, MediaKind.GIF):
+            value = None
+        else:
+            try:
+                async with self._semaphore:
+                    data = await self._download(delivery_url(url))
+            except httpx.HTTPError as e:
+                # Not cached: the next refresh tries again
+                logger.debug("Could not download %s for hashing: %s", url, e)
+                return None
+            value = None
+            if data is not None:
+                loop = asyncio.get_running_loop()
+                value = await loop.run_in_executor(None, image_hash.dhash, data)
+        
+        self._hashes[url] = value
+        while len(self._hashes) > self.max_entries:
+            self._hashes.popitem(last=False)
+        return value
+    
+    async def _download(self, url: str) -> Optional[bytes]:
+        """The body at ``url``, or None if it is over ``max_bytes``."""
+        chunks = []
+        size = 0
+        with span('download'):
+            async with self.client.stream('GET', url) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes(MEDIA_CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        return None
+                    chunks.append(chunk)
+        return b''.join(chunks)
+
+
+class MemePool:
+    """In-memory cache of the latest media posts for one subreddit."""
+    
+    def __init__(self, subreddit: str, ttl: float = POOL_TTL, stale_ttl: float = POOL_STALE_TTL):
+        self.subreddit = subreddit
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.memes = MemeStore()
+        self.index = TitleIndex(self.memes)
+        self.fetched_at = 0.0
+    
+    def __len__(self) -> int:
+        return len(self.memes)
+    
+    def age(self, now: Optional[float] = None) -> float:
+        """Seconds since the pool was last filled."""
+        return (now if now is not None else time.monotonic()) - self.fetched_at
+    
+    def is_fresh(self, now: Optional[float] = None) -> bool:
+        """True if the pool can be served without revalidation."""
+        return bool(self.memes) and self.age(now) < self.ttl
+    
+    def is_usable(self, now: Optional[float] = None) -> bool:
+        """True if the pool may still be served while it is revalidated."""
+        return bool(self.memes) and self.age(now) < self.stale_ttl
+    
+    def replace(self, memes: Iterable[Meme], fetched_at: Optional[float] = None) -> None:
+        """Swap in a listing fetched at ``fetched_at`` (monotonic time, default now)."""
+        self.memes = MemeStore(memes)
+        self.index = TitleIndex(self.memes)
+        self.fetched_at = fetched_at if fetched_at is not None else time.monotonic()
+    
+    def sample(self) -> Optional[Meme]:
+        """Pick a random meme from the pool, or None if it is empty."""
+        return self.memes.sample()
+
+
+class SubredditRefresh:
+    """Refresh schedule and statistics for one subreddit (see ``RefreshScheduler``)."""
+    
+    __slots__ = ('subreddit', 'due', 'interval', 'weight', 'refreshing', 'refreshed_at', 'failures',
+                 'quarantined_until', 'demand', 'demand_at', 'change_rate', 'limit', 'changed', 'unchanged',
+                 'failed', 'lateness')
+    
+    def __init__(self, subreddit: str, now: float):
+        self.subreddit = subreddit
+        self.due = now
+        # Seconds between refreshes
+        self.interval = 0.0
+        # Share of the budget, relative to the others' (0 while idle)
+        self.weight = 0.0
+        self.refreshing = False
+        self.refreshed_at: Optional[float] = None
+        self.failures = 0
+        # Monotonic time until which Reddit is taken to have no such subreddit
+        self.quarantined_until = 0.0
+        # Draws counted so far, decayed to demand_at
+        self.demand = 0.0
+        self.demand_at = now
+        # Share of the listing that is new per second, None until measured
+        self.change_rate: Optional[float] = None
+        self.limit = REFRESH_LISTING_LIMITS[len(REFRESH_LISTING_LIMITS) // 2]
+        self.changed = 0
+        self.unchanged = 0
+        self.failed = 0
+        self.lateness = 0.0
+
+
+class RefreshScheduler:
+    """
+    Decides when each subreddit's listing is refreshed, within a request budget.
+    
+    Every subreddit gets its own interval, from its demand (a decaying
+    count of /meme draws) and the share of its listing that is new per
+    second (measured at each refresh; a 304 finds nothing new). A pool
+    refreshed every T seconds misses on average about change x T / 2 of
+    its listing's current posts, so the draw-weighted share missed across
+    all pools, for a given number of refreshes per second, is smallest
+    with T proportional to 1 / sqrt(draws x change). Intervals follow that
+    rule, scaled so they spend the budget, and are clamped to
+    ``min_interval``..``max_interval``.
+    
+    A subreddit drawn from no more than ``draws_per_refresh`` times per
+    ``max_interval``, or whose listing doesn't change, is idle: idle ones
+    share up to a tenth of the budget, refreshing every ``max_interval``
+    or less often if there are too many, so thousands of them neither
+    starve the busy ones nor all expire together.
+    
+    Due refreshes wait in a heap ordered by due time and start no faster
+    than ``rate_per_minute``. A failed refresh is retried after
+    ``min_interval``, doubling per consecutive failure. A subreddit Reddit
+    reports missing is quarantined instead: left alone, and not drawn from,
+    for ``quarantine_period`` seconds.
+    """
+    
+    # Weight of the newest sample in the change rate's moving average
+    CHANGE_WEIGHT = 0.3
+    # Most of the budget idle subreddits may claim from the drawn-from ones
+    IDLE_SHARE = 0.1
+    
+    def __init__(self, rate_per_minute: float = UPSTREAM_RATE_PER_MINUTE * REFRESH_BUDGET_SHARE,
+                 burst: float = max(1.0, UPSTREAM_BURST * REFRESH_BUDGET_SHARE),
+                 min_interval: float = REFRESH_MIN_INTERVAL, max_interval: float = REFRESH_MAX_INTERVAL,
+                 concurrency: int = REFRESH_CONCURRENCY, half_life: float = REFRESH_DEMAND_HALF_LIFE,
+                 change_prior: float = REFRESH_CHANGE_PRIOR,
+                 draws_per_refresh: float = REFRESH_DRAWS_PER_REFRESH,
+                 quarantine_period: float = SUBREDDIT_QUARANTINE):
+        self.rate = rate_per_minute / 60.0
+        self.budget = TokenBucket(self.rate, burst)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.concurrency = concurrency
+        self.half_life = half_life
+        self.change_prior = change_prior
+        self.draws_per_refresh = draws_per_refresh
+        self.quarantine_period = quarantine_period
+        self.entries: Dict[str, SubredditRefresh] = {}
+        self.running = False
+        self._queue: List[Tuple[float, str]] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._weight_sum = 0.0
+        self._idle = 0
+    
+    def __len__(self) -> int:
+        return len(self.entries)
+    
+    def add(self, subreddit: str, refreshed_at: Optional[float] = None, now: Optional[float] = None) -> None:
+        """
+        Schedule a subreddit, or reschedule it from a pool restored elsewhere.
+        
+        Args:
+            subreddit: Subreddit to schedule
+            refreshed_at: Monotonic time its pool was last filled; without it
+                the first refresh is due now
+        """
+        now = now if now is not None else time.monotonic()
+        entry = self.entries.get(subreddit)
+        if entry is None:
+            entry = self.entries[subreddit] = SubredditRefresh(subreddit, now)
+            self._idle += 1
+        if refreshed_at is not None:
+            entry.refreshed_at = refreshed_at
+        if not entry.refreshing:
+            self._schedule(entry, now)
+    
+    def remove(self, subreddit: str) -> None:
+        """Stop refreshing a subreddit; a refresh already running finishes unrecorded."""
+        entry = self.entries.pop(subreddit, None)
+        if entry is None:
+            return
+        if entry.weight:
+            self._weight_sum = max(0.0, self._weight_sum - entry.weight)
+        else:
+            self._idle -= 1
+    
+    def record_draw(self, subreddit: str, count: int = 1, now: Optional[float] = None) -> None:
+        """
+        Count /meme draws from a subreddit.
+        
+        If the extra demand shortens its interval enough, the next refresh
+        is brought forward.
+        """
+        entry = self.entries.get(subreddit)
+        if entry is None:
+            return
+        now = now if now is not None else time.monotonic()
+        entry.demand = self._decayed_demand(entry, now) + count
+        entry.demand_at = now
+        if entry.refreshing or entry.refreshed_at is None or entry.quarantined_until > now:
+            return
+        
+        previous = entry.interval
+        self._update_interval(entry, now)
+        due = max(now, entry.refreshed_at + entry.interval)
+        if due < entry.due - 0.1 * previous:
+            self._push(entry, due)
+    
+    def quarantine(self, subreddit: str, now: Optional[float] = None) -> None:
+        """Stop refreshing a subreddit Reddit reported missing for ``quarantine_period`` seconds."""
+        entry = self.entries.get(subreddit)
+        if entry is None:
+            return
+        now = now if now is not None else time.monotonic()
+        entry.quarantined_until = now + self.quarantine_period
+        if not entry.refreshing:
+            self._schedule(entry, now)
+    
+    def is_quarantined(self, subreddit: str, now: Optional[float] = None) -> bool:
+        """True if Reddit recently reported the subreddit missing, private or banned."""
+        entry = self.entries.get(subreddit)
+        if entry is None:
+            return False
+        return entry.quarantined_until > (now if now is not None else time.monotonic())
+    
+    def quarantined(self, now: Optional[float] = None) -> int:
+        """Number of subreddits in quarantine."""
+        now = now if now is not None else time.monotonic()
+        return sum(1 for entry in self.entries.values() if entry.quarantined_until > now)
+    
+    def demand_rate(self, entry: SubredditRefresh, now: Optional[float] = None) -> float:
+        """Recent draws per second from a subreddit."""
+        now = now if now is not None else time.monotonic()
+        return self._decayed_demand(entry, now) * math.log(2) / self.half_life
+    
+    def overdue(self, now: Optional[float] = None) -> int:
+        """Number of subreddits waiting past their due time."""
+        now = now if now is not None else time.monotonic()
+        return sum(1 for entry in self.entries.values() if not entry.refreshing and entry.due < now)
+    
+    async def run(self, refresh: Callable[[str, int], Awaitable[Optional[Tuple[float, float]]]]) -> None:
+        """
+        Refresh subreddits as they fall due, until cancelled.
+        
+        Args:
+            refresh: Called as ``refresh(subreddit, limit)`` to refetch a
+                listing of ``limit`` posts; returns the share of the pool
+                that is new and the seconds since it was last filled (0 if
+                it was empty), or None if the refresh failed
+        """
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.concurrency)
+        tasks: Set[asyncio.Task] = set()
+        self._wakeup = asyncio.Event()
+        self.running = True
+        try:
+            while True:
+                await slots.acquire()
+                entry = await self._next_due()
+                delay = self.budget.reserve()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                
+                now = time.monotonic()
+                lateness = max(0.0, now - entry.due)
+                REFRESH_LATENESS.observe(lateness)
+                entry.lateness += lateness
+                entry.limit = self._listing_limit(entry, now)
+                task = loop.create_task(self._refresh(entry, refresh))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                task.add_done_callback(lambda done: slots.release())
+        finally:
+            self.running = False
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    
+    def summary(self) -> str:
+        """One line for the /health report."""
+        now = time.monotonic()
+        _, idle_interval = self._budgets()
+        refreshes = sum(entry.changed + entry.unchanged + entry.failed for entry in self.entries.values())
+        lateness = sum(entry.lateness for entry in self.entries.values())
+        return (f"refresh scheduler: {len(self.entries)} subreddits, {len(self.entries) - self._idle} active, "
+                f"budget {self.rate * 60:.0f}/min, idle ones every {idle_interval:.0f}s, "
+                f"{self.overdue(now)} overdue, {self.quarantined(now)} quarantined, {refreshes} refreshes "
+                f"{lateness / refreshes if refreshes else 0:.1f}s late on average")
+    
+    def report(self, limit: int = 5) -> str:
+        """The ``limit`` most drawn-from subreddits' schedules, one line each."""
+        now = time.monotonic()
+        rates = {subreddit: self.demand_rate(entry, now) for subreddit, entry in self.entries.items()}
+        lines = []
+        for subreddit in sorted(rates, key=rates.get, reverse=True)[:limit]:
+            entry = self.entries[subreddit]
+            change = f"{entry.change_rate * 3600:.0%}/h new" if entry.change_rate is not None else "change unknown"
+            lines.append(f"r/{subreddit}: {rates[subreddit] * 3600:.0f} draws/h, {change}, every "
+                         f"{entry.interval:.0f}s, {entry.limit} posts, {entry.changed} changed/"
+                         f"{entry.unchanged} unchanged/{entry.failed} failed")
+        return '\n'.join(lines)
+    
+    def _decayed_demand(self, entry: SubredditRefresh, now: float) -> float:
+        return entry.demand * 0.5 ** ((now - entry.demand_at) / self.half_life)
+    
+    def _weight(self, entry: SubredditRefresh, now: float) -> float:
+        """sqrt(draws per second x share of the listing new per second), or 0 if idle."""
+        demand = self.demand_rate(entry, now)
+        if demand * self.max_interval <= self.draws_per_refresh:
+            return 0.0
+        change = entry.change_rate if entry.change_rate is not None else self.change_prior
+        return math.sqrt(demand * change)
+    
+    def _budgets(self) -> Tuple[float, float]:
+        """Refreshes per second left for the active subreddits, and the idle interval."""
+        idle_budget = min(self._idle / self.max_interval, self.rate * self.IDLE_SHARE)
+        if not self._weight_sum:
+            idle_budget = self.rate
+        idle_interval = max(self.max_interval, self._idle / idle_budget) if idle_budget else self.max_interval
+        return self.rate - idle_budget, idle_interval
+    
+    def _update_interval(self, entry: SubredditRefresh, now: float) -> None:
+        weight = self._weight(entry, now)
+        if bool(weight) != bool(entry.weight):
+            self._idle += -1 if weight else 1
+        self._weight_sum = max(0.0, self._weight_sum + weight - entry.weight)
+        entry.weight = weight
+        active_budget, idle_interval = self._budgets()
+        if weight:
+            interval = self._weight_sum / (active_budget * weight)
+            entry.interval = min(max(interval, self.min_interval), self.max_interval)
+        else:
+            entry.interval = idle_interval
+    
+    def _schedule(self, entry: SubredditRefresh, now: float) -> None:
+        """Queue the next refresh of an entry that isn't refreshing."""
+        self._update_interval(entry, now)
+        if entry.quarantined_until > now:
+            due = entry.quarantined_until
+        elif entry.failures:
+            due = now + min(entry.interval, self.min_interval * 2 ** (entry.failures - 1))
+        elif entry.refreshed_at is None:
+            due = now
+        else:
+            due = entry.refreshed_at + entry.interval
+        self._push(entry, max(due, now))
+    
+    def _push(self, entry: SubredditRefresh, due: float) -> None:
+        # Earlier queue items for the entry are skipped when popped (their due no longer matches)
+        entry.due = due
+        if self._wakeup is not None and (not self._queue or due < self._queue[0][0]):
+            self._wakeup.set()
+        heapq.heappush(self._queue, (due, entry.subreddit))
+        if len(self._queue) > 2 * len(self.entries) + 64:
+            self._queue = [(entry.due, subreddit) for subreddit, entry in self.entries.items()
+                           if not entry.refreshing]
+            heapq.heapify(self._queue)
+    
+    async def _next_due(self) -> SubredditRefresh:
+        """Wait for the next due entry and take it off the queue."""
+        while True:
+            while self._queue:
+                due, subreddit = self._queue[0]
+                entry = self.entries.get(subreddit)
+                if entry is not None and entry.due == due and not entry.refreshing:
+                    break
+                heapq.heappop(self._queue)
+            
+            now = time.monotonic()
+            if self._queue and self._queue[0][0] <= now:
+                heapq.heappop(self._queue)
+                entry.refreshing = True
+                return entry
+            
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._queue[0][0] - now if self._queue else None)
+            except asyncio.TimeoutError:
+                pass
+    
+    def _listing_limit(self, entry: SubredditRefresh, now: float) -> int:
+        if entry.refreshed_at is None:
+            return entry.limit
+        expected = self.demand_rate(entry, now) * entry.interval
+        for limit in REFRESH_LISTING_LIMITS:
+            if limit >= 2 * expected:
+                return limit
+        return REFRESH_LISTING_LIMITS[-1]
+    
+    async def _refresh(self, entry: SubredditRefresh,
+                       refresh: Callable[[str, int], Awaitable[Optional[Tuple[float, float]]]]) -> None:
+        try:
+            result = await refresh(entry.subreddit, entry.limit)
+        except Exception as e:
+            logger.warning("Scheduled refresh of r/%s failed: %s", entry.subreddit, e)
+            result = None
+        
+        entry.refreshing = False
+        if self.entries.get(entry.subreddit) is not entry:
+            return
+        
+        now = time.monotonic()
+        if result is None:
+            entry.failed += 1
+            entry.failures += 1
+        else:
+            new_share, elapsed = result
+            entry.failures = 0
+            entry.refreshed_at = now
+            if new_share:
+                entry.changed += 1
+            else:
+                entry.unchanged += 1
+            if elapsed > 0:
+                sample = new_share / elapsed
+                entry.change_rate = (sample if entry.change_rate is None
+                                     else entry.change_rate + self.CHANGE_WEIGHT * (sample - entry.change_rate))
+        self._schedule(entry, now)
+
+
+class AsyncMemeFetcher(BaseMemeFetcher):
+    """
+    Non-blocking meme fetcher for use inside the bot's event loop.
+    
+    Uses a single pooled ``httpx.AsyncClient`` and caps the number of
+    in-flight requests per host, so a slow upstream only delays the
+    commands waiting on it. Every request is a plain coroutine: cancelling
+    the calling task (or closing the fetcher) aborts the request.
+    
+    Reddit listings are kept in a warm ``MemePool`` per subreddit: the
+    defaults and every subreddit a chat has picked. Commands sample from
+    memory; pools are refilled on their own schedule by ``run_scheduler``
+    (see ``RefreshScheduler``), or all at once by ``refresh_pools`` run
+    from the bot's job queue, in which case they are also revalidated in
+    the background once they go stale. When ``store`` is given, every
+    refilled pool is also published to it for sharded workers. With
+    ``validate`` only memes a ``MediaValidator`` finds deliverable are
+    admitted to a pool, and with ``dedup`` a ``MediaDeduplicator`` keeps
+    reposts of one image out of the pools.
+    """
+    
+    def __init__(self, max_connections_per_host: int = MAX_CONNECTIONS_PER_HOST,
+                 hedge_delay: float = HEDGE_DELAY, deadline: float = MEME_DEADLINE,
+                 batched: bool = BATCHED_FETCH, pages: int = BATCHED_FETCH_PAGES,
+                 store: Optional[SharedMemeStore] = None, validate: bool = VALIDATE_MEDIA,
+                 dedup: bool = DEDUP_MEDIA):
+        self.max_connections_per_host = max_connections_per_host
+        self.store = store
+        self.batched = batched
+        self.pages = pages
+        self.hedge_delay = hedge_delay
+        self.deadline = deadline
+        self.validate = validate
+        self.dedup = dedup
+        self._client: Optional[httpx.AsyncClient] = None
+        self._validator: Optional[MediaValidator] = None
+        self._deduplicator: Optional[MediaDeduplicator] = None
+        self._host_semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.health = SourceHealth()
+        self.seen = SeenTracker()
+        self.scheduler = RefreshScheduler()
+        self.default_subreddits = tuple(SUBREDDITS)
+        self.chat_subreddits: Dict[int, Tuple[str, ...]] = {}
+        self._subscribers: Dict[str, int] = {}
+        self._chat_change = 0
+        self.pools: Dict[str, MemePool] = {}
+        for subreddit in self.default_subreddits:
+            self._add_pool(subreddit)
+        self.upstream_budget = TokenBucket(UPSTREAM_RATE_PER_MINUTE / 60.0, UPSTREAM_BURST)
+        self._flights = SingleFlight()
+        self._generations: Dict[str, int] = {}
+        self._validated: 'OrderedDict[str, ValidatedResponse]' = OrderedDict()
+        self.conditional_stats = ConditionalStats()
+    
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """
+        The pooled HTTP client, created on first use.
+        
+        Building its TLS context is most of what constructing a fetcher
+        costs, and sharded workers never go upstream at all.
+        """
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                headers={
+                    'User-Agent': USER_AGENT,
+                    'Accept': 'application/json, text/html, */*',
+                    'Accept-Language': 'en-US,en;q=0.9',
+                    'Accept-Encoding': 'gzip, deflate',
+                },
+                timeout=httpx.Timeout(REQUEST_TIMEOUT),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections_per_host * 4,
+                    max_keepalive_connections=self.max_connections_per_host * 2,
+                ),
+                follow_redirects=True,
+            )
+        return self._client
+    
+    @property
+    def validator(self) -> Optional[MediaValidator]:
+        """The ``MediaValidator`` admitting memes to pools, or None without ``validate``."""
+        if self._validator is None and self.validate:
+            self._validator = MediaValidator(self.client)
+        return self._validator
+    
+    @property
+    def deduplicator(self) -> Optional[MediaDeduplicator]:
+        """The ``MediaDeduplicator`` admitting memes to pools, or None without ``dedup``."""
+        if self._deduplicator is None and self.dedup:
+            self._deduplicator = MediaDeduplicator(self.client)
+        return self._deduplicator
+    
+    def load_snapshot(self) -> None:
+        """
+        Warm the chats' subreddit lists, the pools and circuit breakers from ``self.store``.
+        
+        Pools keep their saved age, so stale ones are served while being
+        revalidated in the background and expired ones are refetched.
+        """
+        if self.store is None:
+            return
+        
+        started = time.perf_counter()
+        try:
+            changes, self._chat_change = self.store.load_chat_subreddits()
+            self._apply_chat_subreddits(changes)
+            restored = sum(self._load_pool(subreddit) for subreddit in list(self.pools))
+            self.health.restore(self.store.load_breakers())
+        except sqlite3.Error as e:
+            logger.warning("Could not restore snapshot from %s: %s", self.store.path, e)
+            return
+        
+        for subreddit, pool in self.pools.items():
+            if len(pool):
+                self.scheduler.add(subreddit, refreshed_at=pool.fetched_at)
+        logger.info("Restored %s pools from %s in %.1fms",
+                    restored, self.store.path, (time.perf_counter() - started) * 1000)
+    
+    def save_snapshot(self) -> None:
+        """Save the circuit breakers to ``self.store``; pools are written through on refresh."""
+        if self.store is None:
+            return
+        
+        try:
+            self.store.save_breakers(self.health.snapshot())
+        except sqlite3.Error as e:
+            logger.warning("Could not save source health to %s: %s", self.store.path, e)
+    
+    async def aclose(self) -> None:
+        """Cancel background refreshes and close the HTTP connection pool."""
+        self._flights.cancel_all()
+        if self._validator is not None:
+            self._validator.cancel_all()
+        if self._deduplicator is not None:
+            self._deduplicator.cancel_all()
+        if self._client is not None:
+            await self._client.aclose()
+        if self.store is not None:
+            self.store.close()
+    
+    def sync_store(self) -> None:
+        """
+        Pick up what sharded workers wrote to the store: chats' changed
+        subreddit lists and the /meme draws they counted, for the scheduler.
+        """
+        if self.store is None:
+            return
+        
+        try:
+            changes, self._chat_change = self.store.load_chat_subreddits(self._chat_change)
+            draws = self.store.take_draws()
+        except sqlite3.Error as e:
+            logger.warning("Could not sync with the shared store: %s", e)
+            return
+        
+        self._apply_chat_subreddits(changes)
+        now = time.monotonic()
+        for subreddit, count in draws.items():
+            self.scheduler.record_draw(subreddit, count, now)
+    
+    def subreddits_for(self, chat_id: Optional[int]) -> Tuple[str, ...]:
+        """The subreddits /meme draws from in a chat: its own list, or the defaults."""
+        return self.chat_subreddits.get(chat_id) or self.default_subreddits
+    
+    async def check_subreddit(self, subreddit: str) -> None:
+        """
+        Make sure Reddit has a public, SFW subreddit by this name, with one about.json GET.
+        
+        Raises:
+            SubredditUnavailable: If it is missing, private, banned or NSFW
+            CircuitOpenError, UpstreamBudgetExceeded, httpx.HTTPError: If Reddit couldn't be asked
+        """
+        response = await self._get(f"{REDDIT_BASE_URL}/r/{subreddit}/about.json", 'reddit:about')
+        about = response.json()
+        if about.get('kind') != 't5':
+            raise SubredditUnavailable(f"r/{subreddit} not found")
+        if about['data'].get('over18'):
+            raise SubredditUnavailable(f"r/{subreddit} is NSFW")
+    
+    def set_chat_subreddits(self, chat_id: int, subreddits: Sequence[str]) -> None:
+        """
+        Set the subreddits a chat draws from (empty for the defaults) and save them to the store.
+        
+        Subreddits new to the bot get a pool, scheduled for a refresh right
+        away; pools no chat draws from any more are dropped.
+        """
+        self._apply_chat_subreddits({chat_id: tuple(subreddits)})
+        if self.store is not None:
+            try:
+                self.store.save_chat_subreddits(chat_id, subreddits)
+            except sqlite3.Error as e:
+                logger.warning("Could not save chat %s subreddits to %s: %s", chat_id, self.store.path, e)
+    
+    def _apply_chat_subreddits(self, changes: Dict[int, Tuple[str, ...]]) -> None:
+        """Install chats' subreddit lists, adding and dropping pools by how many chats use them."""
+        for chat_id, subreddits in changes.items():
+            # Count the new list before releasing the old one, so kept pools survive
+            for subreddit in subreddits:
+                self._subscribers[subreddit] = self._subscribers.get(subreddit, 0) + 1
+                self._add_pool(subreddit)
+            for subreddit in self.chat_subreddits.pop(chat_id, ()):
+                remaining = self._subscribers.pop(subreddit) - 1
+                if remaining:
+                    self._subscribers[subreddit] = remaining
+                elif subreddit not in self.default_subreddits:
+                    self._drop_pool(subreddit)
+            if subreddits:
+                self.chat_subreddits[chat_id] = subreddits
+    
+    def _add_pool(self, subreddit: str) -> None:
+        """Create and schedule a subreddit's pool unless it has one."""
+        if subreddit not in self.pools:
+            self.pools[subreddit] = MemePool(subreddit)
+            self.scheduler.add(subreddit)
+    
+    def _drop_pool(self, subreddit: str) -> None:
+        """Forget a subreddit's pool; a refresh in flight for it is discarded."""
+        del self.pools[subreddit]
+        self.scheduler.remove(subreddit)
+        self._generations.pop(subreddit, None)
+    
+    async def run_scheduler(self) -> None:
+        """Refresh the pools as the scheduler finds them due, until cancelled."""
+        await self.scheduler.run(self._scheduled_refresh)
+    
+    async def _scheduled_refresh(self, subreddit: str, limit: int) -> Optional[Tuple[float, float]]:
+        """
+        Refresh one pool for the scheduler, joining a refresh already in flight.
+        
+        Returns:
+            The share of the refilled pool that wasn't in it before and the
+            seconds since it was last filled (0 if it was empty), or None if
+            the refresh failed
+        """
+        pool = self.pools.get(subreddit)
+        if pool is None:
+            return None
+        previous = set(pool.memes.urls())
+        age = pool.age() if len(pool) else 0.0
+        
+        if not await self._flights.do(('refresh', subreddit), lambda: self.refresh_pool(subreddit, limit)):
+            return None
+        pool = self.pools.get(subreddit)
+        if pool is None or not len(pool):
+            return None
+        new = sum(1 for url in pool.memes.urls() if url not in previous)
+        return new / len(pool), age
+    
+    async def refresh_pool(self, subreddit: str, limit: int = 50) -> bool:
+        """
+        Refill the pool for one subreddit.
+        
+        A failed fetch leaves the previous contents in place so they can
+        still be served until they expire. A 304 from the endpoint refills
+        the pool with the listing it already had, marking it fresh again.
+        
+        A subreddit Reddit reports missing, private or banned is
+        quarantined: not refreshed or drawn from for the scheduler's
+        ``quarantine_period``. The default subreddits are never quarantined,
+        since /meme falls back to them.
+        
+        Args:
+            subreddit: Subreddit to refill
+            limit: Posts to request from the listing
+        
+        Returns:
+            True if the pool was refilled
+        """
+        try:
+            memes = await self._get_memes_from_subreddit(subreddit, limit)
+        except SubredditUnavailable as e:
+            if subreddit in self.default_subreddits:
+                logger.warning("Default subreddit r/%s is unavailable: %s", subreddit, e)
+                return False
+            logger.warning("r/%s is unavailable, quarantining it for %.0fs: %s",
+                           subreddit, self.scheduler.quarantine_period, e)
+            self.scheduler.quarantine(subreddit)
+            return False
+        if not await self._fill_pool(subreddit, memes):
+            logger.warning("Pool refresh for r/%s returned no memes", subreddit)
+            return False
+        
+        logger.debug("Refreshed pool for r/%s: %s memes", subreddit, len(self.pools[subreddit]))
+        return True
+    
+    async def warm(self) -> None:
+        """
+        Refill every pool that isn't fresh, with one coalesced refresh per subreddit.
+        
+        Unlike ``refresh_pools`` this doesn't batch subreddits into combined
+        listings, so a command that finds a pool cold while the bot is still
+        starting joins that pool's refresh instead of racing a duplicate.
+        """
+        await asyncio.gather(*(self._refresh_shared(subreddit)
+                               for subreddit, pool in self.pools.items() if not pool.is_fresh()))
+    
+    async def refresh_pools(self) -> None:
+        """
+        Refill every subreddit pool.
+        
+        In batched mode all subreddits come from combined listings, so the
+        refresh costs ``pages`` requests per ``COMBINED_MAX_SUBREDDITS``
+        subreddits instead of one or more per subreddit. Subreddits the
+        combined listing didn't cover are fetched individually only if their
+        pool can no longer be served.
+        """
+        if not self.batched:
+            await asyncio.gather(*(self._refresh_shared(subreddit) for subreddit in self.pools))
+            return
+        
+        subreddits = list(self.pools)
+        groups = [tuple(subreddits[i:i + COMBINED_MAX_SUBREDDITS])
+                  for i in range(0, len(subreddits), COMBINED_MAX_SUBREDDITS)]
+        results = await asyncio.gather(*(
+            self._flights.do(('combined', group), lambda group=group: self._fetch_combined_listing(list(group)))
+            for group in groups
+        ))
+        
+        buckets = {subreddit: memes for result in results for subreddit, memes in result.items()}
+        filled = await asyncio.gather(*(self._fill_pool(subreddit, memes) for subreddit, memes in buckets.items()))
+        missing = [subreddit for subreddit, ok in zip(buckets, filled)
+                   if not ok and not self.pools[subreddit].is_usable()]
+        
+        if missing:
+            logger.info("Combined listing missed %s, fetching individually", ', '.join(missing))
+            await asyncio.gather(*(self._refresh_shared(subreddit) for subreddit in missing))
+    
+    async def _fetch_combined_listing(self, subreddits: list) -> Dict[str, list]:
+        """
+        Fetch several subreddits' hot posts through one combined listing.
+        
+        Follows the ``after`` cursor for up to ``self.pages`` pages of 100
+        posts to build a deep pool.
+        
+        Returns:
+            Mapping of each subreddit to its media posts (empty on failure)
+        """
+        buckets: Dict[str, list] = {subreddit: [] for subreddit in subreddits}
+        url = f"{REDDIT_BASE_URL}/r/{'+'.join(subreddits)}/hot.json"
+        after = None
+        
+        for _ in range(self.pages):
+            params = {'limit': 100}
+            if after:
+                params['after'] = after
+            
+            try:
+                page, after = await self._get_json(
+                    url, 'reddit:json',
+                    lambda data, known: (self._parse_combined_listing(data, subreddits, known),
+                                         data['data'].get('after')),
+                    params=params,
+                )
+            except Exception as e:
+                logger.debug("Combined listing failed for %s: %s", url, e)
+                break
+            
+            for subreddit, memes in page.items():
+                buckets[subreddit].extend(memes)
+            
+            if not after:
+                break
+        
+        return buckets
+    
+    async def _admit(self, memes: list, dedup: bool = True) -> list:
+        """
+        Drop memes Telegram couldn't send (see ``MediaValidator``) and, with
+        ``dedup``, reposts of images already seen (see ``MediaDeduplicator``).
+        """
+        if self.validator is not None:
+            memes = await self.validator.filter(memes)
+        if dedup and self.deduplicator is not None:
+            memes = await self.deduplicator.filter(memes)
+        return memes
+    
+    async def _fetch_admitted(self, fetch: Awaitable[list]) -> list:
+        """
+        Await a listing fetch and keep its deliverable memes.
+        
+        Hedges are racing a deadline, so their memes aren't deduplicated;
+        the next refresh of the pool they seed does that.
+        """
+        return await self._admit(await fetch, dedup=False)
+    
+    async def _fill_pool(self, subreddit: str, memes: list) -> bool:
+        """
+        Swap a listing's deliverable memes into a pool.
+        
+        A cold pool is filled as soon as the first batch of memes (one per
+        validation slot) has been validated, so commands waiting on it
+        aren't held up by the rest of the listing or by deduplication; the
+        rest is checked in the background, the whole listing deduplicated,
+        and the pool replaced when done.
+        
+        Returns:
+            True if the pool was refilled
+        """
+        pool = self.pools.get(subreddit)
+        if pool is None:
+            # Dropped while the listing was being fetched
+            return False
+        
+        if self.validator is not None:
+            batch = self.validator.concurrency
+        elif self.deduplicator is not None:
+            batch = self.deduplicator.concurrency
+        else:
+            batch = 0
+        if not batch or pool.is_usable() or len(memes) <= batch:
+            admitted = await self._admit(memes)
+            if admitted:
+                self._replace_pool(subreddit, admitted)
+            return bool(admitted)
+        
+        head = await self._admit(memes[:batch], dedup=False)
+        if not head:
+            return await self._fill_pool(subreddit, memes[batch:])
+        
+        self._replace_pool(subreddit, head)
+        filled_at = pool.fetched_at
+        self._flights.start(('admit', subreddit),
+                            lambda: self._fill_rest(subreddit, head, memes[batch:], filled_at))
+        return True
+    
+    async def _fill_rest(self, subreddit: str, head: list, rest: list, filled_at: float) -> None:
+        """
+        Background half of a cold ``_fill_pool``: add the rest of the listing.
+        
+        Gives up if the pool was refilled since ``head`` went in at
+        ``filled_at``, rather than overwrite a newer listing with this one.
+        """
+        admitted = head + await self._admit(rest, dedup=False)
+        if not self._filled_since(subreddit, filled_at) and self.deduplicator is not None:
+            admitted = await self.deduplicator.filter(admitted)
+        if admitted and admitted != head and not self._filled_since(subreddit, filled_at):
+            self._replace_pool(subreddit, admitted)
+    
+    def _filled_since(self, subreddit: str, filled_at: float) -> bool:
+        """True if the pool was refilled (or dropped) after ``filled_at``."""
+        pool = self.pools.get(subreddit)
+        return pool is None or pool.fetched_at != filled_at
+    
+    def _replace_pool(self, subreddit: str, memes: list) -> None:
+        """Swap in a new listing and publish it to the shared store, if any."""
+        pool = self.pools.get(subreddit)
+        if pool is None:
+            return
+        pool.replace(memes)
+        if self.store is not None:
+            try:
+                self.store.publish(subreddit, memes)
+            except sqlite3.Error as e:
+                logger.warning("Could not publish r/%s to the shared store: %s", subreddit, e)
+    
+    def _load_pool(self, subreddit: str) -> bool:
+        """Replace a pool with the store's listing if it has a newer generation."""
+        try:
+            memes, generation, fetched_at = self.store.load(subreddit)
+        except sqlite3.Error as e:
+            logger.warning("Could not read r/%s from the shared store: %s", subreddit, e)
+            return False
+        
+        if not memes or generation == self._generations.get(subreddit):
+            return False
+        
+        # Translate the writer's wall-clock fetch time to this process's monotonic clock
+        age = max(0.0, time.time() - fetched_at)
+        self.pools[subreddit].replace(memes, fetched_at=time.monotonic() - age)
+        self._generations[subreddit] = generation
+        logger.debug("Loaded r/%s generation %s from the shared store", subreddit, generation)
+        return True
+    
+    def _choose_subreddit(self, chat_id: Optional[int] = None) -> str:
+        """
+        Pick the chat's subreddit to serve from, weighted by ``SUBREDDIT_WEIGHTS``.
+        
+        Subreddits with a servable pool are preferred so a cold one doesn't
+        force an inline fetch while others are warm. Quarantined ones are
+        skipped, falling back to the defaults if that leaves none.
+        """
+        now = time.monotonic()
+        subreddits = [subreddit for subreddit in self.subreddits_for(chat_id)
+                      if not self.scheduler.is_quarantined(subreddit, now)] or self.default_subreddits
+        candidates = [subreddit for subreddit in subreddits if self.pools[subreddit].is_usable(now)]
+        if not candidates:
+            candidates = list(subreddits)
+        
+        weights = [SUBREDDIT_WEIGHTS.get(subreddit, 1.0) for subreddit in candidates]
+        return random.choices(candidates, weights)[0]
+    
+    def _refresh_in_background(self, subreddit: str) -> asyncio.Task:
+        """Start a refresh task for a pool unless one is already running."""
+        return self._flights.start(('refresh', subreddit), lambda: self.refresh_pool(subreddit))
+    
+    async def _refresh_shared(self, subreddit: str) -> bool:
+        """Refresh a pool, joining a refresh already in flight for it."""
+        return await self._flights.do(('refresh', subreddit), lambda: self.refresh_pool(subreddit))
+    
+    @asynccontextmanager
+    async def _open(self, url: str, source: str, **kwargs) -> AsyncIterator[httpx.Response]:
+        """
+        Open a streaming GET while holding the per-host concurrency slot.
+        
+        The response headers have been checked when the body is entered;
+        the body is read by the caller and the connection is released on
+        exit, even if the caller stops reading early.
+        
+        Transport errors and error statuses count against the source's
+        circuit breaker, except where Reddit says one subreddit is
+        unavailable: a 404, a redirect to subreddit search, or a 403 whose
+        ``reason`` is private, banned or quarantined. Those are about the
+        subreddit rather than the endpoint, so they leave the breaker
+        alone. Any other 403 (a Reddit-wide block) is a failure like a 5xx.
+        
+        Args:
+            url: URL to fetch
+            source: Circuit breaker name for the endpoint, e.g. 'reddit:json'
+            
+        Raises:
+            UpstreamBudgetExceeded: If the global upstream request budget is spent
+            CircuitOpenError: If the source's circuit is open
+            SubredditUnavailable: If Reddit has no such public subreddit
+            httpx.HTTPError: If the request fails or returns an error status
+        """
+        breaker = self.health.breaker(source)
+        if not breaker.allow_request():
+            SOURCE_REQUESTS.inc(source, 'circuit_open')
+            raise CircuitOpenError(f"{source} circuit open")
+        
+        if not self.upstream_budget.try_acquire():
+            breaker.release_probe()
+            SOURCE_REQUESTS.inc(source, 'budget_exceeded')
+            raise UpstreamBudgetExceeded(f"upstream budget spent, skipping {source}")
+        
+        host = urlparse(url).netloc
+        semaphore = self._host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.max_connections_per_host)
+            self._host_semaphores[host] = semaphore
+        
+        opened = False
+        outcome = 'error'
+        try:
+            async with semaphore:
+                with span(source), SOURCE_LATENCY.time(source):
+                    async with self.client.stream('GET', url, **kwargs) as response:
+                        opened = True
+                        reddit = source.startswith('reddit:')
+                        if response.is_error:
+                            status = response.status_code
+                            outcome = f"http_{status}"
+                            unavailable = reddit and (
+                                status == 404
+                                or status == 403
+                                and await self._forbidden_reason(response) in SUBREDDIT_FORBIDDEN_REASONS
+                            )
+                            if unavailable:
+                                breaker.release_probe()
+                                raise SubredditUnavailable(f"HTTP {status} from {url}")
+                            retry_after = response.headers.get('Retry-After', '')
+                            breaker.record_failure(
+                                f"HTTP {status}",
+                                rate_limited=status == 429,
+                                retry_after=float(retry_after) if retry_after.isdigit() else None,
+                            )
+                            response.raise_for_status()
+                        if reddit and response.url.path.startswith('/subreddits/search'):
+                            outcome = 'not_found'
+                            breaker.release_probe()
+                            raise SubredditUnavailable(f"{url} redirected to subreddit search")
+                        
+                        outcome = 'not_modified' if response.status_code == 304 else 'ok'
+                        breaker.record_success()
+                        yield response
+        except httpx.HTTPError as e:
+            if not opened:
+                breaker.record_failure(type(e).__name__)
+            raise
+        except asyncio.CancelledError:
+            outcome = 'cancelled'
+            if not opened:
+                breaker.release_probe()
+            raise
+        finally:
+            SOURCE_REQUESTS.inc(source, outcome)
+    
+    @staticmethod
+    async def _forbidden_reason(response: httpx.Response) -> Optional[str]:
+        """The ``reason`` Reddit gives in a 403 body, or None if it gives none."""
+        try:
+            await response.aread()
+            body = response.json()
+        except (httpx.HTTPError, ValueError):
+            return None
+        return body.get('reason') if isinstance(body, dict) else None
+    
+    async def _get(self, url: str, source: str, **kwargs) -> httpx.Response:
+        """GET a URL and read the whole body; see ``_open`` for arguments."""
+        async with self._open(url, source, **kwargs) as response:
+            await response.aread()
+        return response
+    
+    async def _get_json(self, url: str, source: str,
+                        parse: Callable[[Any, Dict[str, Optional[Meme]]], Any], **kwargs) -> Any:
+        """
+        Conditionally GET a JSON endpoint and parse it.
+        
+        The ETag/Last-Modified validators and parse result of the endpoint's
+        last full response are kept. They are sent back as ``If-None-Match``
+        and ``If-Modified-Since``; a 304 returns the previous result without
+        downloading or parsing anything. A 200 is parsed with the previous
+        post IDs, so unchanged posts are reused instead of re-validated.
+        
+        Args:
+            url: URL to fetch
+            source: Circuit breaker name for the endpoint
+            parse: Called as ``parse(data, known)`` with the decoded JSON and
+                the endpoint's post ID map (see ``_post_converter``)
+            
+        Returns:
+            The parse result, fresh or from the last full response
+        """
+        key = str(httpx.URL(url, params=kwargs.get('params')))
+        cached = self._validated.get(key)
+        headers = {}
+        if cached is not None:
+            if cached.etag:
+                headers['If-None-Match'] = cached.etag
+            if cached.last_modified:
+                headers['If-Modified-Since'] = cached.last_modified
+        
+        stats = self.conditional_stats
+        stats.requests += 1
+        response = await self._get(url, source, headers=headers, **kwargs)
+        
+        if response.status_code == 304 and cached is not None:
+            self._validated.move_to_end(key)
+            stats.not_modified += 1
+            stats.bytes_saved += cached.body_bytes
+            stats.parse_seconds_saved += cached.parse_seconds
+            return cached.payload
+        
+        previous_ids = cached.known.keys() if cached is not None else set()
+        known = dict(cached.known) if cached is not None else {}
+        started = time.perf_counter()
+        with span('parse'):
+            payload = parse(response.json(), known)
+        parse_seconds = time.perf_counter() - started
+        PARSE_SECONDS.observe(parse_seconds, source)
+        
+        reused = len(known.keys() & previous_ids)
+        stats.posts_reused += reused
+        stats.posts_parsed += len(known) - reused
+        
+        # Kept even without validators, so the next parse can still reuse posts
+        self._validated[key] = ValidatedResponse(
+            response.headers.get('ETag', ''), response.headers.get('Last-Modified', ''),
+            payload, known, response.num_bytes_downloaded, parse_seconds,
+        )
+        self._validated.move_to_end(key)
+        while len(self._validated) > VALIDATOR_CACHE_SIZE:
+            self._validated.popitem(last=False)
+        
+        return payload
+    
+    async def get_random_meme(self, chat_id: Optional[int] = None) -> Optional[Meme]:
+        """
+        Get a random meme from available sources.
+        
+        A warm pool answers straight from memory. On a cold pool the
+        sources are raced (see ``_race_sources``) and the hardcoded
+        fallback is served if nothing wins within ``self.deadline``.
+        
+        Args:
+            chat_id: Chat the meme is for; when given, memes the chat has
+                already received are avoided (the caller marks the meme
+                seen once it has been sent)
+        
+        Returns:
+            The meme, or None if no meme found
+        """
+        subreddit = self._choose_subreddit(chat_id)
+        self._record_draw(subreddit)
+        meme = self._sample_pool(subreddit, chat_id)
+        origin = 'pool'
+        POOL_LOOKUPS.inc('hit' if meme else 'miss')
+        
+        if not meme:
+            origin = 'upstream'
+            try:
+                with span('race'):
+                    meme = await asyncio.wait_for(self._race_sources(subreddit), timeout=self.deadline)
+            except asyncio.TimeoutError:
+                logger.info("No source answered within %ss", self.deadline)
+                meme = None
         
-        # If Reddit fails, try Giphy as fallback
         if not meme:
-            logger.info("Reddit unavailable, trying Giphy fallback...")
-            meme = self._try_giphy_meme()
+            # An expired listing (e.g. from the last snapshot) still beats the classic memes
+            origin = 'expired_pool'
+            meme = self.pools[subreddit].sample()
+            if meme:
+                logger.info("All sources unavailable, serving expired r/%s pool", subreddit)
         
-        # If Giphy fails, use hardcoded fallback
         if not meme:
-            logger.info("Giphy unavailable, using hardcoded fallback...")
+            origin = 'fallback'
+            logger.info("All sources unavailable, using hardcoded fallback...")
             meme = self._get_fallback_meme()
         
+        MEMES_SERVED.inc(origin)
         return meme
     
-    def _try_reddit_meme(self) -> Optional[Dict[str, Any]]:
-        """Try to get a meme from Reddit."""
-        # Randomly select a subreddit
-        subreddit = random.choice(SUBREDDITS)
-        logger.info(f"Trying to fetch memes from r/{subreddit}")
+    async def _race_sources(self, subreddit: str) -> Optional[Meme]:
+        """
+        Race the fallback chain instead of walking it in order.
         
-        # Get memes from the selected subreddit
-        memes = self._get_memes_from_subreddit(subreddit)
+        The Reddit pool refresh starts immediately. If it hasn't produced a
+        meme after ``self.hedge_delay`` seconds (or fails sooner), the RSS,
+        alternative JSON and Giphy sources are started as hedges. The first
+        valid meme wins and every other request is cancelled.
         
-        if not memes:
-            logger.warning(f"No valid memes found in r/{subreddit}")
+        A quarantined subreddit isn't asked for again: only Giphy is tried.
+        
+        Returns:
+            The first meme found, or None if every source failed
+        """
+        loop = asyncio.get_running_loop()
+        if self.scheduler.is_quarantined(subreddit):
+            hedges = []
+            tiers = {loop.create_task(self._try_giphy_meme()): 'giphy'}
+        else:
+            hedges = [
+                ('rss', lambda: self._try_rss_meme(subreddit)),
+                ('alternative', lambda: self._try_alternative_meme(subreddit)),
+                ('giphy', self._try_giphy_meme),
+            ]
+            tiers = {loop.create_task(self._try_reddit_meme(subreddit)): 'reddit'}
+        tasks = list(tiers)
+        hedged = False
+        
+        try:
+            while tasks:
+                done, _ = await asyncio.wait(
+                    tasks,
+                    timeout=None if hedged else self.hedge_delay,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for task in done:
+                    tasks.remove(task)
+                    won = not task.cancelled() and task.exception() is None and task.result()
+                    TIER_RESULTS.inc(tiers[task], 'success' if won else 'failure')
+                    if won:
+                        return task.result()
+                
+                # Hedge once the delay has passed or the primary gave up early
+                if not hedged and (not done or not tasks):
+                    hedged = True
+                    logger.info("Hedging r/%s with secondary sources", subreddit)
+                    for tier, start in hedges:
+                        task = loop.create_task(start())
+                        tiers[task] = tier
+                        tasks.append(task)
+            
+            return None
+        finally:
+            for task in tasks:
+                TIER_RESULTS.inc(tiers[task], 'cancelled')
+                task.cancel()
+    
+    def _record_draw(self, subreddit: str) -> None:
+        """Count a /meme draw towards the subreddit's refresh schedule."""
+        self.scheduler.record_draw(subreddit)
+    
+    def _sample_pool(self, subreddit: str, chat_id: Optional[int] = None) -> Optional[Meme]:
+        """Sample a warm pool, scheduling a refresh if it has gone stale."""
+        pool = self.pools[subreddit]
+        now = time.monotonic()
+        
+        if not pool.is_usable(now):
             return None
         
-        # Randomly select a meme
-        meme = random.choice(memes)
-        logger.info(f"Selected Reddit meme: {meme['title'][:50]}... from r/{subreddit}")
+        if not pool.is_fresh(now) and not self.scheduler.running:
+            # Stale-while-revalidate: answer from memory, refresh behind the scenes
+            self._refresh_in_background(subreddit)
+        
+        if chat_id is None:
+            return pool.sample()
+        
+        meme = self.seen.sample_unseen(chat_id, pool.memes)
+        if meme is None:
+            # The chat has exhausted this pool; try a few of its other warm pools before repeating
+            others = [other for other in map(self.pools.get, self.subreddits_for(chat_id))
+                      if other is not pool and other.is_usable(now)]
+            for other in random.sample(others, min(len(others), SEEN_OTHER_POOLS)):
+                meme = self.seen.sample_unseen(chat_id, other.memes)
+                if meme is not None:
+                    break
+            else:
+                logger.debug("Chat %s has seen all sampled memes, repeating", chat_id)
+                meme = pool.sample()
         
         return meme
     
-    def _get_memes_from_subreddit(self, subreddit: str, limit: int = 50) -> list:
+    def search(self, query: str, offset: int = 0, limit: int = INLINE_PAGE_SIZE) -> Tuple[List[Meme], bool]:
         """
-        Fetch memes from a specific subreddit using multiple methods.
+        Find memes in the default subreddits' warm pools by title, for inline mode.
+        
+        Inline queries don't come from a chat, so subreddits chats picked
+        with /subreddits aren't searched. Every word of the query must
+        start a word of the title, so results narrow as the user types.
+        Results alternate between the pools, each in listing order, without
+        repeating a URL. Only memory is read: unless the scheduler is
+        refreshing the pools, stale and cold ones are refreshed in the
+        background for later queries.
         
         Args:
-            subreddit: Name of the subreddit
-            limit: Number of posts to fetch (max 50)
+            query: Search text; empty matches every meme
+            offset: Number of results to skip
+            limit: Maximum number of results to return
             
         Returns:
-            List of meme posts with image/video URLs
+            ``(results, more)``, where more is True if further results follow
+        """
+        terms = title_words(query)
+        now = time.monotonic()
+        matches = []
+        for subreddit in self.default_subreddits:
+            pool = self.pools[subreddit]
+            if not pool.is_fresh(now) and not self.scheduler.running:
+                self._refresh_in_background(subreddit)
+            if pool.is_usable(now):
+                matches.append([(pool.memes, index) for index in pool.index.search(terms)])
+        
+        hits = []
+        urls = set()
+        for row in zip_longest(*matches):
+            for hit in row:
+                if hit is None:
+                    continue
+                url = hit[0].url_at(hit[1])
+                if url not in urls:
+                    urls.add(url)
+                    hits.append(hit)
+            if len(hits) > offset + limit:
+                break
+        return [store[index] for store, index in hits[offset:offset + limit]], len(hits) > offset + limit
+    
+    def _seed_pool(self, subreddit: str, memes: list) -> None:
+        """Fill a cold pool with posts a hedged source happened to fetch."""
+        if memes and not self.pools[subreddit].is_usable():
+            self._replace_pool(subreddit, memes)
+    
+    async def _try_reddit_meme(self, subreddit: str) -> Optional[Meme]:
+        """Refill a cold Reddit pool and pick a meme from it, unless the subreddit is quarantined."""
+        if self.scheduler.is_quarantined(subreddit):
+            return None
+        logger.info("Pool for r/%s is cold, fetching inline", subreddit)
+        await self._refresh_shared(subreddit)
+        
+        return self._pick_meme(self.pools[subreddit].memes, subreddit)
+    
+    async def _try_rss_meme(self, subreddit: str) -> Optional[Meme]:
+        """Hedge: pick a meme from the subreddit's RSS feed."""
+        memes = await self._flights.do(
+            ('rss', subreddit), lambda: self._fetch_admitted(self._try_rss_feed(subreddit, 50))
+        )
+        self._seed_pool(subreddit, memes)
+        return self._pick_meme(memes, subreddit)
+    
+    async def _try_alternative_meme(self, subreddit: str) -> Optional[Meme]:
+        """Hedge: pick a meme from the subreddit's alternative JSON listings."""
+        memes = await self._flights.do(
+            ('alternative', subreddit), lambda: self._fetch_admitted(self._try_alternative_json(subreddit, 50))
+        )
+        self._seed_pool(subreddit, memes)
+        return self._pick_meme(memes, subreddit)
+    
+    async def _get_memes_from_subreddit(self, subreddit: str, limit: int = 50) -> list:
+        """
+        Fetch memes from a subreddit, trying JSON, RSS and alternative JSON.
+        
+        Raises:
+            SubredditUnavailable: If Reddit has no such public subreddit (the
+                other endpoints aren't tried)
         """
-        # Try JSON endpoint first
-        memes = self._try_json_endpoint(subreddit, limit)
+        memes = await self._try_json_endpoint(subreddit, limit)
         
-        # If JSON fails, try RSS feed
         if not memes:
-            logger.info(f"JSON endpoint failed for r/{subreddit}, trying RSS feed...")
-            memes = self._try_rss_feed(subreddit, limit)
+            logger.info("JSON endpoint failed for r/%s, trying RSS feed...", subreddit)
+            memes = await self._try_rss_feed(subreddit, limit)
         
-        # If RSS fails, try alternative JSON endpoint
         if not memes:
-            logger.info(f"RSS feed failed for r/{subreddit}, trying alternative JSON...")
-            memes = self._try_alternative_json(subreddit, limit)
+            logger.info("RSS feed failed for r/%s, trying alternative JSON...", subreddit)
+            memes = await self._try_alternative_json(subreddit, limit)
         
         return memes
     
-    def _try_json_endpoint(self, subreddit: str, limit: int) -> list:
+    async def _try_json_endpoint(self, subreddit: str, limit: int) -> list:
         """Try to fetch from Reddit's JSON endpoint."""
         try:
-            url = f"https://www.reddit.com/r/{subreddit}/hot.json?limit={limit}"
-            response = self.session.get(url, timeout=10)
-            response.raise_for_status()
-            
-            data = response.json()
-            posts = []
-            
-            for post in data['data']['children']:
-                post_data = post['data']
-                
-                # Check if post has media content
-                url = post_data.get('url', '')
-                title = post_data.get('title', 'No title')
-                
-                # Filter for image/video content
-                if self._is_valid_media_url(url):
-                    posts.append({
-                        'title': title,
-                        'url': url,
-                        'subreddit': subreddit,
-                        'permalink': f"https://reddit.com{post_data.get('permalink', '')}"
-                    })
-            
-            return posts
+            url = f"{REDDIT_BASE_URL}/r/{subreddit}/hot.json?limit={limit}"
+            return await self._get_json(
+                url, 'reddit:json', lambda data, known: self._parse_listing(data, subreddit, known)
+            )
             
+        except SubredditUnavailable:
+            raise
         except Exception as e:
-            logger.debug(f"JSON endpoint failed for r/{subreddit}: {e}")
+            logger.debug("JSON endpoint failed for r/%s: %s", subreddit, e)
             return []
     
-    def _try_rss_feed(self, subreddit: str, limit: int) -> list:
+    async def _try_rss_feed(self, subreddit: str, limit: int) -> list:
         """Try to fetch from Reddit's RSS feed."""
         try:
-            url = f"https://www.reddit.com/r/{subreddit}/hot/.rss?limit={limit}"
-            response = self.session.get(url, timeout=10)
-            response.raise_for_status()
-            
-            # Parse RSS content
-            content = response.text
-            posts = []
+            url = f"{REDDIT_BASE_URL}/r/{subreddit}/hot/.rss?limit={limit}"
+            parser = FeedParser(subreddit, limit)
             
-            # Extract items from RSS
-            item_pattern = r'<item>(.*?)</item>'
-            items = re.findall(item_pattern, content, re.DOTALL)
+            # Stream the body and stop reading once enough posts are found
+            async with self._open(url, 'reddit:rss') as response:
+                async for chunk in response.aiter_bytes(FEED_CHUNK_SIZE):
+                    parser.feed(chunk)
+                    if parser.done:
+                        break
             
-            for item in items:
-                # Extract title
-                title_match = re.search(r'<title>(.*?)</title>', item)
-                title = title_match.group(1) if title_match else 'No title'
-                
-                # Extract link
-                link_match = re.search(r'<link>(.*?)</link>', item)
-                link = link_match.group(1) if link_match else ''
-                
-                # Extract media content from description
-                desc_match = re.search(r'<description>(.*?)</description>', item)
-                if desc_match:
-                    description = desc_match.group(1)
-                    # Look for image URLs in description
-                    img_pattern = r'<img[^>]+src=["\']([^"\']+)["\'][^>]*>'
-                    img_matches = re.findall(img_pattern, description)
-                    
-                    for img_url in img_matches:
-                        if self._is_valid_media_url(img_url):
-                            posts.append({
-                                'title': title,
-                                'url': img_url,
-                                'subreddit': subreddit,
-                                'permalink': link
-                            })
-                            break  # Use first valid image per post
-            
-            return posts
+            return parser.posts
             
+        except SubredditUnavailable:
+            raise
         except Exception as e:
-            logger.debug(f"RSS feed failed for r/{subreddit}: {e}")
+            logger.debug("RSS feed failed for r/%s: %s", subreddit, e)
             return []
     
-    def _try_alternative_json(self, subreddit: str, limit: int) -> list:
-        """Try alternative JSON endpoint with different parameters."""
-        try:
-            # Try with different sorting
-            urls_to_try = [
-                f"https://www.reddit.com/r/{subreddit}/top.json?t=day&limit={limit}",
-                f"https://www.reddit.com/r/{subreddit}/new.json?limit={limit}",
-                f"https://www.reddit.com/r/{subreddit}/rising.json?limit={limit}"
-            ]
-            
-            for url in urls_to_try:
-                try:
-                    response = self.session.get(url, timeout=10)
-                    response.raise_for_status()
-                    
-                    data = response.json()
-                    posts = []
-                    
-                    for post in data['data']['children']:
-                        post_data = post['data']
-                        
-                        url = post_data.get('url', '')
-                        title = post_data.get('title', 'No title')
-                        
-                        if self._is_valid_media_url(url):
-                            posts.append({
-                                'title': title,
-                                'url': url,
-                                'subreddit': subreddit,
-                                'permalink': f"https://reddit.com{post_data.get('permalink', '')}"
-                            })
+    async def _try_alternative_json(self, subreddit: str, limit: int) -> list:
+        """Try alternative JSON endpoints with different sorting."""
+        urls_to_try = [
+            ('reddit:top', f"{REDDIT_BASE_URL}/r/{subreddit}/top.json?t=day&limit={limit}"),
+            ('reddit:new', f"{REDDIT_BASE_URL}/r/{subreddit}/new.json?limit={limit}"),
+            ('reddit:rising', f"{REDDIT_BASE_URL}/r/{subreddit}/rising.json?limit={limit}")
+        ]
+        
+        for source, url in urls_to_try:
+            try:
+                posts = await self._get_json(
+                    url, source, lambda data, known: self._parse_listing(data, subreddit, known)
+                )
+                
+                if posts:
+                    return posts
                     
-                    if posts:
-                        return posts
-                        
-                except Exception as e:
-                    logger.debug(f"Alternative JSON failed for {url}: {e}")
-                    continue
-            
-            return []
-            
-        except Exception as e:
-            logger.debug(f"All alternative JSON endpoints failed for r/{subreddit}: {e}")
-            return []
+            except SubredditUnavailable:
+                raise
+            except Exception as e:
+                logger.debug("Alternative JSON failed for %s: %s", url, e)
+                continue
+        
+        return []
     
-    def _try_giphy_meme(self) -> Optional[Dict[str, Any]]:
+    async def _try_giphy_meme(self) -> Optional[Meme]:
         """Try to get a meme from Giphy as fallback."""
         try:
-            # Giphy trending endpoint (no API key required for basic usage)
-            url = "https://api.giphy.com/v1/gifs/trending"
-            params = {
-                'api_key': 'dc6zaTOxFJmzC',  # Public beta key
-                'limit': 50,
-                'rating': 'g'
-            }
-            
-            response = self.session.get(url, params=params, timeout=10)
-            response.raise_for_status()
+            url = f"{GIPHY_BASE_URL}/v1/gifs/trending"
+            data = await self._get_json(url, 'giphy', lambda data, known: data, params=GIPHY_PARAMS)
             
-            data = response.json()
-            
-            if 'data' in data and data['data']:
-                # Randomly select a gif
-                gif = random.choice(data['data'])
-                
-                meme = {
-                    'title': gif.get('title', 'Random Meme'),
-                    'url': gif['images']['original']['url'],
-                    'subreddit': 'giphy',
-                    'permalink': gif.get('url', ''),
-                    'source': 'Giphy'
-                }
-                
-                logger.info(f"Selected Giphy meme: {meme['title'][:50]}...")
-                return meme
-            
-            return None
+            return self._parse_giphy(data)
             
         except Exception as e:
-            logger.debug(f"Giphy fallback failed: {e}")
+            logger.debug("Giphy fallback failed: %s", e)
             return None
+
+
+class SharedStoreFetcher(AsyncMemeFetcher):
+    """
+    Fetcher for sharded workers: pools come from a ``SharedMemeStore``.
     
-    def _get_fallback_meme(self) -> Dict[str, Any]:
-        """Get a random meme from the hardcoded fallback list."""
-        meme = random.choice(FALLBACK_MEMES)
-        logger.info(f"Using fallback meme: {meme['title']}")
-        return meme
+    Workers never fetch from Reddit or Giphy (beyond /subreddits checking
+    that a subreddit exists); the fetcher process does that once for all
+    of them. ``refresh_pools`` is a cheap poll of the store's version and
+    reloads only the subreddits whose generation changed, along with chat
+    subreddit lists other workers changed. A pool keeps the age
+    the fetcher gave it, so a stalled fetcher shows up as stale pools and,
+    eventually, the hardcoded fallback. Draws are counted locally and handed
+    to the fetcher's scheduler through the store on every poll.
+    """
     
-    def _is_valid_media_url(self, url: str) -> bool:
-        """
-        Check if URL points to a valid image or video file.
-        
-        Args:
-            url: URL to check
-            
-        Returns:
-            True if URL is a valid media file
-        """
-        if not url:
-            return False
-        
-        # Common image extensions
-        image_extensions = ['.jpg', '.jpeg', '.png', '.gif', '.webp']
-        # Common video extensions
-        video_extensions = ['.mp4', '.gifv', '.webm']
-        
-        url_lower = url.lower()
-        
-        # Check for image extensions
-        if any(ext in url_lower for ext in image_extensions):
-            return True
-        
-        # Check for video extensions
-        if any(ext in url_lower for ext in video_extensions):
-            return True
-        
-        # Check for common image hosting domains
-        image_domains = [
-            'imgur.com', 'i.imgur.com', 'redd.it', 'i.redd.it',
-            'media.giphy.com', 'giphy.com', 'tenor.com', 'gfycat.com',
-            'v.redd.it', 'preview.redd.it'
-        ]
-        
-        if any(domain in url_lower for domain in image_domains):
-            return True
+    def __init__(self, store: SharedMemeStore, **kwargs):
+        super().__init__(store=store, **kwargs)
+        self._store_version: Optional[int] = None
+        self._draws: Dict[str, int] = {}
+    
+    async def refresh_pool(self, subreddit: str, limit: int = 50) -> bool:
+        """Reload one pool from the store if the fetcher has published a newer listing."""
+        return self._load_pool(subreddit)
+    
+    async def refresh_pools(self) -> None:
+        """Hand over the draws counted and reload whatever the store has changed since the last poll."""
+        try:
+            if self._draws:
+                self.store.add_draws(self._draws)
+                self._draws = {}
+            version = self.store.version()
+            if version == self._store_version:
+                return
+            self._store_version = version
+            generations = self.store.generations()
+            changes, self._chat_change = self.store.load_chat_subreddits(self._chat_change)
+        except sqlite3.Error as e:
+            logger.warning("Could not poll the shared store: %s", e)
+            return
         
-        return False
+        self._apply_chat_subreddits(changes)
+        for subreddit, (generation, _) in generations.items():
+            if subreddit in self.pools and generation != self._generations.get(subreddit):
+                self._load_pool(subreddit)
+    
+    def _record_draw(self, subreddit: str) -> None:
+        """Count a draw for the fetcher's scheduler; the worker schedules no refreshes itself."""
+        self._draws[subreddit] = self._draws.get(subreddit, 0) + 1
+    
+    async def _race_sources(self, subreddit: str) -> Optional[Meme]:
+        """Cold pool: check the store once instead of going upstream."""
+        await self._refresh_shared(subreddit)
+        return self._pick_meme(self.pools[subreddit].memes, subreddit)
+    
+    def save_snapshot(self) -> None:
+        """Workers make no upstream requests, so the fetcher's source health is left alone."""
+
+
+def _build_fetcher() -> AsyncMemeFetcher:
+    """Create the meme fetcher for this process's shard role."""
+    if SHARD_ROLE == 'worker':
+        # Pools in the store were validated and deduplicated by the fetcher process
+        return SharedStoreFetcher(SharedMemeStore(MEME_STORE_PATH), validate=False, dedup=False)
+    if SHARD_ROLE == 'fetcher':
+        return AsyncMemeFetcher(store=SharedMemeStore(MEME_STORE_PATH))
+    return AsyncMemeFetcher()
 
 
 # Global meme fetcher instance
-meme_fetcher = MemeFetcher()
+meme_fetcher = _build_fetcher()
+
+# Global Telegram file_id cache, persisted to the store instead when there is one
+file_id_cache = FileIdCache(path=None if MEME_STORE_PATH else FILE_ID_CACHE_PATH)
+
+# Global /make template renderer
+template_renderer = TemplateRenderer()
+
+# Global on-disk media cache (None unless MEDIA_CACHE_DIR is set) and per-host URL delivery stats
+media_cache = MediaCache(MEDIA_CACHE_DIR) if MEDIA_CACHE_DIR else None
+host_delivery = HostDeliveryStats()
+
+# Global per-user/per-chat command rate limiter
+rate_limiter = CommandRateLimiter()
+
+# Metrics read from the fetcher's state at scrape time
+metrics.register(Gauge(
+    'meme_pool_size', 'Memes in each subreddit pool', ['subreddit'],
+    collect=lambda: {(name, ): len(pool) for name, pool in meme_fetcher.pools.items()}))
+metrics.register(Gauge(
+    'meme_pool_age_seconds', 'Seconds since each subreddit pool was filled', ['subreddit'],
+    collect=lambda: {(name, ): pool.age() for name, pool in meme_fetcher.pools.items() if len(pool)}))
+metrics.register(Gauge(
+    'telegram_file_id_cache_size', 'Entries in the file_id cache',
+    collect=lambda: {(): len(file_id_cache)}))
+metrics.register(Gauge(
+    'meme_media_cache_bytes', 'Bytes of media in the on-disk cache',
+    collect=lambda: {(): media_cache.total_bytes} if media_cache is not None else {}))
+metrics.register(Gauge(
+    'meme_circuit_open', 'Whether each source circuit is open (1) or not (0)', ['source'],
+    collect=lambda: {(name, ): float(b.state != CircuitBreaker.CLOSED)
+                     for name, b in meme_fetcher.health.breakers.items()}))
+metrics.register(Counter(
+    'meme_conditional_not_modified_total', 'Conditional GETs answered 304 Not Modified',
+    collect=lambda: {(): meme_fetcher.conditional_stats.not_modified}))
+metrics.register(Counter(
+    'meme_conditional_bytes_saved_total', 'Response bytes not downloaded thanks to 304s',
+    collect=lambda: {(): meme_fetcher.conditional_stats.bytes_saved}))
+metrics.register(Counter(
+    'meme_conditional_parse_seconds_saved_total', 'Parse time not spent thanks to 304s',
+    collect=lambda: {(): meme_fetcher.conditional_stats.parse_seconds_saved}))
+metrics.register(Counter(
+    'meme_posts_reused_total', 'Listing posts reused from the previous parse',
+    collect=lambda: {(): meme_fetcher.conditional_stats.posts_reused}))
+metrics.register(Gauge(
+    'meme_refresh_interval_seconds', 'Seconds between scheduled refreshes of each subreddit', ['subreddit'],
+    collect=lambda: {(name, ): entry.interval for name, entry in meme_fetcher.scheduler.entries.items()}))
+metrics.register(Gauge(
+    'meme_subreddit_draws_per_hour', 'Recent /meme draws per hour from each subreddit', ['subreddit'],
+    collect=lambda: {(name, ): meme_fetcher.scheduler.demand_rate(entry) * 3600
+                     for name, entry in meme_fetcher.scheduler.entries.items()}))
+metrics.register(Gauge(
+    'meme_listing_change_per_hour', 'Share of each subreddit listing that is new per hour', ['subreddit'],
+    collect=lambda: {(name, ): entry.change_rate * 3600 for name, entry in meme_fetcher.scheduler.entries.items()
+                     if entry.change_rate is not None}))
+metrics.register(Counter(
+    'meme_scheduled_refreshes_total', 'Scheduled pool refreshes by outcome (changed, unchanged, failed)',
+    ['subreddit', 'outcome'],
+    collect=lambda: {key: value for name, entry in meme_fetcher.scheduler.entries.items()
+                     for key, value in (((name, 'changed'), entry.changed), ((name, 'unchanged'), entry.unchanged),
+                                        ((name, 'failed'), entry.failed))}))
+metrics.register(Gauge(
+    'meme_subreddits_quarantined', 'Subreddits Reddit reported missing, private or banned',
+    collect=lambda: {(): meme_fetcher.scheduler.quarantined()}))
+metrics.register(Gauge(
+    'meme_refresh_overdue', 'Subreddits waiting past the time their refresh fell due',
+    collect=lambda: {(): meme_fetcher.scheduler.overdue()} if meme_fetcher.scheduler.running else {}))
+
+
+def _extract_file_id(message: Message, media_type: str) -> Optional[str]:
+    """Pull the file_id of the media Telegram stored for a sent message."""
+    if media_type == 'photo' and message.photo:
+        return message.photo[-1].file_id
+    if media_type == 'animation' and message.animation:
+        return message.animation.file_id
+    if media_type == 'video' and message.video:
+        return message.video.file_id
+    # Telegram may store e.g. a webm as a plain document
+    if message.document:
+        return message.document.file_id
+    return None
+
+
+def meme_caption(meme: Meme) -> str:
+    """HTML caption with the meme's title and source."""
+    return f"🎭 {html.escape(meme.title, quote=False)}\n\n📱 Source: {meme.source_label}"
+
+
+async def send_meme(bot, chat_id: int, meme: Meme, caption: str) -> Message:
+    """
+    Send a meme with the method matching its media type.
+    
+    Reuses the cached Telegram file_id when the URL was sent before, and
+    records the file_id of first-time sends. With a media cache, the bytes
+    are uploaded instead of the URL when they are already on disk, when
+    the host is known to be slow or failing for Telegram, and as a retry
+    when Telegram can't fetch the URL.
+    """
+    senders = {
+        'photo': bot.send_photo,
+        'animation': bot.send_animation,
+        'video': bot.send_video,
+    }
+    url = meme.url
+    
+    cached = file_id_cache.get(url)
+    FILE_ID_LOOKUPS.inc('hit' if cached is not None else 'miss')
+    if cached is not None:
+        media_type, file_id = cached
+        try:
+            with span('send'), TELEGRAM_SEND_SECONDS.time(media_type, 'file_id'):
+                return await senders[media_type](
+                    chat_id, file_id, caption=caption, parse_mode='HTML'
+                )
+        except BadRequest as e:
+            logger.info("Cached file_id rejected for %s, resending by URL: %s", url, e)
+            file_id_cache.discard(url)
+    
+    kind = classify_media_url(url)
+    media_type = kind.send_method if kind is not None else 'photo'
+    message = None
+    if media_cache is not None and (media_cache.get(url) or host_delivery.prefers_upload(url)):
+        message = await upload_meme(senders[media_type], chat_id, url, media_type, caption)
+    
+    if message is None:
+        started = time.perf_counter()
+        try:
+            with span('send'), TELEGRAM_SEND_SECONDS.time(media_type, 'url'):
+                message = await senders[media_type](
+                    chat_id, delivery_url(url), caption=caption, parse_mode='HTML'
+                )
+        except BadRequest as e:
+            if media_cache is None or not is_fetch_error(e):
+                raise
+            logger.info("Telegram could not fetch %s, uploading it instead: %s", url, e)
+            host_delivery.record_failure(url)
+            message = await upload_meme(senders[media_type], chat_id, url, media_type, caption)
+            if message is None:
+                raise
+        else:
+            host_delivery.record_send(url, time.perf_counter() - started)
+    
+    file_id = _extract_file_id(message, media_type)
+    if file_id:
+        file_id_cache.put(url, media_type, file_id)
+    
+    return message
+
+
+def is_fetch_error(error: BadRequest) -> bool:
+    """True if Telegram rejected a send because it couldn't fetch the media URL."""
+    message = error.message.lower()
+    return any(fragment in message for fragment in TELEGRAM_FETCH_ERRORS)
+
+
+async def upload_meme(sender: Callable[..., Awaitable[Message]], chat_id: int, url: str,
+                      media_type: str, caption: str) -> Optional[Message]:
+    """
+    Send a meme by uploading its bytes from the media cache.
+    
+    Downloads the media into the cache first if needed. python-telegram-bot
+    sends an upload from one in-memory buffer, so the file is read whole,
+    in a worker thread to keep the event loop free.
+    
+    Returns:
+        The sent message, or None if the media couldn't be downloaded
+    """
+    limit = TELEGRAM_PHOTO_UPLOAD_LIMIT if media_type == 'photo' else TELEGRAM_FILE_UPLOAD_LIMIT
+    path = await media_cache.fetch(meme_fetcher.client, url, limit)
+    if path is None:
+        return None
+    
+    try:
+        data = await asyncio.to_thread(_read_file, path)
+    except OSError as e:
+        # Evicted between download and upload
+        logger.info("Could not upload %s from %s: %s", url, path, e)
+        return None
+    
+    with span('send'), TELEGRAM_SEND_SECONDS.time(media_type, 'upload'):
+        return await sender(chat_id, data, filename=os.path.basename(path), caption=caption, parse_mode='HTML')
+
 
+def _read_file(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
 
-async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+
+async def start_command(update: Update, context: 'ContextTypes.DEFAULT_TYPE') -> None:
     """Handle the /start command."""
     welcome_message = "Hi! Send /meme to get a random meme from Reddit! 🎭"
     await update.message.reply_text(welcome_message)
 
 
-async def meme_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle the /meme command."""
+async def meme_command(update: Update, context: 'ContextTypes.DEFAULT_TYPE') -> None:
+    """Handle the /meme command, timing it and tracing a sample of commands."""
+    trace = Trace('/meme') if TRACE_SAMPLE_RATE and random.random() < TRACE_SAMPLE_RATE else None
+    token = _current_trace.set(trace)
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        outcome = await _serve_meme(update, context)
+    finally:
+        COMMAND_SECONDS.observe(time.perf_counter() - started, outcome)
+        _current_trace.reset(token)
+        if trace is not None:
+            trace.finish()
+            rendered = trace.render()
+            recent_traces.append(rendered)
+            logger.info("Trace %s", rendered)
+
+
+async def _wait_for_rate_limit(update: Update) -> bool:
+    """Wait out the chat's command rate limit; False (after warning the chat) if it's exhausted."""
+    chat_id = update.effective_chat.id
+    user_id = update.effective_user.id if update.effective_user else None
+    
+    delay = rate_limiter.acquire(user_id, chat_id)
+    if delay is None:
+        if rate_limiter.should_notify(chat_id):
+            await update.message.reply_text("Whoa, slow down! ⏳ Try again in a few seconds.")
+        return False
+    if delay > 0:
+        with span('rate_limit'):
+            await asyncio.sleep(delay)
+    return True
+
+
+async def _serve_meme(update: Update, context: 'ContextTypes.DEFAULT_TYPE') -> str:
+    """Rate-limit, fetch and send one meme; return the outcome for metrics."""
+    if not await _wait_for_rate_limit(update):
+        return 'rate_limited'
+    
     # Send a typing indicator
-    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="upload_photo")
+    with span('chat_action'):
+        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="upload_photo")
     
     try:
         # Get a random meme
-        meme = meme_fetcher.get_random_meme()
+        with span('fetch'):
+            meme = await meme_fetcher.get_random_meme(chat_id=update.effective_chat.id)
         
         if not meme:
             await update.message.reply_text(
                 "Sorry! I couldn't fetch a meme right now. Please try again later! 😔"
             )
-            return
+            return 'no_meme'
         
-        # Create caption with title and source
-        if meme.get('source') == 'Giphy':
-            caption = f"🎭 {meme['title']}\n\n📱 Source: Giphy"
-        elif meme.get('source') == 'Fallback':
-            caption = f"🎭 {meme['title']}\n\n📱 Source: Classic Memes"
-        else:
-            caption = f"🎭 {meme['title']}\n\n📱 Source: r/{meme['subreddit']}"
-        
-        # Send the meme
-        await context.bot.send_photo(
-            chat_id=update.effective_chat.id,
-            photo=meme['url'],
-            caption=caption,
-            parse_mode='HTML'
-        )
+        # Send the meme, and only then keep it from being repeated in the chat
+        await send_meme(context.bot, update.effective_chat.id, meme, meme_caption(meme))
+        meme_fetcher.seen.mark_seen(update.effective_chat.id, meme.url)
+        return 'sent'
         
     except Exception as e:
-        logger.error(f"Error sending meme: {e}")
+        logger.error("Error sending meme: %s", e)
         await update.message.reply_text(
             "Oops! Something went wrong while fetching your meme. Please try again! 😅"
         )
+        return 'error'
+
+
+async def make_command(update: Update, context: 'ContextTypes.DEFAULT_TYPE') -> None:
+    """Handle /make <template> top text | bottom text: render a captioned meme."""
+    name, _, captions = ' '.join(context.args or ()).partition(' ')
+    name = name.lower()
+    if name not in template_renderer.templates:
+        names = ', '.join(template_renderer.templates) or 'none installed'
+        await update.message.reply_text(
+            f"Usage: /make <template> top text | bottom text\nTemplates: {names}"
+        )
+        return
+    
+    top, _, bottom = captions.partition('|')
+    top, bottom = meme_templates.normalize_caption(top), meme_templates.normalize_caption(bottom)
+    if not await _wait_for_rate_limit(update):
+        return
+    
+    chat_id = update.effective_chat.id
+    await context.bot.send_chat_action(chat_id=chat_id, action="upload_photo")
+    try:
+        # Telegram already has identical memes; send those by file_id
+        cache_key = f"make:{template_renderer.key(name, top, bottom)}"
+        cached = file_id_cache.get(cache_key)
+        if cached is not None:
+            try:
+                await context.bot.send_photo(chat_id, cached[1])
+                RENDERS.inc('file_id')
+                return
+            except BadRequest as e:
+                logger.info("Cached file_id rejected for /make %s, rendering it again: %s", name, e)
+                file_id_cache.discard(cache_key)
+        
+        data = await template_renderer.render(name, top, bottom)
+        with span('send'), TELEGRAM_SEND_SECONDS.time('photo', 'upload'):
+            message = await context.bot.send_photo(chat_id, data, filename=f"{name}.jpg")
+        file_id = _extract_file_id(message, 'photo')
+        if file_id:
+            file_id_cache.put(cache_key, 'photo', file_id)
+    except Exception as e:
+        logger.error("Error making meme: %s", e)
+        await update.message.reply_text(
+            "Oops! Something went wrong while making your meme. Please try again! 😅"
+        )
+
+
+def inline_result(meme: Meme) -> Optional[InlineQueryResult]:
+    """
+    Inline query result for a meme.
+    
+    Media Telegram already has is sent by its cached file_id. Otherwise the
+    URL is used, with the media itself as the thumbnail.
+    
+    Returns:
+        The result, or None for media that inline mode can't send by URL
+    """
+    result_id = hashlib.blake2b(meme.url.encode(), digest_size=16).hexdigest()
+    caption = meme_caption(meme)
+    
+    cached = file_id_cache.get(meme.url)
+    if cached is not None:
+        media_type, file_id = cached
+        if media_type == 'photo':
+            return InlineQueryResultCachedPhoto(result_id, file_id, caption=caption, parse_mode='HTML')
+        if media_type == 'animation':
+            return InlineQueryResultCachedGif(result_id, file_id, caption=caption, parse_mode='HTML')
+        return InlineQueryResultCachedVideo(result_id, file_id, meme.title[:64] or 'Meme',
+                                            caption=caption, parse_mode='HTML')
+    
+    url = delivery_url(meme.url)
+    kind = classify_media_url(url)
+    if kind is MediaKind.IMAGE:
+        return InlineQueryResultPhoto(result_id, url, url, caption=caption, parse_mode='HTML')
+    if kind is MediaKind.GIF and url.split('?', 1)[0].lower().endswith('.gif'):
+        return InlineQueryResultGif(result_id, url, url, thumbnail_mime_type='image/gif',
+                                    caption=caption, parse_mode='HTML')
+    if kind is not None and url.split('?', 1)[0].lower().endswith('.mp4'):
+        # Reddit's fallback videos carry no sound track, so they are GIF-like anyway
+        return InlineQueryResultMpeg4Gif(result_id, url, url, thumbnail_mime_type='video/mp4',
+                                         caption=caption, parse_mode='HTML')
+    return None
+
+
+async def inline_query(update: Update, context: 'ContextTypes.DEFAULT_TYPE') -> None:
+    """
+    Answer an inline query (``@bot cats``) with a page of matching memes.
+    
+    Served from the warm pools only, never from upstream, so it fits
+    Telegram's inline deadline. The offset Telegram echoes back for the
+    next page is the number of results already shown.
+    """
+    query = update.inline_query
+    started = time.perf_counter()
+    offset = int(query.offset) if query.offset.isdigit() else 0
+    memes, more = meme_fetcher.search(query.query, offset, INLINE_PAGE_SIZE)
+    results = [result for result in map(inline_result, memes) if result is not None]
+    next_offset = str(offset + INLINE_PAGE_SIZE) if more else ''
+    
+    outcome = 'results' if results else 'empty'
+    try:
+        await query.answer(results, cache_time=INLINE_CACHE_TIME, next_offset=next_offset)
+    except BadRequest as e:
+        # Typically the query expired while waiting in the update queue
+        logger.info("Could not answer inline query %r: %s", query.query, e)
+        outcome = 'error'
+    finally:
+        INLINE_QUERY_SECONDS.observe(time.perf_counter() - started, outcome)
+
+
+_SUBREDDIT_NAME = re.compile(r'^[a-z0-9][a-z0-9_]{1,20}$')
+
+
+async def subreddits_command(update: Update, context: 'ContextTypes.DEFAULT_TYPE') -> None:
+    """
+    Handle /subreddits [add|remove <names> | reset]: show or change where the chat's memes come from.
+    
+    Rate-limited like /meme. Subreddits new to the bot are only added once
+    Reddit confirms they exist and are public and SFW.
+    """
+    if not await _wait_for_rate_limit(update):
+        return
+    
+    chat_id = update.effective_chat.id
+    args = [arg.lower() for arg in context.args or ()]
+    action = args[0] if args else ''
+    names = [name[2:] if name.startswith('r/') else name for name in args[1:]]
+    subreddits = list(meme_fetcher.subreddits_for(chat_id))
+    
+    if action in ('add', 'remove') and names:
+        invalid = [name for name in names if not _SUBREDDIT_NAME.match(name)]
+        if invalid:
+            await update.message.reply_text(f"Not a subreddit name: {', '.join(invalid)}")
+            return
+        if action == 'add':
+            added = [name for name in dict.fromkeys(names) if name not in subreddits]
+            subreddits += added
+            new = [name for name in added if name not in meme_fetcher.pools]
+            if len(subreddits) > CHAT_MAX_SUBREDDITS:
+                await update.message.reply_text(f"A chat can draw from at most {CHAT_MAX_SUBREDDITS} subreddits.")
+                return
+            if new and len(meme_fetcher.pools) + len(new) > MAX_SUBREDDITS:
+                await update.message.reply_text("Sorry, the bot can't follow any more subreddits right now.")
+                return
+            if len(new) > SUBREDDIT_CHECKS_PER_COMMAND:
+                await update.message.reply_text(f"Please add at most {SUBREDDIT_CHECKS_PER_COMMAND} "
+                                                f"new subreddits at a time.")
+                return
+            if not await _check_subreddits(update, added, new):
+                return
+        else:
+            subreddits = [name for name in subreddits if name not in names]
+            if not subreddits:
+                await update.message.reply_text("A chat needs at least one subreddit; use /subreddits reset "
+                                                "to go back to the defaults.")
+                return
+    elif action == 'reset':
+        subreddits = list(meme_fetcher.default_subreddits)
+    elif action:
+        await update.message.reply_text("Usage: /subreddits [add|remove <names> | reset]")
+        return
+    
+    if action:
+        chosen = () if subreddits == list(meme_fetcher.default_subreddits) else subreddits
+        meme_fetcher.set_chat_subreddits(chat_id, chosen)
+    listed = ', '.join(f"r/{name}" for name in subreddits)
+    await update.message.reply_text(f"Memes in this chat come from {listed}.\n"
+                                    f"Change them with /subreddits add|remove <names>, or /subreddits reset.")
+
+
+async def _check_subreddits(update: Update, added: List[str], new: List[str]) -> bool:
+    """Ask Reddit about subreddits new to the bot; False (after telling the chat why) if any can't be added."""
+    unavailable = [name for name in added if meme_fetcher.scheduler.is_quarantined(name)]
+    unchecked = []
+    results = await asyncio.gather(*(meme_fetcher.check_subreddit(name) for name in new), return_exceptions=True)
+    for name, result in zip(new, results):
+        if isinstance(result, SubredditUnavailable):
+            unavailable.append(name)
+        elif isinstance(result, Exception):
+            logger.info("Could not check r/%s: %s", name, result)
+            unchecked.append(name)
+    
+    if unavailable:
+        listed = ', '.join(f"r/{name}" for name in unavailable)
+        await update.message.reply_text(f"Couldn't find a public, SFW subreddit for {listed}.")
+        return False
+    if unchecked:
+        listed = ', '.join(f"r/{name}" for name in unchecked)
+        await update.message.reply_text(f"Couldn't check {listed} with Reddit right now. Please try again later!")
+        return False
+    return True
 
 
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def help_command(update: Update, context: 'ContextTypes.DEFAULT_TYPE') -> None:
     """Handle the /help command."""
-    help_text = """
+    help_text = f"""
 🤖 <b>Meme Bot Commands:</b>
 
 /meme - Get a random meme from Reddit (or fallback sources)
+/make &lt;template&gt; top text | bottom text - Caption a meme template
+/subreddits [add|remove &lt;names&gt; | reset] - Choose the subreddits for this chat
 /start - Start the bot
 /help - Show this help message
 
-<i>Memes are fetched from r/memes, r/dankmemes, and r/wholesomememes. If Reddit is unavailable, Giphy and classic memes are used as fallbacks.</i>
+Type <code>@{context.bot.username} cats</code> in any chat to search the latest memes by title.
+
+<i>By default memes are fetched from r/memes, r/dankmemes, and r/wholesomememes. If Reddit is unavailable, Giphy and classic memes are used as fallbacks.</i>
     """
     await update.message.reply_text(help_text, parse_mode='HTML')
 
 
+async def health_command(update: Update, context: 'ContextTypes.DEFAULT_TYPE') -> None:
+    """Handle the /health admin command: show the source circuit breakers."""
+    if update.effective_user is None or update.effective_user.id not in ADMIN_USER_IDS:
+        await update.message.reply_text("Sorry, this command is for bot admins only.")
+        return
+    
+    report = f"{meme_fetcher.health.scoreboard()}\n\n{meme_fetcher.conditional_stats.summary()}"
+    if meme_fetcher.scheduler.running:
+        report += f"\n\n{meme_fetcher.scheduler.summary()}\n{meme_fetcher.scheduler.report()}"
+    await update.message.reply_text(f"<pre>{html.escape(report)}</pre>", parse_mode='HTML')
+
+
+async def refresh_meme_pools(context: 'ContextTypes.DEFAULT_TYPE') -> None:
+    """Job queue callback that keeps the subreddit pools warm and the snapshot current."""
+    # With the adaptive scheduler running, the pools are already on their own schedules
+    if not meme_fetcher.scheduler.running:
+        await meme_fetcher.refresh_pools()
+    save_snapshot()
+
+
+def save_snapshot() -> None:
+    """Write source health and file_ids to the store (pools are written through on refresh)."""
+    if meme_fetcher.store is None:
+        return
+    
+    meme_fetcher.save_snapshot()
+    try:
+        meme_fetcher.store.save_file_ids(file_id_cache.items(), file_id_cache.max_entries)
+    except sqlite3.Error as e:
+        logger.warning("Could not save file_ids to %s: %s", meme_fetcher.store.path, e)
+
+
+async def start_monitoring() -> List[Any]:
+    """Start the event loop lag monitor and, if configured, the metrics endpoint."""
+    resources: List[Any] = [asyncio.get_running_loop().create_task(monitor_event_loop_lag())]
+    if METRICS_PORT:
+        try:
+            resources.append(await start_metrics_server())
+        except OSError as e:
+            logger.warning("Could not serve metrics on %s:%s: %s", METRICS_LISTEN, METRICS_PORT, e)
+    return resources
+
+
+async def stop_monitoring(resources: List[Any]) -> None:
+    """Stop what ``start_monitoring`` started (and any other tasks added to ``resources``)."""
+    tasks = [resource for resource in resources if isinstance(resource, asyncio.Task)]
+    for task in tasks:
+        task.cancel()
+    for resource in resources:
+        if not isinstance(resource, asyncio.Task):
+            resource.close()
+            await resource.wait_closed()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def restore_snapshot() -> None:
+    """Open the store and restore the last snapshot so the first commands are served warm."""
+    if meme_fetcher.store is None and MEME_STORE_PATH:
+        try:
+            meme_fetcher.store = SharedMemeStore(MEME_STORE_PATH)
+        except sqlite3.Error as e:
+            logger.warning("Could not open %s, starting cold: %s", MEME_STORE_PATH, e)
+            return
+    if meme_fetcher.store is None:
+        return
+    
+    meme_fetcher.load_snapshot()
+    try:
+        file_id_cache.attach(meme_fetcher.store)
+    except sqlite3.Error as e:
+        logger.warning("Could not restore file_ids from %s: %s", meme_fetcher.store.path, e)
+
+
+async def prewarm() -> None:
+    """
+    Get what the first commands need ready: restore the snapshot, refill
+    the pools that aren't fresh (opening the upstream and media host
+    connections on the way), then start the /make render processes. The
+    render processes come last so they don't compete with the pools for CPU.
+    """
+    started = time.perf_counter()
+    restore_snapshot()
+    await meme_fetcher.warm()
+    logger.info("Pre-warmed pools in %.1fms", (time.perf_counter() - started) * 1000)
+    try:
+        await template_renderer.warm()
+    except (OSError, BrokenProcessPool) as e:
+        logger.warning("Could not start the render workers: %s", e)
+
+
+async def post_init(application: 'Application') -> None:
+    """Start monitoring, restore the snapshot and kick off the first pool refresh (or the scheduler)."""
+    loop = asyncio.get_running_loop()
+    monitoring = await start_monitoring()
+    warming = application.bot_data.pop('prewarm', None)
+    if warming is not None:
+        # main() already started both on this loop
+        monitoring.append(warming)
+    else:
+        restore_snapshot()
+    
+    if ADAPTIVE_REFRESH and SHARD_ROLE != 'worker':
+        # Pools the snapshot didn't restore are due at once
+        monitoring.append(loop.create_task(meme_fetcher.run_scheduler()))
+    elif warming is None:
+        # The job queue's first run is one interval away: APScheduler skips a
+        # first=0 run that falls due before the scheduler has started.
+        monitoring.append(loop.create_task(meme_fetcher.refresh_pools()))
+    application.bot_data['monitoring'] = monitoring
+
+
+async def post_shutdown(application: 'Application') -> None:
+    """Snapshot state, release the fetcher's connection pool and persist caches when the bot stops."""
+    await stop_monitoring(application.bot_data.get('monitoring', []))
+    save_snapshot()
+    await meme_fetcher.aclose()
+    template_renderer.shutdown()
+    file_id_cache.save()
+
+
+async def run_fetcher() -> None:
+    """Shard fetcher loop: keep the shared store filled without serving any updates."""
+    logger.info("Fetcher filling shared store %s", MEME_STORE_PATH)
+    meme_fetcher.load_snapshot()
+    monitoring = await start_monitoring()
+    if ADAPTIVE_REFRESH:
+        monitoring.append(asyncio.get_running_loop().create_task(meme_fetcher.run_scheduler()))
+    try:
+        snapshot_due = time.monotonic() + POOL_REFRESH_INTERVAL
+        while True:
+            if not ADAPTIVE_REFRESH:
+                await meme_fetcher.refresh_pools()
+                meme_fetcher.save_snapshot()
+                await asyncio.sleep(POOL_REFRESH_INTERVAL)
+                continue
+            
+            # The scheduler refreshes the pools; feed it the workers' chat lists and draws
+            meme_fetcher.sync_store()
+            if time.monotonic() >= snapshot_due:
+                meme_fetcher.save_snapshot()
+                snapshot_due = time.monotonic() + POOL_REFRESH_INTERVAL
+            await asyncio.sleep(SHARED_STORE_POLL_INTERVAL)
+    finally:
+        await stop_monitoring(monitoring)
+        meme_fetcher.save_snapshot()
+        await meme_fetcher.aclose()
+
+
+def run_supervisor() -> None:
+    """
+    Run a sharded deployment on this machine.
+    
+    Starts one fetcher process and ``SHARD_WORKERS`` webhook workers, worker
+    ``i`` listening on ``WEBHOOK_PORT + i``; put a load balancer in front of
+    the worker ports. Children that exit are restarted, and stopping the
+    supervisor stops them all.
+    """
+    store_path = os.path.abspath(MEME_STORE_PATH)
+    # Create the database (and switch it to WAL) before any child opens it
+    SharedMemeStore(store_path).close()
+    
+    def spawn(role: str, index: int) -> subprocess.Popen:
+        env = dict(os.environ, SHARD_ROLE=role, SHARD_INDEX=str(index), MEME_STORE_PATH=store_path)
+        if role == 'worker':
+            env['WEBHOOK_PORT'] = str(WEBHOOK_PORT + index)
+            if METRICS_PORT:
+                env['METRICS_PORT'] = str(METRICS_PORT + 1 + index)
+            if MEDIA_CACHE_DIR:
+                env['MEDIA_CACHE_DIR'] = os.path.join(MEDIA_CACHE_DIR, f'worker{index}')
+            # The workers' render pools share the machine's cores
+            env['RENDER_WORKERS'] = str(max(1, RENDER_WORKERS // SHARD_WORKERS))
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+    
+    shards = [('fetcher', 0)] + [('worker', index) for index in range(SHARD_WORKERS)]
+    children: Dict[Tuple[str, int], subprocess.Popen] = {}
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    
+    print(f"🧩 Starting 1 fetcher and {SHARD_WORKERS} workers "
+          f"on ports {WEBHOOK_PORT}-{WEBHOOK_PORT + SHARD_WORKERS - 1}")
+    try:
+        for role, index in shards:
+            children[(role, index)] = spawn(role, index)
+        while True:
+            time.sleep(1)
+            for (role, index), child in children.items():
+                if child.poll() is not None:
+                    logger.warning("Shard %s %s exited with code %s, restarting", role, index, child.returncode)
+                    children[(role, index)] = spawn(role, index)
+    except KeyboardInterrupt:
+        print("\n🛑 Bot stopped by user.")
+    finally:
+        for child in children.values():
+            child.terminate()
+        for child in children.values():
+            try:
+                child.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                child.kill()
+
+
 def main() -> None:
     """Start the bot."""
     # Get bot token from environment variable
-    import os
     bot_token = os.getenv('TELEGRAM_BOT_TOKEN')
     
     if not bot_token:
@@ -427,26 +4033,88 @@ def main() -> None:
         print("Please set your bot token: export TELEGRAM_BOT_TOKEN='your_token_here'")
         return
     
+    if SHARD_ROLE == 'fetcher':
+        try:
+            asyncio.run(run_fetcher())
+        except KeyboardInterrupt:
+            pass
+        return
+    
+    if SHARD_WORKERS > 0 and not SHARD_ROLE:
+        if not WEBHOOK_URL:
+            # Several getUpdates consumers on one token conflict, so workers need webhooks
+            print("❌ Error: SHARD_WORKERS requires webhook mode, set WEBHOOK_URL too!")
+            return
+        if not MEME_STORE_PATH:
+            print("❌ Error: SHARD_WORKERS requires MEME_STORE_PATH for the shared store!")
+            return
+        run_supervisor()
+        return
+    
+    from telegram.ext import Application, CommandHandler, InlineQueryHandler
+    
     # Create the Application
-    application = Application.builder().token(bot_token).build()
+    builder = (
+        Application.builder()
+        .token(bot_token)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if TELEGRAM_API_BASE_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_BASE_URL}/bot")
+    application = builder.build()
     
     # Add command handlers
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("meme", meme_command))
+    application.add_handler(CommandHandler("make", make_command))
+    application.add_handler(CommandHandler("subreddits", subreddits_command))
     application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("health", health_command))
+    application.add_handler(InlineQueryHandler(inline_query))
+    
+    # Keep the meme pools warm in the background
+    if application.job_queue is not None:
+        # Workers only poll the shared store, which is cheap, so they check it often
+        interval = SHARED_STORE_POLL_INTERVAL if SHARD_ROLE == 'worker' else POOL_REFRESH_INTERVAL
+        application.job_queue.run_repeating(refresh_meme_pools, interval=interval, first=interval)
+    else:
+        logger.warning("Job queue unavailable; pools will only refresh on demand. "
+                       "Install python-telegram-bot[job-queue] for background refresh.")
+    
+    if PREWARM:
+        # PTB runs the bot on the current event loop; a task created on it now
+        # runs while Application.initialize() is still talking to Telegram
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        application.bot_data['prewarm'] = loop.create_task(prewarm())
     
     # Print startup message
     print("🤖 Telegram Meme Bot is starting...")
-    print("📱 Bot will fetch memes from:")
+    print("📱 Bot will fetch memes from (unless a chat picks its own with /subreddits):")
     for subreddit in SUBREDDITS:
         print(f"   • r/{subreddit}")
     print("🔄 Giphy will be used as fallback if Reddit is unavailable")
     print("🛡️ Classic memes are available as final fallback")
+    if WEBHOOK_URL:
+        print(f"🌐 Serving webhook on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
     print("🚀 Bot is now running! Press Ctrl+C to stop.")
     
     # Start the bot
     try:
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        if WEBHOOK_URL:
+            application.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET_TOKEN,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=ALLOWED_UPDATES,
+            )
+        else:
+            application.run_polling(allowed_updates=ALLOWED_UPDATES)
     except KeyboardInterrupt:
         print("\n🛑 Bot stopped by user.")
     except Exception as e:
@@ -7,10 +7,10 @@ This script tests the MemeFetcher class without requiring a Telegram bot token.
 import sys
 import os
 
-# Add the current directory to Python path to import the bot module
+# Add the current directory to Python path to import the fetcher module
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from telegram_meme_bot import MemeFetcher
+from meme_core import MemeFetcher
 
 def test_meme_fetching():
     """Test the meme fetching functionality."""
@@ -35,9 +35,9 @@ def test_meme_fetching():
                 
                 # Show first meme details
                 first_meme = memes[0]
-                print(f"   📝 Title: {first_meme['title'][:50]}...")
-                print(f"   🔗 URL: {first_meme['url']}")
-                print(f"   📍 Source: r/{first_meme['subreddit']}")
+                print(f"   📝 Title: {first_meme.title[:50]}...")
+                print(f"   🔗 URL: {first_meme.url}")
+                print(f"   📍 Source: r/{first_meme.subreddit}")
             else:
                 print(f"❌ No valid memes found in r/{subreddit}")
                 
@@ -51,9 +51,9 @@ def test_meme_fetching():
         
         if giphy_meme:
             print("✅ Giphy meme fetched successfully!")
-            print(f"   📝 Title: {giphy_meme['title']}")
-            print(f"   🔗 URL: {giphy_meme['url']}")
-            print(f"   📍 Source: {giphy_meme['source']}")
+            print(f"   📝 Title: {giphy_meme.title}")
+            print(f"   🔗 URL: {giphy_meme.url}")
+            print(f"   📍 Source: {giphy_meme.source_label}")
         else:
             print("❌ Failed to fetch Giphy meme")
             
@@ -67,12 +67,9 @@ def test_meme_fetching():
         
         if random_meme:
             print("✅ Random meme fetched successfully!")
-            print(f"   📝 Title: {random_meme['title']}")
-            print(f"   🔗 URL: {random_meme['url']}")
-            if random_meme.get('source') == 'Giphy':
-                print(f"   📍 Source: {random_meme['source']}")
-            else:
-                print(f"   📍 Source: r/{random_meme['subreddit']}")
+            print(f"   📝 Title: {random_meme.title}")
+            print(f"   🔗 URL: {random_meme.url}")
+            print(f"   📍 Source: {random_meme.source_label}")
         else:
             print("❌ Failed to fetch random meme")
             